@@ -0,0 +1,437 @@
+# agents/backends.py
+import os
+import re
+import json
+import time
+import random
+import threading
+from collections import deque
+
+from .tokens import estimate_tokens, estimate_messages_tokens
+
+# 默认使用的后端，可通过环境变量 LLM_BACKEND 切换：dashscope / openai / mock / fake
+DEFAULT_BACKEND = "dashscope"
+
+# 本地模拟服务器的默认地址（见 agents/mock_server.py）
+DEFAULT_MOCK_URL = "http://127.0.0.1:8765/v1"
+
+MOCK_MERMAID = "graph TD\n    A[主题] --> B[论点一]\n    A --> C[论点二]\n    B --> D[结论]"
+
+# 合并请求（见 agents/orchestrator.py）的系统提示词中，每个角色的规则以 "### key：" 一行开始；
+# 单个智能体的提示词没有这种行，模拟回复按这个结构识别合并请求，不需要在真实的提示词中加标记
+_COMBINED_ROLE_RE = re.compile(r'^### (\w+)：', re.M)
+
+
+def mock_reply(messages):
+    """根据系统提示词生成确定性的模拟回复（供模拟服务器和 FakeBackend 使用）"""
+    system_prompt = messages[0].get("content", "") if messages else ""
+    draft = messages[-1].get("content", "") if messages else ""
+    review = f"- 【模拟回复】已收到 {len(draft)} 个字符的内容。\n- 第一条反馈。\n- 第二条反馈。"
+    parts = _COMBINED_ROLE_RE.split(system_prompt)[1:]
+    if parts:
+        # 合并请求：每个角色一个键的 JSON，图表角色给出 Mermaid 代码
+        return json.dumps({
+            key: MOCK_MERMAID if "Mermaid" in rules else review
+            for key, rules in zip(parts[0::2], parts[1::2])
+        }, ensure_ascii=False)
+    if "Mermaid" in system_prompt:
+        return MOCK_MERMAID
+    return review
+
+
+class BackendError(Exception):
+    """模型接口返回错误；status_code 为 HTTP 状态码（网络错误时为 None）"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class LLMResponse:
+    """
+    一次模型调用的结果；流式调用时表示一个分片
+    usage 为 {"prompt_tokens": int, "completion_tokens": int}，没有时为 None
+    retries 为得到这个结果之前重试的次数（见 agents/resilience.py）
+    """
+
+    __slots__ = ("text", "usage", "retries")
+
+    def __init__(self, text, usage=None, retries=0):
+        self.text = text
+        self.usage = usage
+        self.retries = retries
+
+
+class LLMBackend:
+    """模型后端接口，子类实现 complete 和 stream"""
+
+    name = "base"
+
+    def complete(self, model, messages, **kwargs):
+        """
+        阻塞调用，返回 LLMResponse；失败时抛出 BackendError
+        :param model: 模型名称
+        :param messages: 消息列表
+        """
+        raise NotImplementedError
+
+    def stream(self, model, messages, **kwargs):
+        """
+        流式调用，逐个产出 LLMResponse 分片（text 为新增文本，最后一个分片可能带 usage）；
+        失败时抛出 BackendError
+        """
+        raise NotImplementedError
+
+    def warm_up(self):
+        """提前完成耗时的初始化（例如导入 SDK），默认什么也不做"""
+
+
+class DashScopeBackend(LLMBackend):
+    """
+    通义千问 DashScope 原生 SDK
+    新版 SDK 在进程内共享一个带连接池的 requests.Session，连接会被复用
+    """
+
+    name = "dashscope"
+
+    def __init__(self, api_key=None):
+        # 导入 SDK 需要约 0.4 秒，推迟到第一次请求（或 warm_up）时，创建智能体不再拖慢页面的首次渲染
+        self._api_key = api_key
+        self._dashscope = None
+        self._lock = threading.Lock()
+
+    def _sdk(self):
+        if self._dashscope is None:
+            with self._lock:
+                if self._dashscope is None:
+                    import dashscope
+                    # 配置 DashScope API
+                    dashscope.api_key = self._api_key or os.getenv("DASHSCOPE_API_KEY")
+                    self._dashscope = dashscope
+        return self._dashscope
+
+    def warm_up(self):
+        self._sdk()
+
+    @staticmethod
+    def _wrap_error(e):
+        """
+        把 SDK 和 requests 抛出的异常（连接被重置、读超时、DNS 失败等）转换成 BackendError，
+        网络类错误的 status_code 为 None，上层会按可重试处理
+        """
+        from dashscope.common.error import (
+            DashScopeException, TimeoutException, ServiceUnavailableError, RequestFailure, AuthenticationError
+        )
+        if isinstance(e, (OSError, TimeoutException, ServiceUnavailableError, RequestFailure)):
+            return BackendError(str(e), None)
+        if isinstance(e, AuthenticationError):
+            return BackendError(str(e), 401)
+        if isinstance(e, DashScopeException):
+            return BackendError(str(e), 400)
+        return None
+
+    def complete(self, model, messages, **kwargs):
+        try:
+            response = self._sdk().Generation.call(
+                model=model,
+                messages=messages,
+                result_format='message',
+                **kwargs
+            )
+        except Exception as e:
+            error = self._wrap_error(e)
+            if error is None:
+                raise
+            raise error from e
+        if response.status_code != 200:
+            raise BackendError(response.message, response.status_code)
+        return LLMResponse(response.output.choices[0]['message']['content'], self._usage(response))
+
+    def stream(self, model, messages, **kwargs):
+        # incremental_output=True 时每个分片只包含新增的文本
+        usage = None
+        try:
+            responses = self._sdk().Generation.call(
+                model=model,
+                messages=messages,
+                result_format='message',
+                stream=True,
+                incremental_output=True,
+                **kwargs
+            )
+            for response in responses:
+                if response.status_code != 200:
+                    raise BackendError(response.message, response.status_code)
+                usage = self._usage(response) or usage
+                delta = response.output.choices[0]['message']['content']
+                if delta:
+                    yield LLMResponse(delta)
+        except BackendError:
+            raise
+        except Exception as e:
+            error = self._wrap_error(e)
+            if error is None:
+                raise
+            raise error from e
+        if usage:
+            yield LLMResponse("", usage)
+
+    @staticmethod
+    def _usage(response):
+        usage = getattr(response, "usage", None)
+        if not usage:
+            return None
+        return {
+            "prompt_tokens": usage.get("input_tokens", 0),
+            "completion_tokens": usage.get("output_tokens", 0),
+        }
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    OpenAI 兼容接口（OpenAI、自建 vLLM 等服务、DashScope compatible-mode、本地模拟服务器）
+    同一个 base_url 共用一个客户端实例，底层 HTTP 连接池保持长连接
+    """
+
+    name = "openai"
+
+    def __init__(self, base_url=None, api_key=None, timeout=60.0):
+        self.base_url = base_url or os.getenv("OPENAI_BASE_URL")
+        # 导入 SDK 需要近 1 秒，客户端推迟到第一次请求（或 warm_up）时创建
+        self._api_key = api_key
+        self._timeout = timeout
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from openai import OpenAI
+                    # 重试由上层统一控制，这里关闭 SDK 自带的重试
+                    self._client = OpenAI(
+                        base_url=self.base_url,
+                        api_key=self._api_key or os.getenv("OPENAI_API_KEY") or "EMPTY",
+                        timeout=self._timeout,
+                        max_retries=0
+                    )
+        return self._client
+
+    def warm_up(self):
+        self._get_client()
+
+    def complete(self, model, messages, **kwargs):
+        import openai
+        try:
+            response = self._get_client().chat.completions.create(model=model, messages=messages, **kwargs)
+        except openai.APIStatusError as e:
+            raise BackendError(str(e), e.status_code) from e
+        except openai.APIError as e:
+            raise BackendError(str(e)) from e
+        return LLMResponse(response.choices[0].message.content or "", self._usage(response))
+
+    def stream(self, model, messages, **kwargs):
+        import openai
+        try:
+            chunks = self._get_client().chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                **kwargs
+            )
+            for chunk in chunks:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield LLMResponse(delta)
+                usage = self._usage(chunk)
+                if usage:
+                    yield LLMResponse("", usage)
+        except openai.APIStatusError as e:
+            raise BackendError(str(e), e.status_code) from e
+        except openai.APIError as e:
+            raise BackendError(str(e)) from e
+
+    @staticmethod
+    def _usage(response):
+        usage = getattr(response, "usage", None)
+        if not usage:
+            return None
+        return {
+            "prompt_tokens": usage.prompt_tokens or 0,
+            "completion_tokens": usage.completion_tokens or 0,
+        }
+
+
+class FakeBackend(LLMBackend):
+    """
+    进程内的确定性假后端，用于基准测试和压力测试
+    :param latency: 每次调用的固定延迟（秒）
+    :param jitter: 延迟的随机抖动范围（秒），使用固定种子，结果可复现
+    :param chunk_delay: 流式输出时分片之间的间隔（秒）
+    :param seed: 随机种子
+    :param failure_rate: 请求失败（抛出 BackendError）的概率
+    :param failure_statuses: 失败时随机使用的状态码
+    :param tail_rate: 请求进入长尾的概率
+    :param tail_latency: 长尾请求额外增加的延迟（秒）
+    :param token_latency: 每个提示 token 额外增加的延迟（秒），模拟长提示的处理时间
+    :param completion_token_latency: 每个生成 token 额外增加的延迟（秒），模拟逐个生成回复的时间
+    """
+
+    name = "fake"
+
+    def __init__(self, latency=0.0, jitter=0.0, chunk_delay=0.0, chunk_size=4, seed=0,
+                 failure_rate=0.0, failure_statuses=(429, 500, 503), tail_rate=0.0, tail_latency=0.0,
+                 token_latency=0.0, completion_token_latency=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.failure_rate = failure_rate
+        self.failure_statuses = list(failure_statuses)
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.token_latency = token_latency
+        self.completion_token_latency = completion_token_latency
+        self.calls = 0
+        self.failures = 0
+        # 最近若干次请求的大小，供基准测试统计
+        self.requests = deque(maxlen=1000)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _begin(self, model, messages):
+        text = mock_reply(messages)
+        with self._lock:
+            self.calls += 1
+            self.requests.append({
+                "model": model,
+                "message_count": len(messages),
+                "prompt_bytes": sum(len(m.get("content", "").encode("utf-8")) for m in messages),
+            })
+            delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+            if self.token_latency:
+                delay += estimate_messages_tokens(messages) * self.token_latency
+            if self.completion_token_latency:
+                delay += estimate_tokens(text) * self.completion_token_latency
+            if self.tail_rate and self._random.random() < self.tail_rate:
+                delay += self.tail_latency
+            status = None
+            if self.failure_rate and self._random.random() < self.failure_rate:
+                self.failures += 1
+                status = self._random.choice(self.failure_statuses)
+        if delay > 0:
+            time.sleep(delay)
+        if status is not None:
+            raise BackendError(f"fake failure ({status})", status)
+        usage = {
+            "prompt_tokens": estimate_messages_tokens(messages),
+            "completion_tokens": estimate_tokens(text),
+        }
+        return text, usage
+
+    def complete(self, model, messages, **kwargs):
+        text, usage = self._begin(model, messages)
+        return LLMResponse(text, usage)
+
+    def stream(self, model, messages, **kwargs):
+        text, usage = self._begin(model, messages)
+        for start in range(0, len(text), self.chunk_size):
+            if start and self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            yield LLMResponse(text[start:start + self.chunk_size])
+        yield LLMResponse("", usage)
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+_warmed_up = set()
+
+_env_loaded = False
+
+
+def load_env():
+    """
+    加载 .env 中的环境变量，每个进程只加载一次
+    与 python-dotenv 的默认行为一样从本目录向上查找 .env；只有找到文件时才导入 python-dotenv，
+    直接注入环境变量的部署（例如容器）不需要付出导入的开销
+    """
+    global _env_loaded
+    if _env_loaded:
+        return
+    _env_loaded = True
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        path = os.path.join(directory, ".env")
+        if os.path.isfile(path):
+            from dotenv import load_dotenv
+            load_dotenv(path)
+            return
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return
+        directory = parent
+
+
+def warm_up_in_background(backend):
+    """
+    在后台线程中预热后端（导入 SDK、创建客户端），每个后端只预热一次
+    在页面首次渲染之后调用：首屏不等待 SDK 导入，第一次提交时 SDK 通常已经就绪
+    """
+    with _backends_lock:
+        if id(backend) in _warmed_up:
+            return
+        _warmed_up.add(id(backend))
+
+    def run():
+        try:
+            backend.warm_up()
+        except Exception as e:
+            # 预热失败不影响使用，第一次请求时会再次尝试并报告错误
+            print(f"Warning: backend warm-up failed: {str(e)}")
+
+    threading.Thread(target=run, name=f"warm-up-{backend.name}", daemon=True).start()
+
+
+def get_backend(name=None):
+    """
+    获取进程级共享的后端实例（连接池在所有智能体和会话之间复用）
+    :param name: dashscope / openai / mock / fake，默认读取环境变量 LLM_BACKEND
+        - openai：使用 OPENAI_BASE_URL、OPENAI_API_KEY
+        - mock：连接 MOCK_LLM_URL（默认 http://127.0.0.1:8765/v1）上的本地模拟服务器
+        - fake：进程内假后端，延迟由 FAKE_LLM_LATENCY（秒）指定
+    """
+    name = (name or os.getenv("LLM_BACKEND") or DEFAULT_BACKEND).lower()
+    with _backends_lock:
+        if name not in _backends:
+            if name == "dashscope":
+                backend = DashScopeBackend()
+            elif name == "openai":
+                backend = OpenAICompatibleBackend()
+            elif name == "mock":
+                backend = OpenAICompatibleBackend(base_url=os.getenv("MOCK_LLM_URL", DEFAULT_MOCK_URL))
+            elif name == "fake":
+                backend = FakeBackend(latency=float(os.getenv("FAKE_LLM_LATENCY", "0")))
+            else:
+                raise ValueError(f"Unknown LLM backend: {name}")
+            _backends[name] = _make_resilient(backend)
+        return _backends[name]
+
+
+def _make_resilient(backend):
+    """
+    按环境变量给后端加上重试、对冲和熔断（见 agents/resilience.py）
+    LLM_MAX_RETRIES（默认 2，设为 0 关闭重试）、LLM_HEDGE_AFTER（秒，默认不对冲）、
+    LLM_BREAKER_THRESHOLD（连续失败多少次熔断，默认 5）、LLM_BREAKER_RESET（熔断持续秒数，默认 30）
+    """
+    from .resilience import ResilientBackend, RetryPolicy
+    hedge_after = os.getenv("LLM_HEDGE_AFTER")
+    return ResilientBackend(
+        backend,
+        retry_policy=RetryPolicy(max_retries=int(os.getenv("LLM_MAX_RETRIES", "2"))),
+        hedge_after=float(hedge_after) if hedge_after else None,
+        failure_threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", "5")),
+        reset_timeout=float(os.getenv("LLM_BREAKER_RESET", "30"))
+    )
@@ -1,24 +1,158 @@
 # agents/base_agent.py
-import os
-import dashscope
-from dotenv import load_dotenv
+from .backends import get_backend, BackendError, load_env
+from .metrics import CallRecord, get_registry
+from .routing import PromptTooLargeError
+from .similarity import get_similarity_cache, scope_key
 
 # 加载环境变量
-load_dotenv()
-
-# 配置 DashScope API
-dashscope.api_key = os.getenv("DASHSCOPE_API_KEY")
+load_env()
 
 class BaseAgent:
-    def __init__(self, name, role, model="qwen-plus"):
+    # 是否默认使用近似重复草稿的缓存：只对改几个字不影响结果的智能体打开（资料补充、图表）
+    use_similarity_cache = False
+
+    def __init__(self, name, role, model="qwen-plus", cache=None, history_manager=None, backend=None, metrics=None,
+                 similarity_cache=None, routing=None):
         self.name = name
         self.role = role
         self.model_name = model
+        # 回复缓存（可选），相同输入直接返回上次的结果
+        self.cache = cache
+        # 近似重复草稿的缓存（可选），草稿只有少量改动时返回上次的结果；
+        # 不传时按 use_similarity_cache 决定是否使用进程共享的缓存，传入 False 关闭
+        if similarity_cache is None and self.use_similarity_cache:
+            similarity_cache = get_similarity_cache()
+        self.similarity_cache = similarity_cache or None
+        # 对话历史管理（可选），把历史压缩到 token 预算以内
+        self.history_manager = history_manager
+        # 模型后端，默认使用进程共享的后端（由环境变量 LLM_BACKEND 决定）
+        self.backend = backend or get_backend()
+        # 调用度量登记表，默认使用进程共享的登记表
+        self.metrics = metrics or get_registry()
+        # 按提示大小选择模型的策略（可选，见 agents/routing.py）；没有时总是使用 model
+        self.routing = routing
 
     def get_system_prompt(self):
         """需要子类重写"""
         return "You are a helpful assistant."
 
+    def build_messages(self, user_content, context_material=None, conversation_history=None):
+        """
+        构造发送给模型的消息列表
+        :param user_content: 用户的草稿
+        :param context_material: 上传的参考资料（可选）
+        :param conversation_history: 对话历史（可选）
+        """
+        return self._prepare_messages(user_content, context_material, conversation_history)[0]
+
+    def _prepare_messages(self, user_content, context_material=None, conversation_history=None):
+        """构造消息列表，同时返回历史压缩的统计（没有压缩时为 None）"""
+        messages = [
+            {"role": "system", "content": self.get_system_prompt()}
+        ]
+
+        # 如果有参考资料，注入到消息中
+        if context_material:
+            messages.append(self._context_message(context_material))
+
+        # 添加对话历史（如果有），超出预算时较早的轮次会被折叠成摘要
+        history_stats = None
+        if conversation_history:
+            if self.history_manager is not None:
+                conversation_history, history_stats = self.history_manager.prepare(
+                    conversation_history, self.summarize_history
+                )
+            # 历史中可能是紧凑的消息记录，发送前转换成普通的 dict
+            messages.extend({"role": m["role"], "content": m["content"]} for m in conversation_history)
+
+        # 添加当前用户内容
+        messages.append({
+            "role": "user",
+            "content": f"【用户正在撰写的文档】\n{user_content}\n\n请根据你的角色给出反馈。"
+        })
+        return messages, history_stats
+
+    @staticmethod
+    def _context_message(context_material):
+        """参考资料消息"""
+        return {
+            "role": "system",
+            "content": (
+                "【参考资料/背景知识】\n"
+                "请优先基于以下提供的资料内容进行分析。如果用户的内容与资料冲突，请指出。\n"
+                f"---开始资料---\n{context_material}\n---结束资料---\n\n"
+            )
+        }
+
+    def _route(self, record, messages, context_material=None):
+        """
+        发送前的检查：按路由策略选择模型，必要时截短参考资料
+        :return: (模型名称, 实际发送的消息列表)
+        :raises PromptTooLargeError: 提示超过上限，请求不会发出
+        """
+        if self.routing is None:
+            return self.model_name, messages
+        try:
+            decision = self.routing.route(messages, context_material, self._context_message,
+                                          label=f"{type(self).__name__}/{self.name}")
+        except PromptTooLargeError as e:
+            record.route = "rejected"
+            record.estimated_tokens = e.prompt_tokens
+            raise
+        record.model = decision.model
+        record.route = decision.tier.name
+        record.estimated_tokens = decision.prompt_tokens
+        record.trimmed_tokens = decision.trimmed_tokens
+        return decision.model, decision.messages
+
+    def _new_record(self, streamed):
+        return CallRecord(type(self).__name__, self.name, self.model_name, self.backend.name, streamed=streamed)
+
+    @staticmethod
+    def _record_error(record, error):
+        record.error = str(error) or type(error).__name__
+        if isinstance(error, BackendError):
+            record.status_code = error.status_code
+
+    def _lookup_similar(self, user_content, context_material, conversation_history):
+        """
+        在近似缓存中查找只有少量改动的草稿
+        :return: (scope, 命中结果)；没有启用近似缓存时 scope 为 None，没有命中时结果为 None，否则为 (回复, 相似度)
+        """
+        if self.similarity_cache is None:
+            return None, None
+        scope = scope_key(self, context_material, conversation_history)
+        return scope, self.similarity_cache.lookup(scope, user_content)
+
+    def lookup_cached(self, user_content, context_material=None, conversation_history=None):
+        """
+        只查回复缓存和近似缓存，不调用模型（供合并请求等绕过 process 的调用方使用）
+        :return: 命中时返回回复（同时记录一次命中缓存的调用），否则返回 None
+        """
+        cached = None
+        similarity = None
+        if self.cache is not None:
+            cached = self.cache.get(self.cache.make_key(self, user_content, context_material, conversation_history))
+        if cached is None:
+            _, similar = self._lookup_similar(user_content, context_material, conversation_history)
+            if similar is not None:
+                cached, similarity = similar
+        if cached is None:
+            return None
+        record = self._new_record(streamed=False)
+        record.cache_hit = True
+        record.similarity = similarity
+        self.metrics.record(record.finish())
+        return cached
+
+    def store_reply(self, user_content, context_material, conversation_history, reply):
+        """把在别处得到的回复（例如合并请求中本智能体的部分）按本智能体的缓存键写入回复缓存和近似缓存"""
+        if self.cache is not None:
+            self.cache.put(self.cache.make_key(self, user_content, context_material, conversation_history), reply)
+        if self.similarity_cache is not None:
+            scope = scope_key(self, context_material, conversation_history)
+            self.similarity_cache.put(scope, user_content, reply)
+
     def process(self, user_content, context_material=None, conversation_history=None):
         """
         核心处理逻辑
@@ -26,46 +160,122 @@ class BaseAgent:
         :param context_material: 上传的参考资料（可选）
         :param conversation_history: 对话历史（可选）
         """
+        record = self._new_record(streamed=False)
         try:
+            cache_key = None
+            if self.cache is not None:
+                cache_key = self.cache.make_key(self, user_content, context_material, conversation_history)
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    record.cache_hit = True
+                    return cached
+
+            similar_scope, similar = self._lookup_similar(user_content, context_material, conversation_history)
+            if similar is not None:
+                record.cache_hit = True
+                record.similarity = similar[1]
+                return similar[0]
+
             # 构造消息列表
-            messages = [
-                {"role": "system", "content": self.get_system_prompt()}
-            ]
-            
-            # 如果有参考资料，注入到消息中
-            if context_material:
-                messages.append({
-                    "role": "system", 
-                    "content": (
-                        "【参考资料/背景知识】\n"
-                        "请优先基于以下提供的资料内容进行分析。如果用户的内容与资料冲突，请指出。\n"
-                        f"---开始资料---\n{context_material}\n---结束资料---\n\n"
-                    )
-                })
-            
-            # 添加对话历史（如果有）
-            if conversation_history:
-                messages.extend(conversation_history)
-            
-            # 添加当前用户内容
-            messages.append({
-                "role": "user",
-                "content": f"【用户正在撰写的文档】\n{user_content}\n\n请根据你的角色给出反馈。"
-            })
-            
-            # 发送请求
-            response = dashscope.Generation.call(
-                model=self.model_name,
-                messages=messages,
-                result_format='message'
-            )
-            
-            # 处理响应
-            if response.status_code == 200:
-                ai_response = response.output.choices[0]['message']['content']
-                # 返回结果和更新后的对话历史
-                return ai_response
-            else:
-                return f"Error: {response.message}"
+            messages, history_stats = self._prepare_messages(user_content, context_material, conversation_history)
+            if history_stats:
+                record.history_saved_tokens = history_stats["saved_tokens"]
+
+            # 发送前检查提示大小并选择模型，超过上限时不发送
+            model, messages = self._route(record, messages, context_material)
+
+            # 发送请求，失败时后端抛出 BackendError
+            response = self.backend.complete(model, messages)
+            record.first_byte()
+            record.add_usage(response.usage)
+            record.retries += response.retries
+            ai_response = response.text
+            if cache_key is not None:
+                self.cache.put(cache_key, ai_response)
+            if similar_scope is not None:
+                self.similarity_cache.put(similar_scope, user_content, ai_response)
+            return ai_response
         except Exception as e:
-            return f"Error: {str(e)}"
\ No newline at end of file
+            self._record_error(record, e)
+            return f"Error: {str(e)}"
+        finally:
+            self.metrics.record(record.finish())
+
+    def stream(self, user_content, context_material=None, conversation_history=None):
+        """
+        流式处理逻辑：模型每生成一段文本就立即产出，参数与 process 相同
+        出错时产出一段 "Error: ..." 文本后结束
+        """
+        record = self._new_record(streamed=True)
+        completed = False
+        try:
+            cache_key = None
+            if self.cache is not None:
+                cache_key = self.cache.make_key(self, user_content, context_material, conversation_history)
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    record.cache_hit = True
+                    record.first_byte()
+                    completed = True
+                    yield cached
+                    return
+
+            similar_scope, similar = self._lookup_similar(user_content, context_material, conversation_history)
+            if similar is not None:
+                record.cache_hit = True
+                record.similarity = similar[1]
+                record.first_byte()
+                completed = True
+                yield similar[0]
+                return
+
+            messages, history_stats = self._prepare_messages(user_content, context_material, conversation_history)
+            if history_stats:
+                record.history_saved_tokens = history_stats["saved_tokens"]
+
+            model, messages = self._route(record, messages, context_material)
+
+            chunks = []
+            for chunk in self.backend.stream(model, messages):
+                record.add_usage(chunk.usage)
+                record.retries += chunk.retries
+                if chunk.text:
+                    record.first_byte()
+                    chunks.append(chunk.text)
+                    yield chunk.text
+            completed = True
+
+            # 只缓存完整生成的回复
+            if cache_key is not None:
+                self.cache.put(cache_key, "".join(chunks))
+            if similar_scope is not None:
+                self.similarity_cache.put(similar_scope, user_content, "".join(chunks))
+        except Exception as e:
+            self._record_error(record, e)
+            completed = True
+            yield f"Error: {str(e)}"
+        finally:
+            # 调用方提前放弃（例如超时）时生成器被关闭，记为取消
+            if not completed and record.error is None:
+                record.error = "cancelled"
+            self.metrics.record(record.finish())
+
+    def summarize_history(self, previous_summary, messages):
+        """
+        把较早的对话压缩成摘要（供 HistoryManager 调用）
+        :param previous_summary: 已有的摘要，没有时为空字符串
+        :param messages: 需要并入摘要的新消息
+        """
+        transcript = "\n".join(
+            f"{'用户' if m.get('role') == 'user' else self.name}: {m.get('content', '')}" for m in messages
+        )
+        return self.backend.complete(self.model_name, [
+            {
+                "role": "system",
+                "content": "你是对话摘要助手。请把对话压缩成简洁的中文要点，保留用户文档的主题、已经指出的问题和给出的结论，不超过300字。"
+            },
+            {
+                "role": "user",
+                "content": f"【已有摘要】\n{previous_summary or '（无）'}\n\n【新增对话】\n{transcript}\n\n请输出更新后的完整摘要。"
+            }
+        ]).text
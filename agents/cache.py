@@ -0,0 +1,145 @@
+# agents/cache.py
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def _digest(value):
+    """对任意可 JSON 序列化的对象求 SHA-256 摘要"""
+    data = json.dumps(value, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    智能体回复缓存
+    - 内存层：有界 LRU，超过 max_entries 时淘汰最久未使用的条目
+    - 磁盘层（可选）：SQLite 文件，Streamlit 重启后仍然有效
+    """
+
+    # 每写入多少次检查一次磁盘层的条目上限
+    PRUNE_EVERY = 64
+
+    def __init__(self, max_entries=256, path=None, max_disk_entries=5000):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.path = path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(agent, user_content, context_material=None, conversation_history=None):
+        """
+        生成缓存键：智能体类型、模型、系统提示词、参考资料摘要、对话历史摘要和草稿
+        """
+        return _digest([
+            type(agent).__name__,
+            agent.model_name,
+            agent.get_system_prompt(),
+            _digest(context_material or ""),
+            _digest([[m.get("role"), m.get("content")] for m in conversation_history or []]),
+            user_content,
+        ])
+
+    def get(self, key):
+        """查询缓存，未命中时返回 None"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._remember(key, row[0])
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """写入缓存（同时写入内存层和磁盘层）"""
+        with self._lock:
+            self._remember(key, value)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)",
+                    (key, value, time.time())
+                )
+                self._writes += 1
+                if self._writes % self.PRUNE_EVERY == 0:
+                    self._prune_disk()
+                self._db.commit()
+
+    def clear(self):
+        """清空内存层和磁盘层"""
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self):
+        """返回命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+            }
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune_disk(self):
+        # 只保留最新的 max_disk_entries 条
+        self._db.execute(
+            "DELETE FROM responses WHERE key NOT IN "
+            "(SELECT key FROM responses ORDER BY created DESC LIMIT ?)",
+            (self.max_disk_entries,)
+        )
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    进程级共享的回复缓存
+    通过环境变量配置：AGENT_CACHE_SIZE（内存条目数，默认 256），
+    AGENT_CACHE_PATH（SQLite 文件路径，不设置则只使用内存层）
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache(
+                max_entries=int(os.getenv("AGENT_CACHE_SIZE", "256")),
+                path=os.getenv("AGENT_CACHE_PATH") or None
+            )
+        return _default_cache
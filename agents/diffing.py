@@ -0,0 +1,170 @@
+# agents/diffing.py
+import re
+import difflib
+
+from .tokens import estimate_tokens
+
+# 改动部分占全文的比例超过这个值时，重新发送全文
+FULL_PASS_RATIO = 0.5
+
+# 草稿少于这么多段时总是发送全文，差异提示不会更短
+MIN_PARAGRAPHS = 3
+
+# 未修改的段落在提示中只保留开头的这么多个字符，帮助模型定位
+ANCHOR_CHARS = 20
+
+# 一份草稿与下一次提交相同段落的比例达到这个值时，视为被取代的旧版本
+SUPERSEDED_RATIO = 0.5
+
+SUPERSEDED_PLACEHOLDER = "【较早版本的草稿，已被之后的修订版取代，正文从略】"
+
+_BLANK_LINE_RE = re.compile(r'\n\s*\n')
+
+
+def split_paragraphs(text):
+    """
+    把草稿按段落拆分：优先按空行分段，没有空行时按单个换行分段
+    段内的连续空白合并为一个空格，只改动空白不算修改
+    """
+    text = (text or "").strip()
+    if not text:
+        return []
+    blocks = _BLANK_LINE_RE.split(text) if _BLANK_LINE_RE.search(text) else text.split("\n")
+    paragraphs = (" ".join(block.split()) for block in blocks)
+    return [p for p in paragraphs if p]
+
+
+class DraftDiff:
+    """
+    两版草稿在段落级别的差异
+    unchanged 为未修改的段落，modified 为 (旧段落, 新段落)，added 为新增的段落，removed 为删除的段落
+    """
+
+    __slots__ = ("paragraphs", "unchanged", "modified", "added", "removed")
+
+    def __init__(self, paragraphs):
+        self.paragraphs = paragraphs
+        self.unchanged = []
+        self.modified = []
+        self.added = []
+        self.removed = []
+
+    @property
+    def changed(self):
+        return bool(self.modified or self.added or self.removed)
+
+    @property
+    def change_ratio(self):
+        """改动涉及的字符数占新草稿字符数的比例（删除的段落按原长度计）"""
+        total = sum(len(p) for p in self.paragraphs) or 1
+        changed = (
+            sum(len(new) for _, new in self.modified)
+            + sum(len(p) for p in self.added)
+            + sum(len(p) for p in self.removed)
+        )
+        return changed / total
+
+
+def diff_drafts(previous, current):
+    """
+    按段落比较两版草稿
+    :return: DraftDiff；替换块中一一对应的段落算修改，多出来的算新增或删除
+    """
+    old = split_paragraphs(previous)
+    new = split_paragraphs(current)
+    diff = DraftDiff(new)
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            diff.unchanged.extend(new[j1:j2])
+        elif tag == "insert":
+            diff.added.extend(new[j1:j2])
+        elif tag == "delete":
+            diff.removed.extend(old[i1:i2])
+        else:
+            pairs = min(i2 - i1, j2 - j1)
+            diff.modified.extend(zip(old[i1:i1 + pairs], new[j1:j1 + pairs]))
+            diff.removed.extend(old[i1 + pairs:i2])
+            diff.added.extend(new[j1 + pairs:j2])
+    return diff
+
+
+def _anchor(paragraph):
+    return paragraph if len(paragraph) <= ANCHOR_CHARS else paragraph[:ANCHOR_CHARS] + "…"
+
+
+def build_incremental_prompt(diff):
+    """
+    把差异整理成紧凑的提示：修改后和新增的段落给出全文，原段落、删除和未修改的段落只给出开头几个字
+    上一版全文在对话历史中，模型据此理解上下文
+    """
+    lines = [
+        "这是上一版（见对话历史中最近一次提交）的修订版，下面只列出有变化的部分。",
+        "请只针对变化的部分给出反馈，必要时结合未修改的上下文。",
+    ]
+    if diff.modified:
+        lines.append("\n【修改的段落】")
+        for i, (old, new) in enumerate(diff.modified, 1):
+            lines.append(f"{i}. 原文以“{_anchor(old)}”开头的段落修改为：{new}")
+    if diff.added:
+        lines.append("\n【新增的段落】")
+        lines.extend(f"{i}. {p}" for i, p in enumerate(diff.added, 1))
+    if diff.removed:
+        lines.append("\n【删除的段落】")
+        lines.extend(f"{i}. {_anchor(p)}" for i, p in enumerate(diff.removed, 1))
+    if diff.unchanged:
+        lines.append(f"\n【未修改的段落】共 {len(diff.unchanged)} 段：" + "；".join(_anchor(p) for p in diff.unchanged))
+    return "\n".join(lines)
+
+
+def last_submission(conversation_history):
+    """对话历史中最近一次提交的草稿，没有时返回 None"""
+    for message in reversed(conversation_history or []):
+        if message["role"] == "user":
+            return message["content"]
+    return None
+
+
+def incremental_content(draft, conversation_history, full_pass_ratio=FULL_PASS_RATIO):
+    """
+    决定本轮发送给智能体的内容：与上一次提交的差异不大时发送差异提示，否则发送全文
+    :param draft: 本轮的草稿
+    :param conversation_history: 该智能体的对话历史（上一次提交的草稿从中取得）
+    :return: (content, stats)，stats 包含 mode（"full" 或 "diff"）、change_ratio 和两种方式的 token 估算
+    """
+    stats = {"mode": "full", "change_ratio": 1.0, "full_tokens": estimate_tokens(draft), "sent_tokens": 0}
+    previous = last_submission(conversation_history)
+    if previous is None or previous == draft:
+        stats["sent_tokens"] = stats["full_tokens"]
+        return draft, stats
+
+    diff = diff_drafts(previous, draft)
+    stats["change_ratio"] = round(diff.change_ratio, 3)
+    if diff.changed and len(diff.paragraphs) >= MIN_PARAGRAPHS and diff.change_ratio <= full_pass_ratio:
+        prompt = build_incremental_prompt(diff)
+        prompt_tokens = estimate_tokens(prompt)
+        if prompt_tokens < stats["full_tokens"]:
+            stats["mode"] = "diff"
+            stats["sent_tokens"] = prompt_tokens
+            return prompt, stats
+    stats["sent_tokens"] = stats["full_tokens"]
+    return draft, stats
+
+
+def compact_history(conversation_history):
+    """
+    把历史中被之后的修订版取代的旧草稿换成一句占位说明，避免模型收到多份几乎相同的全文
+    一份草稿与紧接着的下一次提交有足够多相同的段落时，视为被它取代；逐份比较，修改了很多轮的旧版也能识别。
+    最近一次提交的草稿保持原样（差异提示以它为基准）；与下一次提交不相似的草稿（另一篇文档）也保持原样
+    :return: 新的历史列表，原列表不变
+    """
+    history = list(conversation_history or [])
+    user_indexes = [i for i, m in enumerate(history) if m["role"] == "user"]
+    if len(user_indexes) < 2:
+        return history
+    paragraphs = [split_paragraphs(history[i]["content"]) for i in user_indexes]
+    for n, i in enumerate(user_indexes[:-1]):
+        following = set(paragraphs[n + 1])
+        if paragraphs[n] and sum(p in following for p in paragraphs[n]) / len(paragraphs[n]) >= SUPERSEDED_RATIO:
+            history[i] = {"role": "user", "content": SUPERSEDED_PLACEHOLDER}
+    return history
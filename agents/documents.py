@@ -0,0 +1,180 @@
+# agents/documents.py
+import io
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor
+
+# 页数达到该值才使用进程池，小文件在当前进程内解析更快
+PARALLEL_MIN_PAGES = 16
+
+# 共享进程池的大小
+POOL_WORKERS = min(4, os.cpu_count() or 1)
+
+# 每个工作进程分到的批次数，批次越多进度条越平滑
+BATCHES_PER_WORKER = 4
+
+# 按文件内容哈希缓存的提取结果数量
+_TEXT_CACHE_SIZE = 32
+_text_cache = OrderedDict()
+_text_cache_lock = threading.Lock()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_reader_class = None
+
+
+def _pdf_reader_class():
+    """
+    优先使用维护中的 pypdf，没有安装时退回 PyPDF2
+    第一次解析 PDF 时才导入，结果保存下来，没有 pypdf 时不会每次都重新查找
+    """
+    global _reader_class
+    if _reader_class is None:
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            from PyPDF2 import PdfReader
+        _reader_class = PdfReader
+    return _reader_class
+
+
+def _extract_page_range(path, start, stop):
+    """在工作进程中提取 [start, stop) 页的文本"""
+    reader = _pdf_reader_class()(path)
+    return [(reader.pages[i].extract_text() or "") for i in range(start, stop)]
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # multiprocessing 只在第一次需要进程池时导入
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # 使用 spawn 启动工作进程，避免在多线程的 Streamlit 服务器中 fork
+            _pool = ProcessPoolExecutor(
+                max_workers=POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def _discard_pool():
+    """丢弃已损坏的进程池，下次使用时重新创建"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def iter_pdf_pages(data, max_workers=None):
+    """
+    分批提取 PDF 文本，按页序逐批产出，便于显示进度
+    页数较多时在进程池中并行解析
+    :param data: PDF 文件内容（bytes）
+    :param max_workers: 用于划分批次的并行度，默认为共享进程池的大小
+    :return: 生成器，产出 (已完成页数, 总页数, 本批各页文本列表)
+    """
+    reader = _pdf_reader_class()(io.BytesIO(data))
+    total = len(reader.pages)
+    if total < PARALLEL_MIN_PAGES:
+        for i, page in enumerate(reader.pages, start=1):
+            yield i, total, [page.extract_text() or ""]
+        return
+
+    pool = _get_pool()
+    workers = max_workers or POOL_WORKERS
+    batch_size = max(1, -(-total // (workers * BATCHES_PER_WORKER)))
+
+    # 通过临时文件把 PDF 交给工作进程，避免每个批次都序列化一遍完整内容
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        futures = [
+            pool.submit(_extract_page_range, path, start, min(start + batch_size, total))
+            for start in range(0, total, batch_size)
+        ]
+        done = 0
+        for future in futures:
+            pages = future.result()
+            done += len(pages)
+            yield done, total, pages
+    finally:
+        os.remove(path)
+
+
+def extract_pdf_text(data, progress=None):
+    """
+    提取 PDF 全文
+    :param data: PDF 文件内容（bytes）
+    :param progress: 进度回调 progress(已完成页数, 总页数)（可选）
+    """
+    pages = []
+    try:
+        for done, total, batch in iter_pdf_pages(data):
+            pages.extend(batch)
+            if progress:
+                progress(done, total)
+    except (BrokenExecutor, OSError) as e:
+        # BrokenExecutor 是 BrokenProcessPool 的基类，捕获它不需要导入 concurrent.futures.process
+        if isinstance(e, BrokenExecutor):
+            _discard_pool()
+        if pages:
+            raise
+        # 进程池不可用（例如受限环境），退回当前进程顺序解析
+        print(f"Warning: PDF process pool unavailable, extracting in-process: {str(e)}")
+        reader = _pdf_reader_class()(io.BytesIO(data))
+        pages = [page.extract_text() or "" for page in reader.pages]
+    return "\n".join(pages)
+
+
+def read_pdf_file(path):
+    """
+    在当前进程中顺序提取一个 PDF 文件的全文
+    供批处理（batch_review.py）的进程池调用：每个工作进程解析一个文件，不再嵌套进程池
+    """
+    reader = _pdf_reader_class()(path)
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def get_cached_text(data):
+    """返回已经提取过的文本，没有缓存时返回 None"""
+    return _cache_lookup(hashlib.sha256(data).hexdigest())
+
+
+def _cache_lookup(key):
+    with _text_cache_lock:
+        if key in _text_cache:
+            _text_cache.move_to_end(key)
+            return _text_cache[key]
+    return None
+
+
+def extract_text(file_name, data, progress=None):
+    """
+    从上传文件中提取文本，结果按文件内容哈希缓存，重复调用不会重新解析
+    :param file_name: 文件名，用于判断类型（txt/md/pdf）
+    :param data: 文件内容（bytes）
+    :param progress: PDF 解析进度回调 progress(已完成页数, 总页数)（可选）
+    """
+    key = hashlib.sha256(data).hexdigest()
+    cached = _cache_lookup(key)
+    if cached is not None:
+        return cached
+
+    if file_name.lower().endswith('.pdf'):
+        text = extract_pdf_text(data, progress=progress)
+    else:
+        text = data.decode("utf-8")
+
+    with _text_cache_lock:
+        _text_cache[key] = text
+        while len(_text_cache) > _TEXT_CACHE_SIZE:
+            _text_cache.popitem(last=False)
+    return text
@@ -0,0 +1,151 @@
+# agents/history.py
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from .tokens import estimate_tokens, estimate_messages_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def _split_turns(conversation_history):
+    """把对话历史按轮次分组：每一轮从一条 user 消息开始"""
+    turns = []
+    for message in conversation_history:
+        if message.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _chain_digests(messages):
+    """逐条计算前缀摘要：第 i 个值对应 messages[:i + 1]"""
+    digests = []
+    h = hashlib.sha256()
+    for message in messages:
+        h.update(message.get("role", "").encode("utf-8"))
+        h.update(b"\x00")
+        h.update(message.get("content", "").encode("utf-8"))
+        h.update(b"\x01")
+        digests.append(h.copy().hexdigest())
+    return digests
+
+
+class HistoryManager:
+    """
+    按 token 预算压缩对话历史
+    - 最近的若干轮对话原样保留（滑动窗口）
+    - 更早的对话折叠成滚动摘要；摘要按前缀缓存，新增的折叠内容只做增量摘要
+    """
+
+    def __init__(self, token_budget=3000, keep_recent_turns=1, summary_max_chars=600, max_cached_summaries=128):
+        """
+        :param token_budget: 发送给模型的历史部分（含摘要）的 token 上限
+        :param keep_recent_turns: 至少原样保留的最近轮数
+        :param summary_max_chars: 本地兜底摘要的最大字符数
+        :param max_cached_summaries: 缓存的摘要条数上限
+        """
+        self.token_budget = token_budget
+        self.keep_recent_turns = keep_recent_turns
+        self.summary_max_chars = summary_max_chars
+        self.max_cached_summaries = max_cached_summaries
+        self.calls = 0
+        self.saved_tokens = 0
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prepare(self, conversation_history, summarizer=None):
+        """
+        返回压缩后的历史消息和统计信息
+        :param conversation_history: 完整的对话历史
+        :param summarizer: 摘要函数 summarizer(previous_summary, new_messages) -> str，
+                           为空或失败时使用本地截断摘要
+        :return: (messages, stats)，stats 包含 original_tokens/sent_tokens/saved_tokens/folded_turns
+        """
+        original_tokens = estimate_messages_tokens(conversation_history)
+        stats = {
+            "original_tokens": original_tokens,
+            "sent_tokens": original_tokens,
+            "saved_tokens": 0,
+            "folded_turns": 0,
+        }
+        if original_tokens <= self.token_budget:
+            self._record(stats)
+            return list(conversation_history), stats
+
+        turns = _split_turns(conversation_history)
+
+        # 摘要预留的空间，剩余部分从最新的一轮开始往前装
+        summary_reserve = estimate_tokens("字" * self.summary_max_chars) // 2
+        window_budget = max(0, self.token_budget - summary_reserve)
+        kept = 0
+        used = 0
+        for turn in reversed(turns):
+            cost = estimate_messages_tokens(turn)
+            if kept >= self.keep_recent_turns and used + cost > window_budget:
+                break
+            kept += 1
+            used += cost
+
+        recent_turns = turns[len(turns) - kept:]
+        folded = [m for turn in turns[:len(turns) - kept] for m in turn]
+        messages = [m for turn in recent_turns for m in turn]
+        if folded:
+            summary = self._summarize(folded, summarizer)
+            messages.insert(0, {"role": "system", "content": f"【早前对话摘要】\n{summary}"})
+
+        sent_tokens = estimate_messages_tokens(messages)
+        stats.update({
+            "sent_tokens": sent_tokens,
+            "saved_tokens": max(0, original_tokens - sent_tokens),
+            "folded_turns": len(turns) - kept,
+        })
+        self._record(stats)
+        return messages, stats
+
+    def _record(self, stats):
+        with self._lock:
+            self.calls += 1
+            self.saved_tokens += stats["saved_tokens"]
+        if stats["saved_tokens"]:
+            logger.info(
+                "history compressed: %d -> %d tokens (saved %d, folded %d turns)",
+                stats["original_tokens"], stats["sent_tokens"], stats["saved_tokens"], stats["folded_turns"]
+            )
+
+    def _summarize(self, folded, summarizer):
+        digests = _chain_digests(folded)
+
+        # 找到已缓存的最长前缀，只对之后新增的消息做增量摘要
+        previous_summary = ""
+        start = 0
+        with self._lock:
+            for i in range(len(digests) - 1, -1, -1):
+                if digests[i] in self._summaries:
+                    previous_summary = self._summaries[digests[i]]
+                    self._summaries.move_to_end(digests[i])
+                    start = i + 1
+                    break
+        if start == len(folded):
+            return previous_summary
+
+        new_messages = folded[start:]
+        if summarizer is not None:
+            try:
+                summary = summarizer(previous_summary, new_messages)
+                if summary:
+                    with self._lock:
+                        self._summaries[digests[-1]] = summary
+                        while len(self._summaries) > self.max_cached_summaries:
+                            self._summaries.popitem(last=False)
+                    return summary
+            except Exception as e:
+                logger.warning("history summarizer failed, using local summary: %s", e)
+
+        # 本地兜底摘要：逐条截取开头，不缓存，下次仍会尝试模型摘要
+        lines = [previous_summary] if previous_summary else []
+        for message in new_messages:
+            speaker = "用户" if message.get("role") == "user" else "助手"
+            lines.append(f"{speaker}: {message.get('content', '')[:80]}")
+        return "\n".join(lines)[-self.summary_max_chars:]
@@ -0,0 +1,217 @@
+# agents/live.py
+import time
+import hashlib
+import threading
+
+from .parallel import stream_parallel, DEFAULT_AGENT_TIMEOUT
+
+# 草稿停止变化多少秒后自动开始一轮点评
+DEFAULT_DEBOUNCE = 2.0
+
+# 草稿少于这么多字符时不自动点评
+MIN_DRAFT_CHARS = 20
+
+
+def normalize_draft(text):
+    """规范化草稿：去掉首尾空白并合并连续空白，只改动了空白的草稿视为没有变化"""
+    return " ".join((text or "").split())
+
+
+def input_signature(content, context_material=None, conversation_history=None):
+    """
+    一个智能体本轮输入的摘要：规范化后的草稿（或差异提示）、参考资料片段和对话历史
+    摘要相同说明该智能体的输入没有实质变化，上一轮的点评仍然有效
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    history = conversation_history or []
+    parts = [normalize_draft(content), context_material or "", str(len(history))]
+    if history:
+        parts.append(history[-1]["content"])
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class LiveReviewController:
+    """
+    实时点评：草稿停止变化 debounce 秒后自动让智能体点评，结果只用于预览，不写入对话历史
+    - 每轮有一个递增的编号，草稿再次变化或开始新一轮时，上一轮立即作废：
+      排队中的任务被取消，正在生成的流被关闭，迟到的分片直接丢弃
+    - 输入（草稿、参考资料、对话历史）没有实质变化的智能体沿用上一轮的点评，不重新请求
+    每个浏览器会话一个实例，后台线程写入结果，界面通过 snapshot() 读取
+    """
+
+    def __init__(self, agents, scheduler=None, session_id=None, debounce=DEFAULT_DEBOUNCE,
+                 timeout=DEFAULT_AGENT_TIMEOUT, min_chars=MIN_DRAFT_CHARS, clock=time.monotonic):
+        """
+        :param agents: {key: 智能体}
+        :param scheduler: 全局调度器（可选），提供时和普通提交一样排队、限速
+        :param session_id: 会话 ID，供调度器做公平调度
+        :param timeout: 每个智能体的超时时间（秒），可以是数字或 {key: 秒数} 的字典
+        :param clock: 时间函数，便于测试
+        """
+        self.agents = agents
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.debounce = debounce
+        self.timeout = timeout
+        self.min_chars = min_chars
+        self.generation = 0
+        self.draft = ""
+        self.changed_at = None
+        self.reviewed = None
+        self.replies = {}
+        self.rounds = 0
+        self.skipped = 0
+        self.cancelled = 0
+        self._clock = clock
+        self._signatures = {}
+        self._cancel = None
+        self._lock = threading.Lock()
+
+    def update(self, draft):
+        """
+        记录最新的草稿；内容有实质变化时重新开始计时，并作废正在进行的一轮
+        :return: 草稿是否有实质变化
+        """
+        with self._lock:
+            if normalize_draft(draft) == normalize_draft(self.draft):
+                return False
+            self.draft = draft
+            self.changed_at = self._clock()
+            self._cancel_round()
+            return True
+
+    def due(self):
+        """草稿已经稳定 debounce 秒，且还没有被点评过"""
+        with self._lock:
+            return self._due()
+
+    def _due(self):
+        normalized = normalize_draft(self.draft)
+        return (
+            self.changed_at is not None
+            and self._clock() - self.changed_at >= self.debounce
+            and len(normalized) >= self.min_chars
+            and normalized != self.reviewed
+        )
+
+    def poll(self, inputs, runner_for=None):
+        """
+        到期时开始新一轮点评，界面定时调用
+        :param inputs: 可调用对象 inputs(draft) -> {key: (发送的内容, 参考资料片段, 对话历史)}
+        :param runner_for: 可调用对象 runner_for(draft, key, content) -> 实际调用的对象，见 start()
+        :return: 是否开始了新一轮
+        """
+        with self._lock:
+            if not self._due():
+                return False
+            draft = self.draft
+        return self.start(draft, inputs(draft), runner_for=runner_for)
+
+    def start(self, draft, inputs, runner_for=None):
+        """
+        作废上一轮并开始新一轮，输入没有变化的智能体被跳过
+        :param inputs: {key: (发送的内容, 参考资料片段, 对话历史)}，发送的内容可以是全文或差异提示
+        :param runner_for: 可调用对象 runner_for(draft, key, content) -> 实际调用的对象（例如长文档的 MapReduceReviewer），
+                           应与正式提交使用相同的选择，这样长草稿也按章节分段审阅，缓存键与提交时一致；默认直接使用智能体
+        :return: 是否有智能体需要请求
+        """
+        with self._lock:
+            self._cancel_round()
+            self.generation += 1
+            generation = self.generation
+            self.reviewed = normalize_draft(draft)
+            jobs = {}
+            signatures = {}
+            for key, (content, context, history) in inputs.items():
+                signature = input_signature(content, context, history)
+                previous = self.replies.get(key)
+                if self._signatures.get(key) == signature and previous and previous["status"] == "done":
+                    self.skipped += 1
+                    continue
+                signatures[key] = signature
+                runner = runner_for(draft, key, content) if runner_for else self.agents[key]
+                jobs[key] = (lambda runner=runner, content=content, context=context, history=list(history or []):
+                             runner.stream(content, context_material=context, conversation_history=history))
+                self.replies[key] = {"content": "", "status": "pending", "position": None, "generation": generation}
+            if not jobs:
+                return False
+            self.rounds += 1
+            cancel = threading.Event()
+            self._cancel = cancel
+
+        threading.Thread(
+            target=self._run, args=(generation, jobs, signatures, cancel), name="live-review", daemon=True
+        ).start()
+        return True
+
+    def cancel(self):
+        """作废正在进行的一轮（例如用户手动提交或关闭实时点评时）"""
+        with self._lock:
+            self._cancel_round()
+
+    def _cancel_round(self):
+        # 调用方持有锁
+        if self._cancel is not None and not self._cancel.is_set():
+            self._cancel.set()
+            self.cancelled += 1
+            # 作废的一轮没有完成，同一份草稿之后仍需重新点评
+            self.reviewed = None
+            for reply in self.replies.values():
+                if reply["status"] in ("pending", "queued", "streaming"):
+                    reply["status"] = "cancelled"
+        self._cancel = None
+
+    def _run(self, generation, jobs, signatures, cancel):
+        """后台线程：消费本轮的流式输出，只接受本轮编号的结果"""
+        events = stream_parallel(jobs, timeout=self.timeout, scheduler=self.scheduler,
+                                 session_id=self.session_id, cancel=cancel)
+        try:
+            for event, key, payload in events:
+                with self._lock:
+                    if generation != self.generation or cancel.is_set():
+                        return
+                    reply = self.replies[key]
+                    if event == "queued":
+                        reply["status"] = "queued"
+                        reply["position"] = payload
+                    elif event == "delta":
+                        reply["status"] = "streaming"
+                        reply["content"] += payload
+                    elif event == "done":
+                        reply["status"] = "done"
+                        # 出错的回复不沿用，下一轮重新请求
+                        if not reply["content"].startswith("Error:"):
+                            self._signatures[key] = signatures[key]
+                    else:
+                        reply["status"] = "error"
+                        reply["content"] = f"Error: {payload}"
+                        self._signatures.pop(key, None)
+        finally:
+            events.close()
+            with self._lock:
+                if self._cancel is cancel:
+                    self._cancel = None
+
+    def snapshot(self):
+        """
+        当前状态的副本，供界面渲染
+        :return: {"generation", "waiting"（草稿还在防抖等待中）, "replies": {key: {...}}}
+        """
+        with self._lock:
+            waiting = (
+                self.changed_at is not None
+                and len(normalize_draft(self.draft)) >= self.min_chars
+                and normalize_draft(self.draft) != self.reviewed
+            )
+            return {
+                "generation": self.generation,
+                "waiting": waiting,
+                "replies": {key: dict(reply) for key, reply in self.replies.items()},
+            }
+
+    def stats(self):
+        with self._lock:
+            return {"rounds": self.rounds, "skipped": self.skipped, "cancelled": self.cancelled}
@@ -0,0 +1,211 @@
+# agents/mapreduce.py
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 草稿超过这么多字符时按章节分段审阅
+LONG_DRAFT_CHARS = 8000
+
+# 每个分段的目标长度（字符），分段只在标题和段落边界切开
+SECTION_CHARS = 3000
+
+# 分段少于这么多字符时并入相邻分段，避免出现只有一两句话的分段
+MIN_SECTION_CHARS = 800
+
+# 同一个智能体同时审阅的分段数
+MAP_WORKERS = 6
+
+# 两条意见的字符二元组相似度达到这个值时视为重复
+DUPLICATE_SIMILARITY = 0.7
+
+# Markdown 标题、"第X章/节"、"一、"、"1." / "1.1" 开头的短行视为章节标题
+_HEADING_RE = re.compile(
+    r'^(#{1,6}\s+\S.*|第[一二三四五六七八九十百\d]+[章节部分篇].*|[一二三四五六七八九十]+、.*|\d+(\.\d+)*[.、]\s*\S.*|\d+(\.\d+)+\s+\S.*)$'
+)
+_BULLET_RE = re.compile(r'^\s*([-*•]|\d+[.、)])\s*')
+
+
+def is_heading(line):
+    """不超过 50 个字符、不以句末标点结尾，且符合标题格式的行"""
+    line = line.strip()
+    return bool(line) and len(line) <= 50 and not line.endswith(("。", "！", "？", "；", ".")) \
+        and bool(_HEADING_RE.match(line))
+
+
+class Section:
+    """草稿中的一个分段：title 为所属章节的标题（没有标题时为空字符串）"""
+
+    __slots__ = ("index", "title", "text")
+
+    def __init__(self, index, title, text):
+        self.index = index
+        self.title = title
+        self.text = text
+
+    @property
+    def label(self):
+        return f"第{self.index + 1}部分" + (f"：{self.title}" if self.title else "")
+
+
+def _paragraphs_with_titles(text):
+    """按段落拆分，同时记录每个段落所属的章节标题；标题行单独成段"""
+    title = ""
+    blocks = []
+    for block in re.split(r'\n\s*\n', text.strip()):
+        lines = [line for line in block.split("\n") if line.strip()]
+        current = []
+        for line in lines:
+            if is_heading(line):
+                if current:
+                    blocks.append((title, "\n".join(current), False))
+                    current = []
+                title = line.strip().lstrip("#").strip()
+                blocks.append((title, line.strip(), True))
+            else:
+                current.append(line)
+        if current:
+            blocks.append((title, "\n".join(current), False))
+    return blocks
+
+
+def split_sections(text, section_chars=SECTION_CHARS, min_chars=MIN_SECTION_CHARS):
+    """
+    把长草稿切成连贯的分段
+    - 遇到章节标题时开始新的分段（上一段已经足够长时），同一章节尽量放在一起
+    - 分段超过 section_chars 时在段落边界切开；单个段落本身过长时单独成段，不从句子中间切断
+    - 过短的分段并入前一个分段
+    :return: Section 列表
+    """
+    pieces = []
+    current = []
+    current_title = ""
+    size = 0
+    for title, paragraph, heading in _paragraphs_with_titles(text):
+        starts_chapter = heading and size >= min_chars
+        if current and (starts_chapter or size + len(paragraph) > section_chars):
+            pieces.append((current_title, current))
+            current, size = [], 0
+        if not current:
+            current_title = title
+        current.append(paragraph)
+        size += len(paragraph)
+    if current:
+        pieces.append((current_title, current))
+
+    merged = []
+    for title, paragraphs in pieces:
+        if merged and sum(len(p) for p in paragraphs) < min_chars:
+            merged[-1][1].extend(paragraphs)
+        else:
+            merged.append((title, paragraphs))
+    return [Section(i, title, "\n\n".join(paragraphs)) for i, (title, paragraphs) in enumerate(merged)]
+
+
+def _bigrams(text):
+    text = re.sub(r'\s+', '', text)
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+class FindingDeduplicator:
+    """增量去重：逐条加入意见，和已经保留的意见字符二元组 Jaccard 相似度过高的丢弃"""
+
+    def __init__(self, threshold=DUPLICATE_SIMILARITY):
+        self.threshold = threshold
+        self.kept = []
+        self.dropped = 0
+
+    def add(self, finding):
+        """加入一条意见，重复时返回 False"""
+        key = _BULLET_RE.sub("", finding).strip()
+        if not key:
+            return False
+        grams = _bigrams(key)
+        for kept in self.kept:
+            if len(grams & kept) / len(grams | kept) >= self.threshold:
+                self.dropped += 1
+                return False
+        self.kept.append(grams)
+        return True
+
+
+class MapReduceReviewer:
+    """
+    长文档模式：把草稿切成分段，由同一个智能体并发审阅（map），再按分段顺序合并并去掉重复的意见（reduce）
+    接口与智能体的 process / stream 相同，可以直接替换；每个分段单独命中回复缓存，
+    只改了一个章节时其他章节不会重新请求。分段之间互相独立，不发送对话历史（否则每个分段都要重复一遍）
+    """
+
+    def __init__(self, agent, section_chars=SECTION_CHARS, max_workers=MAP_WORKERS, context_for=None):
+        """
+        :param agent: 审阅每个分段的智能体（ReviewerAgent / ResearcherAgent）
+        :param max_workers: 同时审阅的分段数上限
+        :param context_for: 可调用对象 context_for(分段文本) -> 参考资料片段（可选），
+                            提供时每个分段检索自己的参考资料，否则所有分段共用传入的 context_material
+        """
+        self.agent = agent
+        self.name = agent.name
+        self.section_chars = section_chars
+        self.max_workers = max_workers
+        self.context_for = context_for
+
+    def _section_prompt(self, section, total):
+        return (
+            f"以下是一篇长文档的{section.label}（共 {total} 部分），"
+            f"请只针对这一部分给出反馈，不要评价其他部分是否缺失。\n\n{section.text}"
+        )
+
+    def process(self, user_content, context_material=None, conversation_history=None):
+        return "".join(self.stream(user_content, context_material, conversation_history))
+
+    def stream(self, user_content, context_material=None, conversation_history=None):
+        """
+        并发审阅各分段，按分段顺序产出合并后的意见：前面的分段完成后立即产出，不必等全部完成
+        所有分段都失败时产出第一个 "Error: ..."
+        """
+        sections = split_sections(user_content, self.section_chars)
+        if len(sections) <= 1:
+            yield from self.agent.stream(user_content, context_material=context_material,
+                                         conversation_history=conversation_history)
+            return
+
+        results = {}
+        ready = threading.Condition()
+
+        def review(section):
+            context = self.context_for(section.text) if self.context_for else context_material
+            try:
+                text = self.agent.process(self._section_prompt(section, len(sections)), context_material=context)
+            except Exception as e:
+                text = f"Error: {str(e)}"
+            with ready:
+                results[section.index] = text
+                ready.notify_all()
+
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(sections)),
+                                      thread_name_prefix="map-section")
+        try:
+            for section in sections:
+                executor.submit(review, section)
+
+            deduplicator = FindingDeduplicator()
+            errors = []
+            produced = False
+            for section in sections:
+                with ready:
+                    while section.index not in results:
+                        ready.wait()
+                    text = results[section.index]
+                if text.startswith("Error:"):
+                    errors.append(text)
+                    continue
+                findings = [line for line in text.splitlines() if line.strip() and deduplicator.add(line)]
+                if findings:
+                    yield ("\n\n" if produced else "") + f"**{section.label}**\n" + "\n".join(findings)
+                    produced = True
+            if not produced and errors:
+                yield errors[0]
+            elif errors:
+                yield f"\n\n（{len(errors)} 个部分审阅失败：{errors[0]}）"
+        finally:
+            # 调用方提前放弃时不再开始新的分段
+            executor.shutdown(wait=False, cancel_futures=True)
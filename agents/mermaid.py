@@ -0,0 +1,329 @@
+# agents/mermaid.py
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 支持的流程图方向
+FLOWCHART_DIRECTIONS = ("TD", "TB", "BT", "LR", "RL")
+
+# 节点形状的起止符号，按起始符号长度从长到短匹配
+_NODE_SHAPES = (
+    ("(((", ")))"), ("([", "])"), ("[[", "]]"), ("[(", ")]"), ("((", "))"), ("{{", "}}"),
+    ("[/", "/]"), ("[\\", "\\]"),
+    ("[", "]"), ("(", ")"), ("{", "}"), (">", "]"),
+)
+_BRACKETS = set("[](){}")
+
+_FENCE_RE = re.compile(r'```(?:mermaid)?\s*\n?(.*?)```', re.S)
+_HEADER_RE = re.compile(r'^(graph|flowchart)(?:\s+(\w+))?\s*;?$')
+_ID_RE = re.compile(r'\w+')
+_CLASS_SUFFIX_RE = re.compile(r':::\w+')
+# 连线：-->、---、-.->、==>、--o、--x、<-->，可带 |文字|（竖线前可以有空格）；
+# 以及 "-- 文字 -->"、"-- 文字 ---"、"-. 文字 .->"、"== 文字 ==>" 形式
+_ARROW_RE = re.compile(
+    r'<?(?:-{2,}>|-{3,}|-\.+->|-\.+-|={2,}>|={3,}|--[ox]|<-->)(?:\s*\|[^|\n]*\|)?'
+    r'|--\s+[^-|>\s][^\n]*?\s+(?:-{2,}>|-{3,}|--[ox])'
+    r'|-\.\s+[^.\s][^\n]*?\s+\.+->?'
+    r'|==\s+[^=>\s][^\n]*?\s+(?:={2,}>|={3,})'
+)
+_STATEMENT_KEYWORDS = ("classDef ", "class ", "style ", "linkStyle ", "click ", "direction ")
+_SINGLE_ARROW_RE = re.compile(r'(?<![-=.<>])->|→')
+# 标签：引号、|连线文字| 和节点形状括号中的内容，规范化箭头时跳过
+_LABEL_SPAN_RE = re.compile(r'"[^"\n]*"|\|[^|\n]*\||\[[^\]\n]*\]|\([^)\n]*\)|\{[^}\n]*\}')
+_SQUARE_LABEL_RE = re.compile(r'(\w)\[([^\[\]"\n]*[(){}][^\[\]"\n]*)\]')
+
+
+def _normalize_arrows(line):
+    """把 "->"、"→" 改为 "-->"，标签中的文字保持不变"""
+    parts = []
+    pos = 0
+    for match in _LABEL_SPAN_RE.finditer(line):
+        parts.append(_SINGLE_ARROW_RE.sub("-->", line[pos:match.start()]))
+        parts.append(match.group())
+        pos = match.end()
+    parts.append(_SINGLE_ARROW_RE.sub("-->", line[pos:]))
+    return "".join(parts)
+
+
+def _quote_label(match):
+    label = match.group(2)
+    # "[(...)]" 是圆柱形节点，不是带括号的标签
+    if label.startswith("(") and label.endswith(")"):
+        return match.group(0)
+    return f'{match.group(1)}["{label}"]'
+
+
+class MermaidError(ValueError):
+    """Mermaid 代码不合法；line 为出错的行号（从 1 开始，0 表示整体问题）"""
+
+    def __init__(self, message, line=0):
+        super().__init__(f"第 {line} 行：{message}" if line else message)
+        self.line = line
+
+
+def strip_fences(text):
+    """去掉 ```mermaid 代码块标记；模型在代码块前后加了说明文字时只取代码块内的内容"""
+    text = text or ""
+    match = _FENCE_RE.search(text)
+    if match:
+        return match.group(1)
+    return text.replace("```mermaid", "").replace("```", "")
+
+
+def normalize(code):
+    """
+    规范化 Mermaid 代码（不改变图的含义）
+    - 去掉代码块标记和图表类型声明之前的说明文字，制表符换成 4 个空格，去掉行尾空白和空行
+    - 流程图中的 "->"、"→" 改为 "-->"，方括号标签中含圆括号/花括号时加上引号（否则会被当成节点形状）
+    """
+    lines = []
+    for line in strip_fences(code).replace("\r\n", "\n").split("\n"):
+        line = line.replace("\t", "    ").rstrip()
+        if line.strip():
+            lines.append(line)
+    # 模型在代码前面加了说明文字时，从图表类型声明所在的行开始
+    for i, line in enumerate(lines):
+        if line.strip() == "mindmap" or _HEADER_RE.match(line.strip()):
+            lines = lines[i:]
+            break
+    # 去掉公共缩进
+    indent = min((len(line) - len(line.lstrip()) for line in lines), default=0)
+    lines = [line[indent:] for line in lines]
+    if lines and _HEADER_RE.match(lines[0].strip()):
+        body = []
+        for line in lines[1:]:
+            if not line.strip().startswith("%%"):
+                line = _normalize_arrows(line)
+                line = _SQUARE_LABEL_RE.sub(_quote_label, line)
+            body.append(line)
+        lines = [lines[0].strip()] + body
+    return "\n".join(lines)
+
+
+def _parse_node(line, pos, lineno):
+    """解析一个节点（ID 加可选的形状和标签），返回结束位置"""
+    match = _ID_RE.match(line, pos)
+    if not match:
+        raise MermaidError(f"应为节点，实际为 '{line[pos:pos + 10]}'", lineno)
+    pos = match.end()
+    for start, end in _NODE_SHAPES:
+        if line.startswith(start, pos):
+            pos += len(start)
+            if line.startswith('"', pos):
+                close_quote = line.find('"', pos + 1)
+                if close_quote < 0:
+                    raise MermaidError("节点标签的引号没有闭合", lineno)
+                pos = close_quote + 1
+                if not line.startswith(end, pos):
+                    raise MermaidError(f"节点 {match.group()} 的标签缺少结束符号 '{end}'", lineno)
+            else:
+                close = line.find(end, pos)
+                if close < 0:
+                    raise MermaidError(f"节点 {match.group()} 的标签缺少结束符号 '{end}'", lineno)
+                label = line[pos:close]
+                if _BRACKETS & set(label):
+                    raise MermaidError(f"节点 {match.group()} 的标签中有未加引号的括号：{label}", lineno)
+                pos = close
+            pos += len(end)
+            break
+    suffix = _CLASS_SUFFIX_RE.match(line, pos)
+    return suffix.end() if suffix else pos
+
+
+def _parse_node_group(line, pos, lineno):
+    """解析 "A & B" 形式的一组节点"""
+    pos = _parse_node(line, pos, lineno)
+    while True:
+        rest = line[pos:].lstrip()
+        if not rest.startswith("&"):
+            return pos
+        after = rest[1:].lstrip()
+        pos = _parse_node(line, len(line) - len(after), lineno)
+
+
+def _validate_flowchart(lines):
+    depth = 0
+    statements = 0
+    for lineno, line in lines:
+        stripped = line.strip().rstrip(";")
+        if not stripped or stripped.startswith("%%"):
+            continue
+        if stripped == "end":
+            if depth == 0:
+                raise MermaidError("多余的 end（没有对应的 subgraph）", lineno)
+            depth -= 1
+            continue
+        if stripped.startswith("subgraph"):
+            depth += 1
+            continue
+        if stripped.startswith(_STATEMENT_KEYWORDS):
+            continue
+        pos = _parse_node_group(stripped, 0, lineno)
+        while pos < len(stripped):
+            rest = stripped[pos:].lstrip()
+            if not rest:
+                break
+            arrow = _ARROW_RE.match(rest)
+            if not arrow:
+                raise MermaidError(f"无法识别的连线：'{rest[:10]}'", lineno)
+            pos = len(stripped) - len(rest) + arrow.end()
+            rest = stripped[pos:].lstrip()
+            if not rest:
+                raise MermaidError("连线缺少目标节点", lineno)
+            pos = _parse_node_group(stripped, len(stripped) - len(rest), lineno)
+        statements += 1
+    if depth:
+        raise MermaidError(f"有 {depth} 个 subgraph 没有对应的 end")
+    if not statements:
+        raise MermaidError("流程图中没有任何节点")
+
+
+def _validate_mindmap(lines):
+    if not lines:
+        raise MermaidError("思维导图中没有任何节点")
+    root_indent = len(lines[0][1]) - len(lines[0][1].lstrip())
+    for lineno, line in lines:
+        text = line.strip()
+        if text.startswith("%%") or text.startswith("::icon"):
+            continue
+        if lineno != lines[0][0] and len(line) - len(line.lstrip()) <= root_indent:
+            raise MermaidError("思维导图只能有一个根节点，其余节点必须比根节点缩进更多", lineno)
+        depth = 0
+        for char in text:
+            if char in "([{":
+                depth += 1
+            elif char in ")]}":
+                depth -= 1
+            if depth < 0:
+                break
+        # 云朵 ")text(" 和爆炸 "))text((" 形状的括号方向相反
+        if depth != 0 and not re.match(r'^\w*\){1,2}.*\({1,2}$', text):
+            raise MermaidError(f"节点的括号不匹配：{text}", lineno)
+
+
+def validate(code):
+    """
+    规范化并校验 Mermaid 代码，支持 flowchart（graph）和 mindmap
+    :return: 规范化后的代码
+    :raises MermaidError: 代码不合法，消息中包含出错的行号和原因
+    """
+    code = normalize(code)
+    lines = code.split("\n")
+    if not code:
+        raise MermaidError("代码为空")
+    header = lines[0].strip()
+    body = list(enumerate(lines[1:], 2))
+    if header == "mindmap":
+        _validate_mindmap(body)
+        return code
+    match = _HEADER_RE.match(header)
+    if not match:
+        raise MermaidError(f"第一行应为 'graph TD'、'flowchart LR' 或 'mindmap'，实际为 '{header[:30]}'", 1)
+    if match.group(2) and match.group(2) not in FLOWCHART_DIRECTIONS:
+        raise MermaidError(f"未知的方向 '{match.group(2)}'，应为 {'/'.join(FLOWCHART_DIRECTIONS)}", 1)
+    _validate_flowchart(body)
+    return code
+
+
+class DiagramCache:
+    """
+    已校验图表的缓存：按草稿（合并空白后）的哈希保存，同一份草稿再次请求时不再调用模型、也不再校验
+    有界 LRU，线程安全
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(draft):
+        normalized = " ".join((draft or "").split())
+        return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, draft):
+        key = self.make_key(draft)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, draft, code):
+        key = self.make_key(draft)
+        with self._lock:
+            self._entries[key] = code
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+_diagram_cache = None
+_diagram_cache_lock = threading.Lock()
+
+
+def get_diagram_cache():
+    """进程级共享的图表缓存"""
+    global _diagram_cache
+    with _diagram_cache_lock:
+        if _diagram_cache is None:
+            _diagram_cache = DiagramCache()
+        return _diagram_cache
+
+
+# 回归样例：(代码, 规范化后的代码)，不合法的代码对应 None；python -m agents.mermaid 逐个检查
+EXAMPLES = (
+    ("graph TD\n    A --> B", "graph TD\n    A --> B"),
+    ("graph TD\n    A -->|是| B", "graph TD\n    A -->|是| B"),
+    ("graph TD\n    A --> |是| B", "graph TD\n    A --> |是| B"),
+    ("graph TD\n    A -- 文字 --> B", "graph TD\n    A -- 文字 --> B"),
+    ("graph TD\n    A -- 文字 --- B", "graph TD\n    A -- 文字 --- B"),
+    ("graph TD\n    A -. 可选 .-> B", "graph TD\n    A -. 可选 .-> B"),
+    ("graph TD\n    A == 重要 ==> B", "graph TD\n    A == 重要 ==> B"),
+    ("graph TD\n    A[开始] --> B{判断} -- 是 --> C", "graph TD\n    A[开始] --> B{判断} -- 是 --> C"),
+    ("graph LR\n    A -> B", "graph LR\n    A --> B"),
+    ("graph LR\n    A[输入->输出] -> B", "graph LR\n    A[输入->输出] --> B"),
+    ("graph LR\n    A -->|a->b| B", "graph LR\n    A -->|a->b| B"),
+    ("graph LR\n    A[\"x → y\"] → B", "graph LR\n    A[\"x → y\"] --> B"),
+    ("graph TD\n    A -- B", None),
+    ("graph TD\n    A -->", None),
+    ("graph TD\n    A ~~ B", None),
+    ("mindmap\n    root((主题))\n        分支", "mindmap\n    root((主题))\n        分支"),
+)
+
+
+def self_check():
+    """
+    检查回归样例
+    :return: 不符合预期的样例列表 [(代码, 预期, 实际)]
+    """
+    failures = []
+    for code, expected in EXAMPLES:
+        try:
+            actual = validate(code)
+        except MermaidError as e:
+            actual = None if expected is None else str(e)
+        if actual != expected:
+            failures.append((code, expected, actual))
+    return failures
+
+
+if __name__ == "__main__":
+    failed = self_check()
+    for code, expected, actual in failed:
+        print(f"FAIL {code!r}: expected {expected!r}, got {actual!r}")
+    print(f"{len(EXAMPLES) - len(failed)}/{len(EXAMPLES)} mermaid examples passed")
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,305 @@
+# agents/metrics.py
+import json
+import time
+import threading
+from collections import deque, defaultdict
+
+# 各模型的参考价格（元 / 千 tokens）：(输入, 输出)，用于估算成本
+MODEL_PRICES = {
+    "qwen-turbo": (0.0003, 0.0006),
+    "qwen-plus": (0.0008, 0.002),
+    "qwen-max": (0.0024, 0.0096),
+    "qwen-long": (0.0005, 0.002),
+}
+
+# 延迟直方图的分桶边界（秒）
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 首字节时间直方图的分桶边界（秒）
+TTFB_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class CallRecord:
+    """一次智能体调用的度量数据"""
+
+    __slots__ = (
+        "agent", "name", "model", "backend", "streamed", "started_at", "ttfb", "latency",
+        "prompt_tokens", "completion_tokens", "retries", "cache_hit", "similarity", "history_saved_tokens",
+        "route", "estimated_tokens", "trimmed_tokens", "error", "status_code", "_t0",
+    )
+
+    def __init__(self, agent, name, model, backend, streamed=False):
+        self.agent = agent
+        self.name = name
+        self.model = model
+        self.backend = backend
+        self.streamed = streamed
+        self.started_at = time.time()
+        self.ttfb = None
+        self.latency = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+        self.cache_hit = False
+        # 由近似缓存返回时为草稿与缓存草稿的相似度（见 agents/similarity.py），否则为 None
+        self.similarity = None
+        self.history_saved_tokens = 0
+        # 路由结果（见 agents/routing.py）：选中的档位、发送前估算的提示 token 数、截掉的参考资料 token 数
+        self.route = None
+        self.estimated_tokens = None
+        self.trimmed_tokens = 0
+        self.error = None
+        self.status_code = None
+        self._t0 = time.perf_counter()
+
+    def first_byte(self):
+        """记录首字节时间（只记录第一次）"""
+        if self.ttfb is None:
+            self.ttfb = time.perf_counter() - self._t0
+
+    def add_usage(self, usage):
+        if usage:
+            self.prompt_tokens += usage.get("prompt_tokens", 0)
+            self.completion_tokens += usage.get("completion_tokens", 0)
+
+    def finish(self):
+        self.latency = time.perf_counter() - self._t0
+        if self.ttfb is None and self.error is None:
+            self.ttfb = self.latency
+        return self
+
+    @property
+    def cost(self):
+        """按参考价格估算的成本（元）"""
+        input_price, output_price = MODEL_PRICES.get(self.model, (0.0, 0.0))
+        return (self.prompt_tokens * input_price + self.completion_tokens * output_price) / 1000
+
+    def to_dict(self):
+        return {
+            "agent": self.agent,
+            "name": self.name,
+            "model": self.model,
+            "backend": self.backend,
+            "streamed": self.streamed,
+            "started_at": round(self.started_at, 3),
+            "ttfb_ms": None if self.ttfb is None else round(self.ttfb * 1000, 1),
+            "latency_ms": None if self.latency is None else round(self.latency * 1000, 1),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost_yuan": round(self.cost, 6),
+            "retries": self.retries,
+            "cache_hit": self.cache_hit,
+            "similarity": self.similarity,
+            "history_saved_tokens": self.history_saved_tokens,
+            "route": self.route,
+            "estimated_tokens": self.estimated_tokens,
+            "trimmed_tokens": self.trimmed_tokens,
+            "error": self.error,
+            "status_code": self.status_code,
+        }
+
+
+class _Series:
+    """按 (agent, model) 聚合的累计指标"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.similar_hits = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.latency_sum = 0.0
+        self.ttfb_sum = 0.0
+        self.ttfb_count = 0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.ttfb_buckets = [0] * len(TTFB_BUCKETS)
+
+
+class MetricsRegistry:
+    """
+    进程级的调用度量登记表
+    保留最近 max_records 条明细（用于 JSONL 导出和分位数），同时维护不受淘汰影响的累计计数
+    """
+
+    def __init__(self, max_records=5000):
+        self._records = deque(maxlen=max_records)
+        self._series = defaultdict(_Series)
+        self._lock = threading.Lock()
+
+    def record(self, call):
+        """登记一次已结束的调用"""
+        with self._lock:
+            self._records.append(call)
+            series = self._series[(call.agent, call.model)]
+            series.calls += 1
+            series.errors += 1 if call.error else 0
+            series.cache_hits += 1 if call.cache_hit else 0
+            series.similar_hits += 1 if call.similarity is not None else 0
+            series.retries += call.retries
+            series.prompt_tokens += call.prompt_tokens
+            series.completion_tokens += call.completion_tokens
+            series.cost += call.cost
+            series.latency_sum += call.latency or 0.0
+            if call.ttfb is not None:
+                series.ttfb_sum += call.ttfb
+                series.ttfb_count += 1
+                for i, bound in enumerate(TTFB_BUCKETS):
+                    if call.ttfb <= bound:
+                        series.ttfb_buckets[i] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if (call.latency or 0.0) <= bound:
+                    series.latency_buckets[i] += 1
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def reset(self):
+        with self._lock:
+            self._records.clear()
+            self._series.clear()
+
+    def summary(self):
+        """
+        按智能体汇总最近的调用，供界面展示
+        :return: [{"agent", "calls", "errors", "cache_hits", "p50_ms", "p95_ms", "ttfb_p50_ms", ...}, ...]
+        """
+        grouped = defaultdict(list)
+        for call in self.records():
+            grouped[call.agent].append(call)
+
+        def pct(values, p):
+            if not values:
+                return None
+            values = sorted(values)
+            return round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 1)
+
+        rows = []
+        for agent, calls in sorted(grouped.items()):
+            latencies = [c.latency for c in calls if c.latency is not None and not c.cache_hit]
+            ttfbs = [c.ttfb for c in calls if c.ttfb is not None and not c.cache_hit]
+            rows.append({
+                "agent": agent,
+                "calls": len(calls),
+                "errors": sum(1 for c in calls if c.error),
+                "cache_hits": sum(1 for c in calls if c.cache_hit),
+                "similar_hits": sum(1 for c in calls if c.similarity is not None),
+                "retries": sum(c.retries for c in calls),
+                "ttfb_p50_ms": pct(ttfbs, 50),
+                "p50_ms": pct(latencies, 50),
+                "p95_ms": pct(latencies, 95),
+                "prompt_tokens": sum(c.prompt_tokens for c in calls),
+                "completion_tokens": sum(c.completion_tokens for c in calls),
+                "cost_yuan": round(sum(c.cost for c in calls), 4),
+            })
+        return rows
+
+    def to_jsonl(self):
+        """导出最近的调用明细，每行一个 JSON 对象"""
+        return "".join(json.dumps(c.to_dict(), ensure_ascii=False) + "\n" for c in self.records())
+
+    def to_prometheus(self):
+        """导出 Prometheus 文本格式的累计指标"""
+        with self._lock:
+            items = sorted(self._series.items())
+            lines = []
+
+            def metric(name, kind, help_text, values):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in values:
+                    lines.append(f"{name}{{{labels}}} {value}")
+
+            def labels(key, extra=""):
+                agent, model = key
+                return f'agent="{agent}",model="{model}"' + extra
+
+            metric("agent_calls_total", "counter", "Agent calls.",
+                   [(labels(k), s.calls) for k, s in items])
+            metric("agent_errors_total", "counter", "Agent calls that returned an error.",
+                   [(labels(k), s.errors) for k, s in items])
+            metric("agent_cache_hits_total", "counter", "Agent calls served from the response cache.",
+                   [(labels(k), s.cache_hits) for k, s in items])
+            metric("agent_similar_hits_total", "counter", "Agent calls served from the near-duplicate draft cache.",
+                   [(labels(k), s.similar_hits) for k, s in items])
+            metric("agent_retries_total", "counter", "Retried backend requests.",
+                   [(labels(k), s.retries) for k, s in items])
+            metric("agent_prompt_tokens_total", "counter", "Prompt tokens reported by the backend.",
+                   [(labels(k), s.prompt_tokens) for k, s in items])
+            metric("agent_completion_tokens_total", "counter", "Completion tokens reported by the backend.",
+                   [(labels(k), s.completion_tokens) for k, s in items])
+            metric("agent_cost_yuan_total", "counter", "Estimated cost in CNY.",
+                   [(labels(k), round(s.cost, 6)) for k, s in items])
+            def histogram(name, help_text, bucket_bounds, values):
+                """values: [(key, 各分桶的累计数, 总和, 总数), ...]"""
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                bounds = [str(b) for b in bucket_bounds] + ["+Inf"]
+                for key, buckets, total, count in values:
+                    for bound, bucket_count in zip(bounds, buckets + [count]):
+                        bucket_labels = labels(key, ',le="' + bound + '"')
+                        lines.append(f"{name}_bucket{{{bucket_labels}}} {bucket_count}")
+                    lines.append(f"{name}_sum{{{labels(key)}}} {round(total, 6)}")
+                    lines.append(f"{name}_count{{{labels(key)}}} {count}")
+
+            histogram("agent_ttfb_seconds", "Agent call time to first byte.", TTFB_BUCKETS,
+                      [(k, s.ttfb_buckets, s.ttfb_sum, s.ttfb_count) for k, s in items])
+            histogram("agent_latency_seconds", "Total agent call latency.", LATENCY_BUCKETS,
+                      [(k, s.latency_buckets, s.latency_sum, s.calls) for k, s in items])
+            return "\n".join(lines) + "\n"
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry():
+    """进程级共享的度量登记表"""
+    return _registry
+
+
+def _metrics_handler_class():
+    """/metrics 和 /calls.jsonl 的请求处理类；http.server 只在打开度量端点时才导入，不增加应用的启动时间"""
+    from http.server import BaseHTTPRequestHandler
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.startswith("/metrics"):
+                body, content_type = _registry.to_prometheus(), "text/plain; version=0.0.4"
+            elif self.path.startswith("/calls.jsonl"):
+                body, content_type = _registry.to_jsonl(), "application/x-ndjson"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return _MetricsHandler
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    """
+    在后台线程中启动 /metrics（Prometheus）和 /calls.jsonl 端点，同一进程只启动一次
+    :param host: 监听地址，默认只接受本机访问（调用明细中有各会话的用量）；需要从其他机器抓取时显式传入 "0.0.0.0"
+    """
+    global _server
+    with _server_lock:
+        if _server is None:
+            from http.server import ThreadingHTTPServer
+            _server = ThreadingHTTPServer((host, port), _metrics_handler_class())
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return _server
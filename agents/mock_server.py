@@ -0,0 +1,191 @@
+# agents/mock_server.py
+"""
+本地 OpenAI 兼容模拟服务器，用于在没有网络的情况下测量性能
+
+用法：
+    python -m agents.mock_server --port 8765 --latency 0.8 --jitter 0.2 --failure-rate 0.05
+然后设置 LLM_BACKEND=mock（或 MOCK_LLM_URL=http://127.0.0.1:8765/v1）运行应用
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .tokens import estimate_tokens, estimate_messages_tokens
+from .backends import mock_reply
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 支持长连接，便于测量连接复用的效果
+    protocol_version = "HTTP/1.1"
+    # 关闭 Nagle 算法，避免响应头和响应体分两次发送时产生额外延迟
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        with server.stats_lock:
+            server.requests += 1
+        time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+
+        if random.random() < server.failure_rate:
+            with server.stats_lock:
+                server.failures += 1
+            status = random.choice(server.failure_statuses)
+            self._send_json(status, {"error": {"message": f"mock failure ({status})", "type": "mock_error"}})
+            return
+
+        messages = body.get("messages", [])
+        model = body.get("model", "mock")
+        text = mock_reply(messages)
+        usage = {
+            "prompt_tokens": estimate_messages_tokens(messages),
+            "completion_tokens": estimate_tokens(text),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if body.get("stream"):
+            self._send_stream(model, text, usage, (body.get("stream_options") or {}).get("include_usage"))
+        else:
+            self._send_json(200, {
+                "id": "mock-completion",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, model, text, usage, include_usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(delta, finish_reason=None):
+            return json.dumps({
+                "id": "mock-completion",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }, ensure_ascii=False)
+
+        step = self.server.chunk_size
+        for start in range(0, len(text), step):
+            event(chunk({"content": text[start:start + step]}))
+            time.sleep(self.server.chunk_delay)
+        event(chunk({}, "stop"))
+        if include_usage:
+            event(json.dumps({
+                "id": "mock-completion",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            }))
+        event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """
+    可配置延迟和失败率的 OpenAI 兼容模拟服务器
+    :param latency: 首字节前的平均延迟（秒）
+    :param jitter: 延迟的随机抖动范围（秒）
+    :param failure_rate: 请求失败的概率（0~1）
+    :param failure_statuses: 失败时随机返回的状态码
+    :param chunk_size: 流式输出时每个分片的字符数
+    :param chunk_delay: 流式输出时分片之间的间隔（秒）
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=8765, latency=0.5, jitter=0.0, failure_rate=0.0,
+                 failure_statuses=(429, 500, 503), chunk_size=4, chunk_delay=0.01):
+        super().__init__((host, port), _MockHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_statuses = list(failure_statuses)
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.requests = 0
+        self.failures = 0
+        self.stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """在后台线程中启动服务器，返回 base_url"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容模拟服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="平均延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟抖动（秒）")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="失败概率（0~1）")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="流式分片间隔（秒）")
+    args = parser.parse_args()
+
+    server = MockLLMServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        chunk_delay=args.chunk_delay
+    )
+    print(f"Mock LLM server listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+# agents/orchestrator.py
+import re
+import json
+import threading
+
+from .history import HistoryManager
+from .mermaid import validate, strip_fences, MermaidError
+from .metrics import CallRecord
+from .parallel import Fallback
+
+# 合并模式默认包含的角色
+COMBINED_KEYS = ("mark", "amy", "susu")
+
+# 合并请求中对话历史的 token 预算（三个角色共用一份历史）
+COMBINED_HISTORY_BUDGET = 4000
+
+# 整段 JSON 解析失败时逐个键提取字符串值
+_SECTION_RE = r'"{key}"\s*:\s*"((?:[^"\\]|\\.)*)"'
+
+
+def parse_sections(text, keys):
+    """
+    从合并请求的输出中取出各角色的回复
+    先按完整的 JSON 对象解析；输出被截断或夹杂了其他文字导致整体解析失败时，逐个键提取还完整的部分
+    :return: {key: 回复}，只包含解析成功且不为空的部分
+    """
+    text = strip_fences(text or "").strip()
+    start, end = text.find("{"), text.rfind("}")
+    data = None
+    if start != -1 and end > start:
+        try:
+            data = json.loads(text[start:end + 1])
+        except ValueError:
+            data = None
+    sections = {}
+    for key in keys:
+        if isinstance(data, dict):
+            value = data.get(key)
+        else:
+            match = re.search(_SECTION_RE.format(key=re.escape(key)), text)
+            try:
+                value = json.loads(f'"{match.group(1)}"') if match else None
+            except ValueError:
+                value = None
+        if isinstance(value, str) and value.strip():
+            sections[key] = value.strip()
+    return sections
+
+
+def merge_histories(histories, keys):
+    """
+    把各角色的对话历史按轮次对齐合并成一份：每轮的用户草稿只保留一份，各角色的回复合并成一条 JSON 回复
+    各角色的轮数不同时（例如某一轮有人出错没有记录）从最近一轮往前对齐，只保留共同的轮次
+    """
+    turns = {}
+    for key in keys:
+        grouped = []
+        for message in histories.get(key) or []:
+            if message["role"] == "user" or not grouped:
+                grouped.append([])
+            grouped[-1].append(message)
+        turns[key] = grouped
+    count = min(len(grouped) for grouped in turns.values()) if turns else 0
+    merged = []
+    for back in range(count, 0, -1):
+        lead = turns[keys[0]][-back]
+        merged.append({
+            "role": "user",
+            "content": "\n".join(m["content"] for m in lead if m["role"] == "user"),
+        })
+        replies = {
+            key: "\n".join(m["content"] for m in turns[key][-back] if m["role"] == "assistant")
+            for key in keys
+        }
+        merged.append({"role": "assistant", "content": json.dumps(replies, ensure_ascii=False)})
+    return merged
+
+
+class CombinedReviewer:
+    """
+    合并模式：一次模型调用同时得到多个角色（默认马克、艾米、苏苏）的回复
+    - 草稿、参考资料和对话历史只发送一次，各角色的系统提示词合并成一条，要求模型输出每个角色一个键的 JSON；
+      分开调用时这些内容要发送三遍，输入 token 和预填充时间也付三遍
+    - 发出合并请求前先查各智能体自己的缓存（回复缓存、近似缓存、苏苏的图表缓存），命中的角色不参与合并；
+      合并结果中可用的部分按各智能体的缓存键写回，下次分开调用或合并调用都能命中
+    - 解析失败或不合格的部分（例如苏苏的图表没有通过校验）改为单独调用该智能体
+    - 模型按第一个角色（马克）的路由策略选择
+    进程内共享，可以被多个会话同时使用
+    """
+
+    def __init__(self, agents, keys=COMBINED_KEYS, history_manager=None, backend=None, metrics=None):
+        """
+        :param agents: {key: 智能体}
+        :param keys: 合并的角色
+        :param history_manager: 合并后历史的压缩（可选），默认按 COMBINED_HISTORY_BUDGET 压缩
+        :param backend: 模型后端，默认使用第一个角色的后端
+        :param metrics: 调用度量登记表，默认使用第一个角色的登记表
+        """
+        self.agents = agents
+        self.keys = tuple(keys)
+        lead = agents[self.keys[0]]
+        self.backend = backend or lead.backend
+        self.metrics = metrics or lead.metrics
+        self.history_manager = history_manager or HistoryManager(COMBINED_HISTORY_BUDGET)
+        self.calls = 0
+        self.sections = 0
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+    def get_system_prompt(self, keys, context_keys=()):
+        roles = "\n\n".join(
+            f"### {key}：{self.agents[key].name}（{self.agents[key].role}）\n{self.agents[key].get_system_prompt()}"
+            for key in keys
+        )
+        context_note = ""
+        if context_keys:
+            context_note = f"参考资料只供 {'、'.join(context_keys)} 使用，其他角色忽略它。\n"
+        example = json.dumps({key: "……" for key in keys}, ensure_ascii=False)
+        return (
+            f"你要同时扮演学习小组中的 {len(keys)} 位助手，对同一份草稿分别给出各自的反馈。\n"
+            "每位助手的身份和规则如下（以 ### 开头的一行是该助手在输出中的键）：\n\n"
+            f"{roles}\n\n"
+            "输出要求：\n"
+            f"1. 只输出一个 JSON 对象，不要输出其他任何内容，格式为 {example}。\n"
+            "2. 每个值是该助手严格按自己的规则写出的完整回复（字符串）；图表助手的值是纯 Mermaid 代码。\n"
+            "3. 各助手互不引用，不要让一位助手评论另一位的内容。\n"
+            "4. 对话历史中助手的回复也是这种 JSON 格式。\n"
+            f"{context_note}"
+        )
+
+    def build_messages(self, draft, keys, context_material=None, context_keys=(), histories=None):
+        """
+        构造合并请求的消息列表
+        :return: (messages, 历史压缩的统计或 None)
+        """
+        lead = self.agents[self.keys[0]]
+        messages = [{"role": "system", "content": self.get_system_prompt(keys, context_keys)}]
+        if context_material:
+            messages.append(lead._context_message(context_material))
+        history_stats = None
+        history = merge_histories(histories or {}, keys)
+        if history:
+            history, history_stats = self.history_manager.prepare(history, lead.summarize_history)
+            messages.extend({"role": m["role"], "content": m["content"]} for m in history)
+        messages.append({
+            "role": "user",
+            "content": f"【用户正在撰写的文档】\n{draft}\n\n请按要求输出 JSON。"
+        })
+        return messages, history_stats
+
+    def request(self, draft, inputs):
+        """
+        发出一次合并请求
+        :param draft: 完整的草稿（合并模式下所有角色都收到全文）
+        :param inputs: {key: (发送的内容, 参考资料片段, 对话历史)}，与分开调用时相同
+        :return: {key: 回复原文}，请求失败时为空字典
+        """
+        keys = [key for key in self.keys if key in inputs]
+        # 马克和艾米收到的参考资料相同，只发送一份
+        context_keys = [key for key in keys if inputs[key][1]]
+        context_material = inputs[context_keys[0]][1] if context_keys else None
+        histories = {key: inputs[key][2] for key in keys}
+        lead = self.agents[self.keys[0]]
+        record = CallRecord(type(self).__name__, "小组", lead.model_name, self.backend.name)
+        with self._lock:
+            self.calls += 1
+        try:
+            messages, history_stats = self.build_messages(draft, keys, context_material, context_keys, histories)
+            if history_stats:
+                record.history_saved_tokens = history_stats["saved_tokens"]
+            model, messages = lead._route(record, messages, context_material)
+            response = self.backend.complete(model, messages)
+            record.first_byte()
+            record.add_usage(response.usage)
+            record.retries += response.retries
+            return parse_sections(response.text, keys)
+        except Exception as e:
+            lead._record_error(record, e)
+            print(f"Warning: combined review failed, falling back to separate calls: {str(e)}")
+            return {}
+        finally:
+            self.metrics.record(record.finish())
+
+    def accept(self, key, text, inputs):
+        """
+        检查合并请求中一个角色的回复：苏苏的图表必须通过校验；可用的回复写入该智能体的缓存
+        :param inputs: 该角色的 (发送的内容, 参考资料片段, 对话历史)
+        :return: 可以直接使用的回复，不合格时返回 None
+        """
+        if not text:
+            return None
+        agent = self.agents[key]
+        if hasattr(agent, "diagram_cache"):
+            try:
+                text = validate(text)
+            except MermaidError as e:
+                print(f"Warning: combined review returned invalid mermaid code for {key}: {e}")
+                return None
+        content, context, history = inputs
+        agent.store_reply(content, context, history, text)
+        return text
+
+    def count_section(self, used):
+        """统计一个角色的回复是直接使用合并结果，还是改为单独调用"""
+        with self._lock:
+            if used:
+                self.sections += 1
+            else:
+                self.fallbacks += 1
+
+    def start(self, draft, inputs, fallback_jobs):
+        """
+        开始一轮合并审阅
+        :param inputs: {key: (发送的内容, 参考资料片段, 对话历史)}，只包含需要合并的角色
+        :param fallback_jobs: {key: 单独调用时的任务}，与分开调用时交给 stream_parallel 的任务相同
+        :return: CombinedRound，round.run 作为以 tuple(inputs) 为键的组任务交给 stream_parallel
+        """
+        return CombinedRound(self, draft, inputs, fallback_jobs)
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "sections": self.sections, "fallbacks": self.fallbacks}
+
+
+class CombinedRound:
+    """
+    一轮合并审阅，作为 stream_parallel 的一个组任务执行：整轮只占调度器的一个工作线程（一张票）
+    命中缓存的角色直接返回；其余角色不止一个时发出合并请求，合并结果中缺失或不合格的角色交回 stream_parallel 单独提交
+    """
+
+    def __init__(self, reviewer, draft, inputs, fallback_jobs):
+        self.reviewer = reviewer
+        self.draft = draft
+        self.inputs = inputs
+        self.fallback_jobs = fallback_jobs
+
+    def run(self):
+        """:return: 生成器，产出 (key, 回复) 和 (key, None)（该角色结束），或 (key, Fallback)"""
+        remaining = {}
+        for key, (content, context, history) in self.inputs.items():
+            cached = self.reviewer.agents[key].lookup_cached(content, context, history)
+            if cached is None:
+                remaining[key] = self.inputs[key]
+                continue
+            yield key, cached
+            yield key, None
+
+        sections = self.reviewer.request(self.draft, remaining) if len(remaining) > 1 else {}
+        for key in remaining:
+            reply = self.reviewer.accept(key, sections.get(key), remaining[key])
+            if len(remaining) > 1:
+                self.reviewer.count_section(reply is not None)
+            if reply is None:
+                yield key, Fallback(self.fallback_jobs[key])
+                continue
+            yield key, reply
+            yield key, None
+
+
+_combined_reviewer = None
+_combined_reviewer_lock = threading.Lock()
+
+
+def get_combined_reviewer(agents):
+    """
+    进程级共享的合并审阅器
+    :param agents: 第一次创建时使用的智能体（通常是 get_shared_agents() 的结果）
+    """
+    global _combined_reviewer
+    with _combined_reviewer_lock:
+        if _combined_reviewer is None:
+            _combined_reviewer = CombinedReviewer(agents)
+        return _combined_reviewer
@@ -0,0 +1,274 @@
+# agents/parallel.py
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# 单个智能体的默认超时时间（秒）
+DEFAULT_AGENT_TIMEOUT = 60
+
+# 在全局调度器中排队的最长时间（秒），排队时间不计入智能体的超时
+DEFAULT_QUEUE_TIMEOUT = 120
+
+# 排队期间报告排队位置的间隔（秒）
+QUEUE_REPORT_INTERVAL = 0.5
+
+
+class AgentTimeoutError(TimeoutError):
+    """某个智能体在规定时间内没有返回结果"""
+
+    def __init__(self, key, timeout):
+        super().__init__(f"{key} 响应超时（{timeout}秒）")
+        self.key = key
+        self.timeout = timeout
+
+
+class QueueTimeoutError(AgentTimeoutError):
+    """某个智能体的任务在全局调度器中排队太久，还没有开始执行"""
+
+    def __init__(self, key, timeout):
+        TimeoutError.__init__(self, f"{key} 排队超时（{timeout}秒）")
+        self.key = key
+        self.timeout = timeout
+
+
+def run_parallel(jobs, timeout=DEFAULT_AGENT_TIMEOUT, max_workers=None):
+    """
+    并发执行多个智能体任务，按完成顺序逐个产出结果
+    :param jobs: {key: 无参可调用对象}，例如 {"mark": lambda: agent.process(...)}
+    :param timeout: 每个任务的超时时间（秒），可以是数字，也可以是 {key: 秒数} 的字典
+    :param max_workers: 线程池大小，默认与任务数相同
+    :return: 生成器，产出 (key, result, error)；成功时 error 为 None，
+             超时时 error 为 AgentTimeoutError，任务抛出异常时 error 为该异常
+    """
+    if not jobs:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(jobs))
+    try:
+        started = time.monotonic()
+        futures = {executor.submit(fn): key for key, fn in jobs.items()}
+        deadlines = {}
+        for future, key in futures.items():
+            limit = timeout.get(key, DEFAULT_AGENT_TIMEOUT) if isinstance(timeout, dict) else timeout
+            deadlines[future] = (started + limit, limit)
+
+        pending = set(futures)
+        while pending:
+            # 等到最近的一个截止时间为止，期间任何一个任务完成都会立即返回
+            nearest = min(deadlines[f][0] for f in pending)
+            done, pending = wait(pending, timeout=max(0, nearest - time.monotonic()), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                key = futures[future]
+                try:
+                    yield key, future.result(), None
+                except Exception as e:
+                    yield key, None, e
+
+            # 处理已经超时的任务：不再等待它们，直接报告超时
+            now = time.monotonic()
+            for future in list(pending):
+                deadline, limit = deadlines[future]
+                if now >= deadline:
+                    pending.discard(future)
+                    future.cancel()
+                    yield futures[future], None, AgentTimeoutError(futures[future], limit)
+    finally:
+        # 超时的线程仍可能在后台运行，这里不阻塞等待它们结束
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _drain_stream(key, factory, events, cancelled):
+    """在后台线程中消费一个智能体的流式输出，把分片放入事件队列"""
+    try:
+        for chunk in factory():
+            if cancelled.is_set():
+                return
+            events.put(("delta", key, chunk))
+        events.put(("done", key, None))
+    except Exception as e:
+        events.put(("error", key, e))
+
+
+def _start_and_drain(key, factory, events, cancelled):
+    """调度器中的任务：先通知已开始执行（开始计算超时），再消费流式输出"""
+    if cancelled.is_set():
+        return
+    events.put(("started", key, None))
+    _drain_stream(key, factory, events, cancelled)
+
+
+class Fallback:
+    """组任务中的一个智能体改为单独执行：factory 与普通任务相同，由 stream_parallel 另外提交"""
+
+    __slots__ = ("factory",)
+
+    def __init__(self, factory):
+        self.factory = factory
+
+
+def _drain_group(keys, factory, events, cancelled):
+    """
+    消费一个组任务（一次执行同时得到多个智能体的输出）：factory() 产出 (key, 分片)，
+    分片为 None 表示该智能体结束，为 Fallback 表示该智能体改为单独执行；组任务结束时仍未结束的智能体按完成处理
+    """
+    open_keys = list(keys)
+    try:
+        for key, chunk in factory():
+            if all(cancelled[k].is_set() for k in open_keys):
+                return
+            if chunk is None or isinstance(chunk, Fallback):
+                open_keys.remove(key)
+                events.put(("done", key, None) if chunk is None else ("fallback", key, chunk.factory))
+            elif not cancelled[key].is_set():
+                events.put(("delta", key, chunk))
+        for key in open_keys:
+            events.put(("done", key, None))
+    except Exception as e:
+        for key in open_keys:
+            events.put(("error", key, e))
+
+
+def _start_and_drain_group(keys, factory, events, cancelled):
+    """调度器中的组任务：一个工作线程执行，所有成员同时开始计算超时"""
+    if all(cancelled[key].is_set() for key in keys):
+        return
+    for key in keys:
+        events.put(("started", key, None))
+    _drain_group(keys, factory, events, cancelled)
+
+
+def stream_parallel(jobs, timeout=DEFAULT_AGENT_TIMEOUT, max_workers=None, scheduler=None, session_id=None,
+                    queue_timeout=DEFAULT_QUEUE_TIMEOUT, cancel=None):
+    """
+    并发消费多个智能体的流式输出，分片一到达就产出，供界面逐步刷新
+    :param jobs: {key: 返回可迭代文本分片的无参可调用对象}，例如 {"mark": lambda: agent.stream(...)}；
+                 键为多个 key 组成的元组时是组任务：只占一个工作线程，返回的可迭代对象产出 (key, 分片)，
+                 分片为 None 表示该 key 结束，为 Fallback 时该 key 改为单独提交 Fallback.factory
+    :param timeout: 每个任务从开始到结束的超时时间（秒），可以是数字或 {key: 秒数} 的字典
+    :param max_workers: 线程池大小，默认与任务数相同（使用 scheduler 时忽略）
+    :param scheduler: 全局调度器 RequestScheduler（可选），提供时任务在调度器的工作线程中排队执行
+    :param session_id: 提交任务的会话 ID，供调度器做会话间的公平调度
+    :param queue_timeout: 在调度器中排队的最长时间（秒）
+    :param cancel: threading.Event（可选），被设置后立即停止：不再产出事件，取消排队中的任务并通知后台线程停止
+    :return: 生成器，产出 (event, key, payload)：
+             ("delta", key, 文本分片)、("done", key, None) 或 ("error", key, 异常/AgentTimeoutError)；
+             使用调度器时，排队期间还会产出 ("queued", key, 前面的任务数)
+    """
+    if not jobs:
+        return
+
+    events = queue.Queue()
+    members = {job: job if isinstance(job, tuple) else (job,) for job in jobs}
+    keys = [key for job in jobs for key in members[job]]
+    cancelled = {key: threading.Event() for key in keys}
+    executor = None
+    tickets = {}
+
+    def run_job(job):
+        if isinstance(job, tuple):
+            return lambda: _start_and_drain_group(job, jobs[job], events, cancelled)
+        return lambda: _start_and_drain(job, jobs[job], events, cancelled[job])
+
+    try:
+        started = time.monotonic()
+        limits = {
+            key: timeout.get(key, DEFAULT_AGENT_TIMEOUT) if isinstance(timeout, dict) else timeout for key in keys
+        }
+        deadlines = {key: (started + limits[key], limits[key]) for key in keys}
+
+        if scheduler is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers or len(keys))
+            for job, factory in jobs.items():
+                if isinstance(job, tuple):
+                    executor.submit(_drain_group, job, factory, events, cancelled)
+                else:
+                    executor.submit(_drain_stream, job, factory, events, cancelled[job])
+        else:
+            try:
+                submitted = scheduler.submit_many(session_id, [run_job(job) for job in jobs])
+            except Exception as e:
+                # 队列已满等情况：所有任务都报告同一个错误
+                for key in keys:
+                    yield "error", key, e
+                return
+            # 组任务的成员共用一张票
+            tickets = {key: ticket for job, ticket in zip(jobs, submitted) for key in members[job]}
+            # 排队期间的截止时间按排队上限计算，开始执行后再按智能体的超时重新计算
+            for key in keys:
+                deadlines[key] = (started + queue_timeout, queue_timeout)
+
+        queued = set(tickets)
+        positions = {}
+        pending = set(keys)
+        while pending:
+            nearest = min(deadlines[k][0] for k in pending)
+            wait_for = max(0, nearest - time.monotonic())
+            if queued or cancel is not None:
+                wait_for = min(wait_for, QUEUE_REPORT_INTERVAL)
+            try:
+                event, key, payload = events.get(timeout=wait_for)
+            except queue.Empty:
+                event = None
+            if cancel is not None and cancel.is_set():
+                return
+
+            if event == "started":
+                if key in pending:
+                    queued.discard(key)
+                    deadlines[key] = (time.monotonic() + limits[key], limits[key])
+            elif event == "fallback":
+                # 组任务中的一个智能体改为单独执行
+                if key in pending:
+                    if scheduler is None:
+                        executor.submit(_drain_stream, key, payload, events, cancelled[key])
+                        deadlines[key] = (time.monotonic() + limits[key], limits[key])
+                    else:
+                        try:
+                            tickets[key] = scheduler.submit(
+                                session_id, lambda key=key, factory=payload: _start_and_drain(
+                                    key, factory, events, cancelled[key])
+                            )
+                        except Exception as e:
+                            pending.discard(key)
+                            yield "error", key, e
+                        else:
+                            queued.add(key)
+                            deadlines[key] = (time.monotonic() + queue_timeout, queue_timeout)
+            # 已超时任务迟到的分片直接丢弃
+            elif event is not None and key in pending:
+                if event != "delta":
+                    pending.discard(key)
+                queued.discard(key)
+                yield event, key, payload
+
+            # 报告仍在排队的任务的位置（只在变化时产出）
+            for key in list(queued):
+                position = tickets[key].position()
+                if positions.get(key) != position:
+                    positions[key] = position
+                    yield "queued", key, position
+
+            now = time.monotonic()
+            for key in list(pending):
+                deadline, limit = deadlines[key]
+                if now >= deadline:
+                    pending.discard(key)
+                    queued.discard(key)
+                    cancelled[key].set()
+                    # 组任务的票还有其他成员在等时不取消，只报告排队超时
+                    ticket = tickets.get(key)
+                    shared = ticket is not None and any(tickets.get(other) is ticket for other in pending)
+                    if ticket is not None and (ticket.state == ticket.QUEUED if shared else ticket.cancel()):
+                        yield "error", key, QueueTimeoutError(key, limit)
+                    else:
+                        yield "error", key, AgentTimeoutError(key, limit)
+    finally:
+        # 通知仍在运行的后台线程尽快停止读取，取消仍在排队的任务
+        for flag in cancelled.values():
+            flag.set()
+        for ticket in tickets.values():
+            ticket.cancel()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
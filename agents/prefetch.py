@@ -0,0 +1,197 @@
+# agents/prefetch.py
+import os
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future
+
+from .live import input_signature
+from .scheduler import QueueFullError
+from .tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# 每个会话预取最多花费的提示 token 数（按估算值计）
+DEFAULT_SESSION_BUDGET = 60000
+
+
+def draft_key(draft):
+    """草稿的哈希，预取结果按它保存"""
+    return hashlib.blake2b((draft or "").encode("utf-8"), digest_size=16).hexdigest()
+
+
+def estimate_job_tokens(agent, content, context_material=None, conversation_history=None):
+    """一次调用的提示 token 估算：系统提示词、发送的内容、参考资料和完整的对话历史（压缩前）"""
+    return (
+        estimate_tokens(agent.get_system_prompt())
+        + estimate_tokens(content)
+        + estimate_tokens(context_material or "")
+        + sum(estimate_tokens(m["content"]) for m in conversation_history or [])
+    )
+
+
+class _Prefetch:
+    """一个智能体的预取任务"""
+
+    __slots__ = ("signature", "future", "ticket", "tokens")
+
+    def __init__(self, signature, future, tokens):
+        self.signature = signature
+        self.future = future
+        self.ticket = None
+        self.tokens = tokens
+
+
+class SpeculativePrefetcher:
+    """
+    预取：上传的草稿解析完成后，不等用户点击提交就在后台让智能体审阅
+    - 结果按草稿哈希保存在会话内，提交的草稿与预取的草稿相同、且该智能体的输入（参考资料、对话历史）没有变化时直接使用
+    - 草稿被修改后预取结果作废，还在排队的任务被取消
+    - 每个会话的预取花费有上限（按估算的提示 token 计），超出后不再预取；调度器有排队时也不预取，不和正式提交抢资源
+    每个浏览器会话一个实例
+    """
+
+    def __init__(self, agents, scheduler=None, session_id=None, budget_tokens=None):
+        """
+        :param agents: {key: 智能体}
+        :param scheduler: 全局调度器（可选），预取任务和正式提交使用同一个会话 ID 排队，
+                          同一会话内先进先出，正式提交等待预取结果时不会占住预取任务需要的工作线程
+        :param session_id: 会话 ID
+        :param budget_tokens: 本会话预取的 token 上限，默认读取环境变量 PREFETCH_SESSION_TOKENS
+        """
+        self.agents = agents
+        self.scheduler = scheduler
+        self.session_id = session_id
+        if budget_tokens is None:
+            budget_tokens = int(os.getenv("PREFETCH_SESSION_TOKENS", str(DEFAULT_SESSION_BUDGET)))
+        self.budget_tokens = budget_tokens
+        self.spent_tokens = 0
+        self.key = None
+        # 最近一次考虑过的草稿（预取过或因超出上限跳过），同一份草稿不再重复考虑
+        self._considered = None
+        self.rounds = 0
+        self.used = 0
+        self.dropped = 0
+        self.over_budget = 0
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def start(self, draft, inputs, runner_for=None):
+        """
+        开始预取一份草稿；这份草稿已经预取过、超出花费上限或调度器繁忙时什么也不做
+        :param inputs: 可调用对象 inputs(draft) -> {key: (发送的内容, 参考资料片段, 对话历史)}，只在需要预取时调用
+        :param runner_for: 可调用对象 runner_for(key, content) -> 实际调用的对象（例如长文档的 MapReduceReviewer），
+                           默认直接使用智能体
+        :return: 是否开始了预取
+        """
+        if not draft or not draft.strip():
+            return False
+        key = draft_key(draft)
+        with self._lock:
+            if key == self._considered:
+                return False
+        if self.scheduler is not None and self.scheduler.stats()["queued"]:
+            return False
+
+        prefetches = {}
+        calls = {}
+        for agent_key, (content, context, history) in inputs(draft).items():
+            history = list(history or [])
+            runner = runner_for(agent_key, content) if runner_for else self.agents[agent_key]
+            prefetch = _Prefetch(
+                input_signature(content, context, history), Future(),
+                estimate_job_tokens(self.agents[agent_key], content, context, history)
+            )
+            prefetches[agent_key] = prefetch
+            calls[agent_key] = (lambda runner=runner, content=content, context=context, history=history,
+                                future=prefetch.future: self._run(future, runner, content, context, history))
+
+        with self._lock:
+            if key == self._considered:
+                return False
+            tokens = sum(p.tokens for p in prefetches.values())
+            if self.spent_tokens + tokens > self.budget_tokens:
+                self._considered = key
+                self.over_budget += 1
+                logger.info("prefetch skipped: session budget %d tokens, spent %d, needs %d",
+                            self.budget_tokens, self.spent_tokens, tokens)
+                return False
+            self._drop()
+            if self.scheduler is not None:
+                try:
+                    tickets = self.scheduler.submit_many(self.session_id, list(calls.values()))
+                except QueueFullError:
+                    return False
+                for prefetch, ticket in zip(prefetches.values(), tickets):
+                    prefetch.ticket = ticket
+            else:
+                for agent_key, call in calls.items():
+                    threading.Thread(target=call, name=f"prefetch-{agent_key}", daemon=True).start()
+            self.key = self._considered = key
+            self._jobs = prefetches
+            self.spent_tokens += tokens
+            self.rounds += 1
+            return True
+
+    @staticmethod
+    def _run(future, runner, content, context, history):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(runner.process(content, context_material=context, conversation_history=history))
+        except Exception as e:
+            future.set_exception(e)
+
+    def retain(self, draft):
+        """草稿与预取的草稿不同（用户改过）时作废预取结果"""
+        with self._lock:
+            if self._jobs and draft_key(draft) != self.key:
+                self._drop()
+
+    def claim(self, draft, inputs):
+        """
+        正式提交时取出可以直接使用的预取结果；其余的预取任务作废，同一份结果只用一次
+        :param inputs: 本次提交的 {key: (发送的内容, 参考资料片段, 对话历史)}
+        :return: {key: Future}，Future 的结果为该智能体的完整回复（可能仍在生成中）
+        """
+        with self._lock:
+            if draft_key(draft) != self.key:
+                self._drop()
+                return {}
+            claimed = {}
+            for agent_key, (content, context, history) in inputs.items():
+                prefetch = self._jobs.pop(agent_key, None)
+                if prefetch is None or prefetch.signature != input_signature(content, context, history):
+                    continue
+                future = prefetch.future
+                if future.cancelled():
+                    continue
+                # 出错的预取结果不使用，正式提交时重新请求
+                if future.done() and (future.exception() is not None or future.result().startswith("Error:")):
+                    continue
+                claimed[agent_key] = future
+            self.used += len(claimed)
+            self._drop()
+            return claimed
+
+    def _drop(self):
+        # 调用方持有锁；还没开始执行的任务被取消，估算的花费退回。
+        # self._considered 保持不变：同一份上传的草稿不会因为用户改过或已经提交而再次预取
+        for prefetch in self._jobs.values():
+            if prefetch.ticket is not None:
+                prefetch.ticket.cancel()
+            if prefetch.future.cancel():
+                self.spent_tokens -= prefetch.tokens
+            self.dropped += 1
+        self._jobs = {}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rounds": self.rounds,
+                "used": self.used,
+                "dropped": self.dropped,
+                "over_budget": self.over_budget,
+                "spent_tokens": self.spent_tokens,
+                "budget_tokens": self.budget_tokens,
+            }
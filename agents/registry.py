@@ -0,0 +1,76 @@
+# agents/registry.py
+import threading
+
+from .reviewer import ReviewerAgent
+from .researcher import ResearcherAgent
+from .visualizer import VisualizerAgent
+from .history import HistoryManager
+from .routing import RoutingPolicy, ModelTier, MAX_PROMPT_TOKENS
+from .backends import get_backend
+from .scheduler import get_scheduler
+
+# 每个智能体发送的对话历史的 token 预算，超出部分折叠成摘要
+HISTORY_TOKEN_BUDGETS = {"mark": 3000, "amy": 2000, "susu": 1500}
+
+# 每个智能体按提示大小（估算的 token 数）选择模型：
+# 马克的逻辑审核对模型能力要求高，短输入也使用 qwen-plus；艾米和苏苏的短输入使用更快更便宜的 qwen-turbo；
+# 整篇论文加长对话历史这样的长输入使用长上下文的 qwen-long
+ROUTING_POLICIES = {
+    "mark": RoutingPolicy([
+        ModelTier("standard", "qwen-plus", 24000),
+        ModelTier("long", "qwen-long", MAX_PROMPT_TOKENS),
+    ]),
+    "amy": RoutingPolicy([
+        ModelTier("fast", "qwen-turbo", 2000),
+        ModelTier("standard", "qwen-plus", 24000),
+        ModelTier("long", "qwen-long", MAX_PROMPT_TOKENS),
+    ]),
+    "susu": RoutingPolicy([
+        ModelTier("fast", "qwen-turbo", 3000),
+        ModelTier("standard", "qwen-plus", 24000),
+        ModelTier("long", "qwen-long", MAX_PROMPT_TOKENS),
+    ]),
+}
+
+
+def create_agents(cache=None, backend=None, history_budgets=None, routing_policies=None):
+    """
+    创建小组的三个智能体
+    :param cache: 共享的回复缓存（可选）
+    :param backend: 模型后端（可选），默认使用进程共享的后端
+    :param history_budgets: {key: token 预算}，默认使用 HISTORY_TOKEN_BUDGETS；传入空字典则不压缩历史
+    :param routing_policies: {key: RoutingPolicy}，默认使用 ROUTING_POLICIES；传入空字典则总是使用 qwen-plus
+    :return: {"mark": ReviewerAgent, "amy": ResearcherAgent, "susu": VisualizerAgent}
+    """
+    budgets = HISTORY_TOKEN_BUDGETS if history_budgets is None else history_budgets
+    policies = ROUTING_POLICIES if routing_policies is None else routing_policies
+
+    def history_manager(key):
+        return HistoryManager(budgets[key]) if key in budgets else None
+
+    return {
+        "mark": ReviewerAgent(name="马克", role="逻辑审核员", cache=cache, backend=backend,
+                              history_manager=history_manager("mark"), routing=policies.get("mark")),
+        "amy": ResearcherAgent(name="艾米", role="数据资料员", cache=cache, backend=backend,
+                               history_manager=history_manager("amy"), routing=policies.get("amy")),
+        "susu": VisualizerAgent(name="苏苏", role="视觉设计师", cache=cache, backend=backend,
+                                history_manager=history_manager("susu"), routing=policies.get("susu")),
+    }
+
+
+_shared_agents = None
+_shared_agents_lock = threading.Lock()
+
+
+def get_shared_agents(cache=None):
+    """
+    进程级共享的三个智能体，所有会话共用
+    智能体本身不保存单次调用的状态（对话历史由调用方传入），可以被多个线程同时使用
+    后端经过全局调度器的 throttle 包装：长文档在一个任务内并发的分段请求也逐个计入限速和并发上限
+    :param cache: 第一次创建时使用的回复缓存
+    """
+    global _shared_agents
+    with _shared_agents_lock:
+        if _shared_agents is None:
+            _shared_agents = create_agents(cache=cache, backend=get_scheduler().throttle(get_backend()))
+        return _shared_agents
@@ -1,6 +1,9 @@
 from .base_agent import BaseAgent
 
 class ResearcherAgent(BaseAgent):
+    # 草稿只改了几个字时补充的资料不会变，复用上次的结果
+    use_similarity_cache = True
+
     def get_system_prompt(self):
         return (
             f"你是 {self.name}，一个高效的资料搜集员。"
@@ -0,0 +1,268 @@
+# agents/resilience.py
+import os
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .backends import LLMBackend, BackendError
+from .scheduler import DEFAULT_WORKERS
+
+logger = logging.getLogger(__name__)
+
+# 可以重试的 HTTP 状态码；网络错误（status_code 为 None）同样重试
+RETRYABLE_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+_END = object()
+
+
+def is_retryable(error):
+    """判断一次失败是否值得重试：限流、服务端错误和网络错误"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, BackendError):
+        return error.status_code is None or error.status_code in RETRYABLE_STATUSES
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def _discard_result(future, cleanup):
+    """对冲中落后的请求结束后，释放它的结果（例如关闭流式连接）"""
+    if not future.cancelled() and future.exception() is None:
+        cleanup(future.result())
+
+
+class CircuitOpenError(BackendError):
+    """熔断器处于打开状态，请求被直接拒绝"""
+
+    def __init__(self, key, retry_in):
+        super().__init__(f"{key} 暂时不可用（熔断中，{retry_in:.0f} 秒后重试）", 503)
+        self.key = key
+        self.retry_in = retry_in
+
+
+class RetryPolicy:
+    """
+    有上限的重试，退避时间为带完全抖动的指数退避：uniform(0, min(max_delay, base_delay * 2^n))
+    :param max_retries: 最多重试次数（不含第一次请求）
+    """
+
+    def __init__(self, max_retries=2, base_delay=0.5, max_delay=8.0, seed=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._random = random.Random(seed)
+
+    def delay(self, retry):
+        """第 retry 次重试（从 0 开始）之前的等待时间（秒）"""
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry)))
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续失败 failure_threshold 次后打开，reset_timeout 秒内直接拒绝请求；
+    之后进入半开状态，放行一个试探请求，成功则关闭，失败则重新打开
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, key, failure_threshold=5, reset_timeout=30.0):
+        self.key = key
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """请求前调用，熔断中时抛出 CircuitOpenError"""
+        with self._lock:
+            if self.state == CircuitBreaker.OPEN:
+                retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+                if retry_in > 0:
+                    raise CircuitOpenError(self.key, retry_in)
+                self.state = CircuitBreaker.HALF_OPEN
+                self._probing = False
+            if self.state == CircuitBreaker.HALF_OPEN:
+                # 半开状态只放行一个试探请求
+                if self._probing:
+                    raise CircuitOpenError(self.key, 0)
+                self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def release(self):
+        """请求没有得出结论（例如请求本身有问题）：只归还半开状态的试探名额，不改变熔断状态和失败计数"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    logger.warning("circuit opened for %s after %d failures", self.key, self.failures)
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+class ResilientBackend(LLMBackend):
+    """
+    给任意后端加上重试、对冲请求和熔断
+    - 可重试的失败（429、5xx、网络错误）按 RetryPolicy 退避后重试
+    - hedge_after 不为 None 时，请求超过该时间（秒）还没有返回（流式调用为首个分片），
+      就再发一个相同的请求，采用先返回的那个
+    - 每个 (后端, 模型) 一个熔断器，后端持续失败时直接拒绝，不再等待超时
+    流式调用只在产出第一个分片之前重试或对冲，已经输出的内容不会重复
+    对冲线程池默认为调度器并发数（SCHEDULER_WORKERS）的两倍，每个调度线程同时最多占用一个主请求和一个对冲请求，
+    请求不会在池中排队；hedge_after 从主请求真正开始执行时计时
+    """
+
+    def __init__(self, backend, retry_policy=None, hedge_after=None, failure_threshold=5, reset_timeout=30.0,
+                 sleep=time.sleep, hedge_workers=None):
+        self.inner = backend
+        self.name = backend.name
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.hedge_after = hedge_after
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._sleep = sleep
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        if hedge_after:
+            if hedge_workers is None:
+                hedge_workers = 2 * int(os.getenv("SCHEDULER_WORKERS", str(DEFAULT_WORKERS)))
+            self._executor = ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="hedge")
+
+    def warm_up(self):
+        self.inner.warm_up()
+
+    def breaker(self, model):
+        key = f"{self.name}/{model}"
+        with self._lock:
+            if key not in self._breakers:
+                self._breakers[key] = CircuitBreaker(key, self.failure_threshold, self.reset_timeout)
+            return self._breakers[key]
+
+    def complete(self, model, messages, **kwargs):
+        def attempt():
+            if self.hedge_after is None:
+                return self.inner.complete(model, messages, **kwargs)
+            return self._hedged(lambda: self.inner.complete(model, messages, **kwargs))
+
+        response, retries = self._with_retries(model, attempt)
+        response.retries = retries
+        return response
+
+    def stream(self, model, messages, **kwargs):
+        def attempt():
+            # 拿到第一个分片才算请求成功，之后的分片直接转发
+            if self.hedge_after is None:
+                chunks = iter(self.inner.stream(model, messages, **kwargs))
+                return next(chunks, _END), chunks
+            return self._hedged(lambda: self._first_chunk(model, messages, kwargs), on_lose=self._close_stream)
+
+        (first, chunks), retries = self._with_retries(model, attempt)
+        if first is _END:
+            return
+        first.retries = retries
+        yield first
+        yield from chunks
+
+    def _first_chunk(self, model, messages, kwargs):
+        chunks = iter(self.inner.stream(model, messages, **kwargs))
+        return next(chunks, _END), chunks
+
+    @staticmethod
+    def _close_stream(result):
+        close = getattr(result[1], "close", None)
+        if close:
+            close()
+
+    def _with_retries(self, model, attempt):
+        """执行 attempt，可重试的失败按退避策略重试；返回 (结果, 重试次数)"""
+        breaker = self.breaker(model)
+        retries = 0
+        while True:
+            breaker.before_call()
+            try:
+                result = attempt()
+            except Exception as e:
+                if not is_retryable(e):
+                    # 请求本身有问题（例如 400），既不算失败也不能说明后端已经恢复
+                    breaker.release()
+                    raise
+                breaker.record_failure()
+                if retries >= self.retry_policy.max_retries:
+                    raise
+                delay = self.retry_policy.delay(retries)
+                retries += 1
+                with self._lock:
+                    self.retries += 1
+                logger.info("retrying %s/%s in %.2fs after: %s", self.name, model, delay, e)
+                self._sleep(delay)
+                continue
+            breaker.record_success()
+            return result, retries
+
+    def _hedged(self, call, on_lose=None):
+        """
+        先发一个请求，hedge_after 秒内没有返回就再发一个，返回先成功的结果；
+        两个都失败时抛出最后一个异常。落后的请求在后台结束后交给 on_lose 清理
+        """
+        started = threading.Event()
+
+        def run_primary():
+            started.set()
+            return call()
+
+        primary = self._executor.submit(run_primary)
+        # 池中排队的时间不计入 hedge_after
+        started.wait()
+        done, _ = wait([primary], timeout=self.hedge_after)
+        futures = [primary]
+        if not done:
+            with self._lock:
+                self.hedges += 1
+            futures.append(self._executor.submit(call))
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is not primary:
+                    with self._lock:
+                        self.hedge_wins += 1
+                for other in pending:
+                    if not other.cancel() and on_lose is not None:
+                        other.add_done_callback(lambda f: _discard_result(f, on_lose))
+                return result
+        raise error
+
+    def stats(self):
+        with self._lock:
+            return {
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "breakers": {key: b.state for key, b in self._breakers.items()},
+            }
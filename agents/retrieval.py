@@ -0,0 +1,148 @@
+# agents/retrieval.py
+import re
+import math
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+
+# 中文按字符二元组切词，英文和数字按单词切词
+_CJK_RUN_RE = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+_WORD_RE = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    """把文本切成检索用的词项：中文字符 bigram（单字片段保留 unigram）+ 英文单词"""
+    text = text.lower()
+    terms = _WORD_RE.findall(text)
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def chunk_text(text, chunk_size=500, overlap=100):
+    """
+    按段落把文本切成不超过 chunk_size 个字符的片段
+    单个段落过长时按固定窗口切分，相邻窗口重叠 overlap 个字符
+    """
+    paragraphs = [p.strip() for p in re.split(r'\n\s*\n|\n', text) if p.strip()]
+    chunks = []
+    current = ""
+    for paragraph in paragraphs:
+        if len(paragraph) > chunk_size:
+            if current:
+                chunks.append(current)
+                current = ""
+            step = max(1, chunk_size - overlap)
+            for start in range(0, len(paragraph), step):
+                chunks.append(paragraph[start:start + chunk_size])
+                if start + chunk_size >= len(paragraph):
+                    break
+        elif len(current) + len(paragraph) + 1 > chunk_size:
+            chunks.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class BM25Index:
+    """基于 BM25 的词法检索索引"""
+
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self._term_freqs = [Counter(tokenize(chunk)) for chunk in chunks]
+        self._lengths = [sum(tf.values()) for tf in self._term_freqs]
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0
+        doc_freq = Counter()
+        for tf in self._term_freqs:
+            doc_freq.update(tf.keys())
+        n = len(chunks)
+        self._idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+
+    def search(self, query, k=4):
+        """
+        检索与查询最相关的片段
+        :return: [(score, chunk_index), ...]，按得分从高到低排列，只包含得分大于 0 的片段
+        """
+        query_terms = set(tokenize(query)) & self._idf.keys()
+        if not query_terms:
+            return []
+        scores = []
+        for i, tf in enumerate(self._term_freqs):
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[i] / (self._avg_length or 1))
+            score = 0.0
+            for term in query_terms:
+                freq = tf.get(term)
+                if freq:
+                    score += self._idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            if score > 0:
+                scores.append((score, i))
+        scores.sort(reverse=True)
+        return scores[:k]
+
+
+class DocumentIndex:
+    """单个参考文档的分块检索索引"""
+
+    def __init__(self, text, name="", chunk_size=500, overlap=100):
+        self.name = name
+        self.chunks = chunk_text(text, chunk_size, overlap)
+        self.index = BM25Index(self.chunks)
+
+    def search(self, query, k=4):
+        """返回 [(score, 文档名, 片段文本), ...]"""
+        return [(score, self.name, self.chunks[i]) for score, i in self.index.search(query, k)]
+
+
+# 进程级索引缓存：同一份文档（按内容哈希）只建一次索引
+_INDEX_CACHE_SIZE = 32
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+
+def get_document_index(text, name=""):
+    """获取文档索引，按内容哈希缓存，Streamlit 重新运行时直接复用"""
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    with _index_cache_lock:
+        if key in _index_cache:
+            _index_cache.move_to_end(key)
+            return _index_cache[key]
+
+    index = DocumentIndex(text, name=name)
+    with _index_cache_lock:
+        _index_cache[key] = index
+        while len(_index_cache) > _INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+
+def build_context(indexes, query, k=4, max_chars=3000):
+    """
+    从一个或多个文档索引中检索与草稿最相关的 top-k 片段，拼接成参考资料文本
+    :param indexes: DocumentIndex 列表
+    :param query: 检索查询（通常是用户草稿）
+    :param k: 返回的片段数量
+    :param max_chars: 参考资料的总字符上限
+    :return: 参考资料文本，没有相关片段时返回空字符串
+    """
+    results = []
+    for index in indexes:
+        results.extend(index.search(query, k))
+    results.sort(key=lambda r: r[0], reverse=True)
+
+    parts = []
+    total = 0
+    for n, (_, name, chunk) in enumerate(results[:k], start=1):
+        if total + len(chunk) > max_chars and parts:
+            break
+        source = f"（{name}）" if name else ""
+        parts.append(f"【片段{n}{source}】\n{chunk}")
+        total += len(chunk)
+    return "\n\n".join(parts)
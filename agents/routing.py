@@ -0,0 +1,97 @@
+# agents/routing.py
+import logging
+
+from .tokens import estimate_tokens, estimate_messages_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+# 提示的默认上限（估算的 token 数）：长上下文模型能处理更多，但超过这个量的输入在本应用中基本是误操作
+MAX_PROMPT_TOKENS = 100000
+
+# 参考资料被截短时附加的说明
+TRIM_NOTICE = "\n……（参考资料过长，后面的部分已省略）"
+
+
+class PromptTooLargeError(ValueError):
+    """提示超过路由策略允许的上限，请求没有发出"""
+
+    def __init__(self, message, prompt_tokens=None):
+        super().__init__(message)
+        self.prompt_tokens = prompt_tokens
+
+
+class ModelTier:
+    """路由的一档：估算的提示 token 数不超过 max_prompt_tokens 时使用 model"""
+
+    __slots__ = ("name", "model", "max_prompt_tokens")
+
+    def __init__(self, name, model, max_prompt_tokens):
+        self.name = name
+        self.model = model
+        self.max_prompt_tokens = max_prompt_tokens
+
+
+class RouteDecision:
+    """一次路由的结果"""
+
+    __slots__ = ("tier", "model", "prompt_tokens", "trimmed_tokens", "messages")
+
+    def __init__(self, tier, prompt_tokens, trimmed_tokens, messages):
+        self.tier = tier
+        self.model = tier.model
+        self.prompt_tokens = prompt_tokens
+        self.trimmed_tokens = trimmed_tokens
+        self.messages = messages
+
+
+class RoutingPolicy:
+    """
+    按提示大小选择模型
+    - 发送前用本地估算（agents/tokens.py，不需要网络）计算整个提示的 token 数
+    - 按档位从小到大选择第一个装得下的模型：短输入用更快更便宜的模型，长输入用长上下文模型
+    - 超过最后一档的上限时先截短参考资料，仍然超出则拒绝，不发出注定失败的请求
+    """
+
+    def __init__(self, tiers, trim_context=True):
+        """
+        :param tiers: [ModelTier, ...]，按 max_prompt_tokens 从小到大排列，最后一档的上限即提示的上限
+        :param trim_context: 超出上限时是否截短参考资料；为 False 时直接拒绝
+        """
+        self.tiers = sorted(tiers, key=lambda tier: tier.max_prompt_tokens)
+        self.trim_context = trim_context
+
+    @property
+    def max_prompt_tokens(self):
+        return self.tiers[-1].max_prompt_tokens
+
+    def route(self, messages, context_material=None, context_message=None, label=""):
+        """
+        为一次请求选择模型
+        :param messages: 准备发送的消息列表
+        :param context_material: 消息中的参考资料原文（可选）
+        :param context_message: 可调用对象 context_message(material) -> 参考资料消息，截短时用它重新生成
+        :param label: 日志中显示的调用方名称
+        :return: RouteDecision，messages 为实际发送的消息列表（截短时是新的列表）
+        :raises PromptTooLargeError: 截短参考资料后仍然超过上限
+        """
+        limit = self.max_prompt_tokens
+        tokens = estimate_messages_tokens(messages)
+        trimmed = 0
+        if tokens > limit and context_material and context_message is not None and self.trim_context:
+            keep = estimate_tokens(context_material) - (tokens - limit) - estimate_tokens(TRIM_NOTICE)
+            if keep > 0:
+                original = context_message(context_material)
+                replacement = context_message(truncate_to_tokens(context_material, keep) + TRIM_NOTICE)
+                messages = [replacement if m == original else m for m in messages]
+                trimmed = tokens - estimate_messages_tokens(messages)
+                tokens -= trimmed
+        if tokens > limit:
+            logger.warning("route %s: rejected, ~%d prompt tokens over limit %d", label, tokens, limit)
+            raise PromptTooLargeError(
+                f"内容太长（约 {tokens} tokens，上限 {limit}），请缩短草稿、参考资料或开始新的对话",
+                prompt_tokens=tokens
+            )
+        tier = next(tier for tier in self.tiers if tokens <= tier.max_prompt_tokens)
+        logger.info("route %s: ~%d prompt tokens -> %s (%s)%s", label, tokens, tier.model, tier.name,
+                    f", trimmed {trimmed} context tokens" if trimmed else "")
+        return RouteDecision(tier, tokens, trimmed, messages)
@@ -0,0 +1,306 @@
+# agents/scheduler.py
+import os
+import time
+import threading
+from collections import deque, OrderedDict
+
+from .backends import LLMBackend
+
+# 默认配置，可通过环境变量覆盖（见 get_scheduler）
+DEFAULT_WORKERS = 16
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 20
+DEFAULT_MAX_QUEUE = 300
+
+
+class QueueFullError(Exception):
+    """全局请求队列已满，新的请求被拒绝"""
+
+    def __init__(self, depth, limit):
+        super().__init__(f"请求队列已满（{depth}/{limit}），请稍后再试")
+        self.depth = depth
+        self.limit = limit
+
+
+class TokenBucket:
+    """
+    令牌桶限速：平均每秒 rate 个令牌，最多积攒 capacity 个（允许短时突发）
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """立即尝试取出令牌，成功返回 True"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        取出令牌，不足时等待
+        :param timeout: 最长等待时间（秒），None 表示一直等待
+        :return: 是否取到令牌
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None:
+                if now >= deadline:
+                    return False
+                wait = min(wait, deadline - now)
+            time.sleep(wait)
+
+
+class ThrottledBackend(LLMBackend):
+    """
+    限制并发数和每秒请求数的后端包装：同时进行的请求不超过 max_concurrency 个，每个请求开始前取一个令牌
+    RequestScheduler 按智能体调用排队，这里作用在每一次后端请求上（包括长文档的分段请求和图表修复请求），
+    供批量审阅（batch_review.py）和应用（RequestScheduler.throttle）保证全局的请求速率
+    """
+
+    def __init__(self, backend, rate=DEFAULT_RATE, burst=None, max_concurrency=DEFAULT_WORKERS, bucket=None,
+                 slots=None):
+        """
+        :param bucket: 共享的 TokenBucket（可选），提供时忽略 rate 和 burst
+        :param slots: 共享的并发信号量（可选），提供时忽略 max_concurrency
+        """
+        self.inner = backend
+        self.name = backend.name
+        self.bucket = bucket or TokenBucket(rate, burst or max(1, int(rate)))
+        self._slots = slots or threading.BoundedSemaphore(max_concurrency)
+
+    def complete(self, model, messages, **kwargs):
+        with self._slots:
+            self.bucket.acquire()
+            return self.inner.complete(model, messages, **kwargs)
+
+    def stream(self, model, messages, **kwargs):
+        with self._slots:
+            self.bucket.acquire()
+            yield from self.inner.stream(model, messages, **kwargs)
+
+    def warm_up(self):
+        self.inner.warm_up()
+
+
+class Ticket:
+    """提交给调度器的一个任务"""
+
+    __slots__ = ("session_id", "fn", "state", "result", "error", "submitted_at", "started_at", "_done", "_scheduler")
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    CANCELLED = "cancelled"
+
+    def __init__(self, scheduler, session_id, fn):
+        self.session_id = session_id
+        self.fn = fn
+        self.state = Ticket.QUEUED
+        self.result = None
+        self.error = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self._done = threading.Event()
+        self._scheduler = scheduler
+
+    def position(self):
+        """排在它前面的任务数（已开始执行时为 0）"""
+        return self._scheduler.position(self)
+
+    def cancel(self):
+        """取消仍在排队的任务，已经开始执行的任务无法取消"""
+        return self._scheduler.cancel(self)
+
+    def wait(self, timeout=None):
+        """等待任务结束（完成或取消），返回是否已结束"""
+        return self._done.wait(timeout)
+
+
+class RequestScheduler:
+    """
+    进程级的全局请求调度器
+    - 有界工作线程池：同时执行的智能体调用不超过 max_workers 个
+    - 令牌桶限速：每个任务开始前取一个令牌，避免触发模型服务的限流；
+      通过 throttle() 包装过后端之后改为每一次后端请求取一个令牌（一个任务内可能有多次请求，例如长文档的分段审阅）
+    - 会话间公平：每个会话一个队列，工作线程按会话轮流取任务，一个会话提交再多也不会饿死其他会话
+    - 队列深度上限：排队的任务超过 max_queue 时拒绝新的提交（QueueFullError）
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 max_queue=DEFAULT_MAX_QUEUE):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.bucket = TokenBucket(rate, burst)
+        # 按后端请求计量时为 True（见 throttle），任务本身不再取令牌
+        self.meters_requests = False
+        self._backend_slots = threading.BoundedSemaphore(max_workers)
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self._queues = OrderedDict()  # session_id -> deque[Ticket]，顺序即轮转顺序
+        self._depth = 0
+        self._running = 0
+        self._cond = threading.Condition()
+        self._workers = []
+
+    def _ensure_workers(self):
+        # 工作线程在第一次提交时才启动
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._work, name=f"scheduler-{len(self._workers)}", daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def throttle(self, backend):
+        """
+        用调度器的令牌桶和并发上限包装一个后端：经过它的每一次请求都取一个令牌、占一个并发名额，
+        一个任务内部再并发发出的请求（例如长文档的分段审阅）也受全局限速和并发上限约束
+        :return: ThrottledBackend
+        """
+        self.meters_requests = True
+        return ThrottledBackend(backend, bucket=self.bucket, slots=self._backend_slots)
+
+    def check_capacity(self, count=1):
+        """检查队列能否再接收 count 个任务，不能时抛出 QueueFullError"""
+        with self._cond:
+            if self._depth + count > self.max_queue:
+                self.rejected += count
+                raise QueueFullError(self._depth, self.max_queue)
+
+    def submit_many(self, session_id, fns):
+        """
+        原子地提交同一个会话的一组任务：要么全部入队，要么全部拒绝
+        :param session_id: 会话 ID，用于公平调度
+        :param fns: 无参可调用对象列表
+        :return: Ticket 列表
+        """
+        with self._cond:
+            if self._depth + len(fns) > self.max_queue:
+                self.rejected += len(fns)
+                raise QueueFullError(self._depth, self.max_queue)
+            self._ensure_workers()
+            tickets = [Ticket(self, session_id, fn) for fn in fns]
+            self._queues.setdefault(session_id, deque()).extend(tickets)
+            self._depth += len(tickets)
+            self.submitted += len(tickets)
+            self._cond.notify(len(tickets))
+            return tickets
+
+    def submit(self, session_id, fn):
+        return self.submit_many(session_id, [fn])[0]
+
+    def _next_ticket(self):
+        """按会话轮转取出下一个任务（调用方持有锁）"""
+        session_id, tickets = next(iter(self._queues.items()))
+        ticket = tickets.popleft()
+        # 取过任务的会话移到队尾，轮到其他会话
+        del self._queues[session_id]
+        if tickets:
+            self._queues[session_id] = tickets
+        self._depth -= 1
+        return ticket
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._depth:
+                    self._cond.wait()
+                ticket = self._next_ticket()
+                ticket.state = Ticket.RUNNING
+                self._running += 1
+            try:
+                if not self.meters_requests:
+                    self.bucket.acquire()
+                ticket.started_at = time.monotonic()
+                ticket.result = ticket.fn()
+            except Exception as e:
+                ticket.error = e
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self.completed += 1
+                ticket.state = Ticket.DONE
+                ticket._done.set()
+
+    def cancel(self, ticket):
+        with self._cond:
+            if ticket.state != Ticket.QUEUED:
+                return False
+            tickets = self._queues.get(ticket.session_id)
+            tickets.remove(ticket)
+            if not tickets:
+                del self._queues[ticket.session_id]
+            self._depth -= 1
+            ticket.state = Ticket.CANCELLED
+        ticket._done.set()
+        return True
+
+    def position(self, ticket):
+        """
+        按轮转规则计算排在 ticket 前面的任务数
+        设它是所在会话队列中的第 i 个：轮转顺序在它之前的会话最多还会先执行 i + 1 个任务，之后的会话最多 i 个
+        """
+        with self._cond:
+            if ticket.state != Ticket.QUEUED:
+                return 0
+            own = self._queues[ticket.session_id]
+            index = own.index(ticket)
+            ahead = index
+            before = True
+            for session_id, tickets in self._queues.items():
+                if session_id == ticket.session_id:
+                    before = False
+                    continue
+                ahead += min(len(tickets), index + 1 if before else index)
+            return ahead
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": self._depth,
+                "running": self._running,
+                "sessions_waiting": len(self._queues),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    进程级共享的调度器
+    通过环境变量配置：SCHEDULER_WORKERS（并发数，默认 16）、SCHEDULER_RATE（每秒请求数，默认 10）、
+    SCHEDULER_BURST（突发上限，默认 20）、SCHEDULER_MAX_QUEUE（排队上限，默认 300）
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler(
+                max_workers=int(os.getenv("SCHEDULER_WORKERS", str(DEFAULT_WORKERS))),
+                rate=float(os.getenv("SCHEDULER_RATE", str(DEFAULT_RATE))),
+                burst=int(os.getenv("SCHEDULER_BURST", str(DEFAULT_BURST))),
+                max_queue=int(os.getenv("SCHEDULER_MAX_QUEUE", str(DEFAULT_MAX_QUEUE)))
+            )
+        return _scheduler
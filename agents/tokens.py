@@ -0,0 +1,45 @@
+# agents/tokens.py
+import re
+
+# 中日韩字符（含全角标点）大致一个字符一个 token
+_CJK_RE = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+# 每条消息的角色、分隔符等额外开销
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text):
+    """
+    不依赖网络的 token 数估算
+    中文按每个字符 1 个 token 计，其余文本（英文、数字、代码）按每 4 个字符 1 个 token 计，
+    对 Qwen 系列模型来说略偏保守
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def estimate_messages_tokens(messages):
+    """估算消息列表的总 token 数"""
+    return sum(estimate_tokens(m.get("content", "")) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    截取 text 的最长前缀，使其估算 token 数不超过 max_tokens
+    按前缀长度二分查找，估算值随前缀变长单调不减
+    """
+    if max_tokens <= 0 or not text:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, min(len(text), max_tokens * 4)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
@@ -1,8 +1,15 @@
 from .base_agent import BaseAgent
-import re
-import json
+from .mermaid import validate, strip_fences, MermaidError, get_diagram_cache
 
 class VisualizerAgent(BaseAgent):
+    # 草稿只改了几个字时图表结构不会变，复用上次的结果
+    use_similarity_cache = True
+
+    def __init__(self, *args, diagram_cache=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 已校验图表的缓存（按草稿哈希），默认使用进程共享的缓存
+        self.diagram_cache = diagram_cache or get_diagram_cache()
+
     def get_system_prompt(self):
         return (
             f"你是 {self.name}，一个擅长逻辑可视化的设计师。"
@@ -17,48 +24,105 @@ class VisualizerAgent(BaseAgent):
             "7. 必须严格输出有效的Mermaid代码，确保图表能正确渲染。"
         )
 
-    def process(self, user_content, conversation_history=None):
+    def process(self, user_content, conversation_history=None, context_material=None):
+        # 同一份草稿已经有校验过的图表时，既不调用模型也不再校验
+        cached = self.diagram_cache.get(user_content)
+        if cached is not None:
+            return cached
         try:
             # 调用基类获取原始响应，传递conversation_history参数
-            response_text = super().process(user_content, conversation_history=conversation_history)
-            
-            # 清洗数据：有时候模型还是会忍不住加 ```mermaid，我们手动去掉它
-            clean_code = re.sub(r'```mermaid', '', response_text)
-            clean_code = re.sub(r'```', '', clean_code)
-            clean_code = clean_code.strip()
-            
-            # 添加错误检查和回退机制
-            if not clean_code or len(clean_code) < 10:
-                # 如果模型返回的代码太短或无效，生成一个更合理的默认图表
-                print(f"Warning: Received short or empty mermaid code: '{clean_code}'")
-                # 分析用户输入内容生成更有意义的图表
-                if "工业革命" in user_content or "蒸汽机" in user_content:
-                    return "graph TD\n    A[工业革命] --> B[蒸汽机]\n    A --> C[社会结构改变]\n    C --> D[城市化加快]"
-                elif "大学" in user_content:
-                    return "mindmap\n    root[大学教育]\n        就业压力大\n        管理复杂化\n        课程信息化\n        管理对象变化\n        学生自主性"
-                else:
-                    # 根据内容长度决定图表类型
-                    if len(user_content) > 50:  # 内容较长，适合流程图
-                        return "graph TD\n    A[主题] --> B[要点1]\n    A --> C[要点2]\n    B --> D[细节1]\n    C --> E[细节2]"
-                    else:  # 内容较短，适合思维导图
-                        return "mindmap\n    root[主要概念]\n        概念1\n        概念2\n        概念3\n        概念4\n        概念5"
-            
-            # 确保代码以正确的图表类型开始
-            if not (clean_code.startswith('graph') or clean_code.startswith('mindmap')):
-                # 如果没有正确的图表类型声明，根据内容选择合适的图表类型
-                print(f"Warning: Mermaid code doesn't start with graph or mindmap: '{clean_code}'")
-                if "工业革命" in user_content or "蒸汽机" in user_content:
-                    return "graph TD\n    A[工业革命] --> B[蒸汽机]\n    A --> C[社会结构改变]\n    C --> D[城市化加快]"
-                else:
-                    return "mindmap\n    root[主要概念]\n        概念1\n        概念2\n        概念3\n        概念4\n        概念5"
-            
-            return clean_code
+            response_text = super().process(
+                user_content, context_material=context_material, conversation_history=conversation_history
+            )
+            return self.finalize(response_text, user_content)
         except Exception as e:
             # 捕获所有异常并返回一个有意义的默认图表
             print(f"Error in VisualizerAgent.process: {str(e)}")
-            # 根据内容选择合适的默认图表
-            if "工业革命" in user_content or "蒸汽机" in user_content:
-                return "graph TD\n    A[工业革命] --> B[蒸汽机]\n    A --> C[社会结构改变]\n    C --> D[城市化加快]"
-            else:
-                return "mindmap\n    root[主要概念]\n        概念1\n        概念2\n        概念3\n        概念4\n        概念5"
+            return self.default_chart(user_content)
+
+    def stream(self, user_content, conversation_history=None, context_material=None):
+        """
+        流式接口：图表代码必须完整才能渲染，因此先缓冲全部分片，
+        校验（必要时修复）后一次性产出
+        """
+        cached = self.diagram_cache.get(user_content)
+        if cached is not None:
+            yield cached
+            return
+        try:
+            chunks = list(super().stream(
+                user_content, context_material=context_material, conversation_history=conversation_history
+            ))
+            # 基类出错时最后产出一段 "Error: ..."，前面可能已有不完整的代码，拼起来会被当成图表送去修复
+            if chunks and chunks[-1].startswith("Error:"):
+                print(f"Error in VisualizerAgent.stream: {chunks[-1]}")
+                yield self.default_chart(user_content)
+                return
+            yield self.finalize("".join(chunks), user_content)
+        except Exception as e:
+            print(f"Error in VisualizerAgent.stream: {str(e)}")
+            yield self.default_chart(user_content)
+
+    def lookup_cached(self, user_content, context_material=None, conversation_history=None):
+        cached = self.diagram_cache.get(user_content)
+        if cached is not None:
+            return cached
+        return super().lookup_cached(user_content, context_material, conversation_history)
+
+    def store_reply(self, user_content, context_material, conversation_history, reply):
+        """reply 必须是已经校验过的图表代码"""
+        self.diagram_cache.put(user_content, reply)
+        super().store_reply(user_content, context_material, conversation_history, reply)
+
+    def finalize(self, response_text, user_content):
+        """
+        校验并规范化模型输出的 Mermaid 代码
+        不合法时把具体的解析错误发给模型修复一次，仍不合法（或模型调用出错）时回退到默认图表；
+        校验通过的图表按草稿缓存
+        """
+        if response_text.startswith("Error:"):
+            return self.default_chart(user_content)
+        try:
+            code = validate(response_text)
+        except MermaidError as e:
+            print(f"Warning: invalid mermaid code ({e}), requesting repair")
+            code = self.repair(response_text, e)
+            if code is None:
+                return self.default_chart(user_content)
+        self.diagram_cache.put(user_content, code)
+        return code
+
+    def repair(self, code, error):
+        """
+        请模型修复一段不合法的 Mermaid 代码：只发送代码和解析错误，不带草稿和对话历史，只尝试一次
+        :return: 修复并校验通过的代码，失败时返回 None
+        """
+        record = self._new_record(streamed=False)
+        try:
+            response = self.backend.complete(self.model_name, [
+                {
+                    "role": "system",
+                    "content": (
+                        "你是 Mermaid 语法修复助手。请修复用户给出的 Mermaid 代码中的语法错误，"
+                        "保持图的结构和节点文字不变，只输出修复后的纯代码，不要包含 ```mermaid 标记或任何解释。"
+                    )
+                },
+                {"role": "user", "content": f"解析错误：{error}\n\n代码：\n{strip_fences(code).strip()}"},
+            ])
+            record.first_byte()
+            record.add_usage(response.usage)
+            record.retries += response.retries
+            return validate(response.text)
+        except Exception as e:
+            self._record_error(record, e)
+            print(f"Warning: mermaid repair failed: {e}")
+            return None
+        finally:
+            self.metrics.record(record.finish())
 
+    def default_chart(self, user_content):
+        """根据内容选择合适的默认图表（模型异常或超时时使用）"""
+        if "工业革命" in user_content or "蒸汽机" in user_content:
+            return "graph TD\n    A[工业革命] --> B[蒸汽机]\n    A --> C[社会结构改变]\n    C --> D[城市化加快]"
+        else:
+            return "mindmap\n    root[主要概念]\n        概念1\n        概念2\n        概念3\n        概念4\n        概念5"
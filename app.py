@@ -1,10 +1,58 @@
 # app.py
 import streamlit as st
 import streamlit.components.v1 as components
-import json
-from agents.reviewer import ReviewerAgent
-from agents.researcher import ResearcherAgent
-from agents.visualizer import VisualizerAgent  # 导入新角色
+import os
+import time
+import uuid
+from profiling import StartupTimer, get_startup_profile, profiling_enabled
+
+# 冷启动计时从这里开始：下面的导入只在进程第一次运行脚本时真正执行（见 profiling.py）
+startup = StartupTimer()
+
+from agents.registry import get_shared_agents
+from agents.parallel import stream_parallel
+from agents.live import LiveReviewController
+from agents.prefetch import SpeculativePrefetcher
+from agents.orchestrator import get_combined_reviewer
+from agents.diffing import incremental_content, compact_history
+from agents.mapreduce import MapReduceReviewer, LONG_DRAFT_CHARS
+from agents.scheduler import get_scheduler, QueueFullError
+from agents.cache import get_default_cache
+from agents.documents import extract_text, get_cached_text
+from agents.retrieval import get_document_index, build_context
+from agents.metrics import get_registry, serve_metrics
+from rendering import build_mermaid_html, build_mermaid_feed_html, window_chat_history, CHAT_WINDOW_ROUNDS
+from storage import get_session_cache
+from agents.backends import warm_up_in_background
+
+startup.mark("imports")
+
+# 每个智能体的超时时间（秒），超时的智能体不会拖慢其他智能体
+AGENT_TIMEOUTS = {"mark": 60, "amy": 60, "susu": 60}
+
+# 每轮发送给智能体的参考资料片段数
+RETRIEVAL_TOP_K = 4
+
+# 只收到草稿差异（而不是全文）的智能体
+DIFF_REVIEW_AGENTS = ("mark", "amy")
+
+# 长草稿按章节分段、并发审阅的智能体
+LONG_REVIEW_AGENTS = ("mark", "amy")
+
+# 合并模式下每个角色的超时时间（秒）：一次请求要生成三个角色的全部回复，比单独调用慢
+COMBINED_TIMEOUT = 90
+
+# 流式输出时同一个气泡两次刷新之间的最小间隔（秒）
+STREAM_RENDER_INTERVAL = 0.1
+
+# 实时点评：草稿停止变化多少秒后自动点评，以及界面检查进度的间隔（秒）
+LIVE_DEBOUNCE = 2.0
+LIVE_POLL_INTERVAL = 1.0
+
+# 设置环境变量 METRICS_PORT 后，在该端口提供 /metrics（Prometheus）和 /calls.jsonl；
+# 默认只监听本机，METRICS_HOST 可以改为其他地址（例如容器中用 0.0.0.0）
+if os.getenv("METRICS_PORT"):
+    serve_metrics(int(os.getenv("METRICS_PORT")), host=os.getenv("METRICS_HOST", "127.0.0.1"))
 
 # --- 辅助函数：渲染 Mermaid 图表 ---
 def render_mermaid(code, sender_info=None, debug=False):
@@ -16,7 +64,7 @@ def render_mermaid(code, sender_info=None, debug=False):
         # 显示调试信息
         st.write("**Mermaid代码调试信息：**")
         st.write(f"- 代码长度: {len(code)} 字符")
-        st.write(f"- 代码格式: {'有效' if code.strip().startswith(('graph', 'mindmap')) else '无效'}")
+        st.write(f"- 代码格式: {'有效' if code.strip().startswith(('graph', 'flowchart', 'mindmap')) else '无效'}")
         st.code(code, language='mermaid')
     
     # 检查代码是否为空
@@ -26,152 +74,205 @@ def render_mermaid(code, sender_info=None, debug=False):
         return
         
     # 确保代码包含正确的图表类型声明
-    if not (code.strip().startswith('graph') or code.strip().startswith('mindmap')):
+    if not code.strip().startswith(('graph', 'flowchart', 'mindmap')):
         if debug:
-            st.warning("Mermaid代码格式不正确，请检查是否包含 'graph' 或 'mindmap' 声明")
+            st.warning("Mermaid代码格式不正确，请检查是否包含 'graph'、'flowchart' 或 'mindmap' 声明")
     
-    # 准备头部信息
-    header_html = ""
-    box_style = ""
-    if sender_info:
-        name = sender_info.get('name', '苏苏')
-        role = sender_info.get('role', '视觉设计师')
-        timestamp = sender_info.get('timestamp', '')
-        
-        # 使用新的CSS类样式
-        header_html = f"""
+    html_code, estimated_height = build_mermaid_html(code, sender_info, st.get_option("server.baseUrlPath"))
+
+    # 使用估算的高度
+    if debug:
+        st.write(f"**图表渲染结果 (高度: {estimated_height}px)：**")
+    components.html(html_code, height=estimated_height, scrolling=True)
+
+def render_mermaid_feed(diagrams):
+    """
+    把聊天窗口中的所有图表渲染在同一个组件中，mermaid.js 只加载一次
+    :param diagrams: [(Mermaid 代码, 发送者信息)]
+    """
+    diagrams = [(code, sender_info) for code, sender_info in diagrams if code and code.strip()]
+    if not diagrams:
+        return
+    html_code, estimated_height = build_mermaid_feed_html(diagrams, st.get_option("server.baseUrlPath"))
+    components.html(html_code, height=estimated_height, scrolling=True)
+
+# --- 辅助函数：渲染单条聊天消息 ---
+def render_chat_message(message):
+    """根据发送者渲染一条聊天气泡"""
+    sender = message["sender"]
+    name = message["name"]
+    content = message["content"]
+    timestamp = message["timestamp"]
+
+    # 根据发送者设置不同的样式
+    if sender == "user":
+        st.markdown(f"""
+        <div class="chat-bubble user-bubble">
+            <div class="bubble-header" style="justify-content: flex-end;">
+                <small style="color: gray; margin-right: 8px;">{timestamp}</small>
+                <strong style="color: #1565c0;">{name}</strong>
+                <span class="avatar" style="background-color: #bbdefb; margin-left: 8px; margin-right: 0;">👤</span>
+            </div>
+            <div style="color: #333; text-align: right;">{content}</div>
+        </div>
+        """, unsafe_allow_html=True)
+    elif sender == "mark":
+        st.markdown(f"""
+        <div class="chat-bubble assistant-bubble role-mark">
             <div class="bubble-header">
-                <span class="avatar" style="background-color: #fff3e0;">🎨</span>
-                <strong style="color: #f57c00;">{name}</strong>
-                <span style="background-color: #fff3e0; color: #f57c00; padding: 2px 8px; border-radius: 10px; font-size: 0.8em; margin-left: 8px;">{role}</span>
+                <span class="avatar" style="background-color: #e3f2fd;">🧠</span>
+                <strong style="color: #1976d2;">{name}</strong> 
+                <span style="background-color: #e3f2fd; color: #1976d2; padding: 2px 8px; border-radius: 10px; font-size: 0.8em; margin-left: 8px;">逻辑审核员</span>
                 <small style="color: gray; margin-left: auto;">{timestamp}</small>
             </div>
-        """
-        # 使用新的CSS类样式
-        box_class = "chat-bubble assistant-bubble role-susu"
-    else:
-        box_class = "mermaid"
-    
-    # 估算高度：基础高度 + 每行代码增加的高度
-    # 这是一个简单的启发式方法，避免固定高度导致的巨大空白
-    line_count = len(code.strip().split('\n'))
-    estimated_height = max(200, min(600, line_count * 40 + 100))
-    
-    # 使用最简单直接的方式加载mermaid.js
-    # 简化HTML代码，避免复杂的DOM加载事件
-    # 注意：我们需要将CSS样式注入到iframe中，因为iframe不继承父页面的样式
-    html_code = f"""
-    <style>
-        body {{
-            font-family: "Helvetica Neue", Helvetica, Arial, sans-serif;
-            margin: 0;
-            padding: 10px;
-            overflow: hidden; /* 隐藏滚动条，除非必要 */
-        }}
-        /* 聊天气泡基础样式 */
-        .chat-bubble {{
-            padding: 15px;
-            border-radius: 15px;
-            margin-bottom: 0; /* 移除内部margin，由iframe高度控制 */
-            box-shadow: 0 2px 5px rgba(0,0,0,0.05);
-            position: relative;
-        }}
-        
-        /* 助手气泡通用 */
-        .assistant-bubble {{
-            background-color: #ffffff;
-            border-bottom-left-radius: 2px;
-            margin-right: 10%;
-            border: 1px solid #f0f0f0;
-        }}
-        
-        /* 角色特定样式 */
-        .role-susu {{ border-left: 4px solid #ff9800; }}
-        
-        /* 头部信息 */
-        .bubble-header {{
-            display: flex;
-            align-items: center;
-            margin-bottom: 8px;
-            font-size: 0.9em;
-        }}
-        
-        .avatar {{
-            width: 24px;
-            height: 24px;
-            border-radius: 50%;
-            display: inline-flex;
-            align-items: center;
-            justify-content: center;
-            margin-right: 8px;
-            font-size: 14px;
-        }}
-    </style>
-    <div class="{box_class}">
-        {header_html}
-        <div class="mermaid">
-        {code}
+            <div style="color: #333; line-height: 1.6;">{content}</div>
+        </div>
+        """, unsafe_allow_html=True)
+    elif sender == "amy":
+        st.markdown(f"""
+        <div class="chat-bubble assistant-bubble role-amy">
+            <div class="bubble-header">
+                <span class="avatar" style="background-color: #e8f5e9;">📊</span>
+                <strong style="color: #388e3c;">{name}</strong>
+                <span style="background-color: #e8f5e9; color: #388e3c; padding: 2px 8px; border-radius: 10px; font-size: 0.8em; margin-left: 8px;">数据资料员</span>
+                <small style="color: gray; margin-left: auto;">{timestamp}</small>
+            </div>
+            <div style="color: #333; line-height: 1.6;">{content}</div>
         </div>
-    </div>
-    <script src="https://cdn.jsdelivr.net/npm/mermaid@10.9.0/dist/mermaid.min.js"></script>
-    <script>
-        // 直接初始化，不等待DOM加载完成
-        mermaid.initialize({{ startOnLoad: true, theme: 'default' }});
-        mermaid.init();
-    </script>
+        """, unsafe_allow_html=True)
+    elif sender == "susu":
+        # 渲染 Mermaid 图表，包含发送者信息以便包装在同一个框内
+        render_mermaid(content, sender_info=diagram_sender_info(message), debug=False)
+
+def diagram_sender_info(message):
+    """苏苏的图表气泡头部信息"""
+    return {"name": message["name"], "role": "视觉设计师", "timestamp": message["timestamp"]}
+
+# --- 辅助函数：读取上传文件 ---
+def read_uploaded_file(uploaded_file):
     """
-    
-    # 使用估算的高度
-    if debug:
-        st.write(f"**图表渲染结果 (高度: {estimated_height}px)：**")
-    components.html(html_code, height=estimated_height, scrolling=True)
+    提取上传文件的文本
+    结果按文件内容哈希缓存，重新运行时不会再次解析；首次解析 PDF 时显示进度条
+    """
+    data = uploaded_file.getvalue()
+    if not uploaded_file.name.lower().endswith('.pdf') or get_cached_text(data) is not None:
+        return extract_text(uploaded_file.name, data)
 
-# --- 辅助函数：本地存储对话历史 ---
-def save_conversation_history():
-    """将对话历史保存到localStorage"""
-    # 保存统一的聊天记录格式
-    conversation_data = {
-        "mark": st.session_state.conversation_history["mark"],
-        "amy": st.session_state.conversation_history["amy"],
-        "susu": st.session_state.conversation_history["susu"],
-        "chat": st.session_state.chat_history  # 保存统一的聊天记录
-    }
-    st.session_state.storage_data = json.dumps(conversation_data)
+    progress_bar = st.progress(0.0, text=f"正在解析 {uploaded_file.name}...")
+    try:
+        return extract_text(
+            uploaded_file.name,
+            data,
+            progress=lambda done, total: progress_bar.progress(
+                done / total, text=f"正在解析 {uploaded_file.name}（{done}/{total} 页）"
+            )
+        )
+    finally:
+        progress_bar.empty()
 
-def load_conversation_history():
-    """从localStorage加载对话历史"""
-    if "storage_data" in st.session_state and st.session_state.storage_data:
-        try:
-            conversation_data = json.loads(st.session_state.storage_data)
-            st.session_state.conversation_history = {
-                "mark": conversation_data.get("mark", []),
-                "amy": conversation_data.get("amy", []),
-                "susu": conversation_data.get("susu", [])
-            }
-            # 加载统一的聊天记录
-            st.session_state.chat_history = conversation_data.get("chat", [])
-        except:
-            st.session_state.conversation_history = {
-                "mark": [],
-                "amy": [],
-                "susu": []
-            }
-            st.session_state.chat_history = []
+# --- 辅助函数：组织智能体的输入 ---
+def build_agent_inputs(draft, reference_indexes, session):
+    """
+    每个智能体本轮的输入 {key: (发送的内容, 参考资料片段, 对话历史副本)}
+    只把与草稿最相关的参考资料片段发给马克和艾米；苏苏只根据草稿本身作图。
+    马克和艾米在草稿只改了一小部分时只收到与上一次提交的差异，苏苏需要全文来画完整的图。
+    历史中被取代的旧版草稿换成占位说明；历史使用副本，后台线程不会读到本轮正在写入的内容
+    """
+    context_material = build_context(reference_indexes, draft, k=RETRIEVAL_TOP_K) or None
+    contexts = {"mark": context_material, "amy": context_material, "susu": None}
+    inputs = {}
+    for key in ("mark", "amy", "susu"):
+        history = compact_history(session.conversation_history[key])
+        content = incremental_content(draft, history)[0] if key in DIFF_REVIEW_AGENTS else draft
+        inputs[key] = (content, contexts[key], history)
+    return inputs
+
+def get_runner(key, content, draft, reference_indexes):
+    """
+    本轮实际调用的对象：长草稿全文交给马克和艾米时按章节分段并发审阅，每个分段检索自己的参考资料；
+    其他情况（包括只发送差异时）直接使用智能体
+    """
+    if key in LONG_REVIEW_AGENTS and content == draft and len(draft) >= LONG_DRAFT_CHARS:
+        return MapReduceReviewer(
+            agents[key],
+            context_for=lambda text: build_context(reference_indexes, text, k=RETRIEVAL_TOP_K) or None
+        )
+    return agents[key]
+
+# --- 辅助函数：实时点评 ---
+def get_live_controller():
+    """当前浏览器会话的实时点评控制器"""
+    if 'live_review' not in st.session_state:
+        st.session_state.live_review = LiveReviewController(
+            agents, scheduler=get_scheduler(), session_id=st.session_state.session_id,
+            debounce=LIVE_DEBOUNCE, timeout=AGENT_TIMEOUTS
+        )
+    return st.session_state.live_review
+
+# --- 辅助函数：预取 ---
+def get_prefetcher():
+    """当前浏览器会话的预取器"""
+    if 'prefetch' not in st.session_state:
+        st.session_state.prefetch = SpeculativePrefetcher(
+            agents, scheduler=get_scheduler(), session_id=st.session_state.session_id
+        )
+    return st.session_state.prefetch
+
+def prefetched_job(future, timeout):
+    """直接使用预取结果的任务：预取还没完成时等待它完成"""
+    return lambda: [future.result(timeout=timeout)]
+
+@st.fragment(run_every=LIVE_POLL_INTERVAL)
+def render_live_review(controller, inputs, runner_for):
+    """
+    实时点评面板：只有这个片段定时重新运行，不会重跑整个页面
+    草稿稳定后开始新一轮，显示各智能体的最新点评
+    """
+    controller.poll(inputs, runner_for=runner_for)
+    snapshot = controller.snapshot()
+    with st.container(border=True):
+        st.markdown("**⚡ 实时点评**（预览，不计入讨论记录）")
+        if snapshot["waiting"]:
+            st.caption("草稿有改动，停止输入后自动点评...")
+        elif not snapshot["replies"]:
+            st.caption("撰写草稿后自动点评（输入框失去焦点或按 Ctrl+Enter 后生效）")
+        for key, reply in snapshot["replies"].items():
+            name = agents[key].name
+            if reply["status"] == "queued":
+                st.caption(f"{name}：排队中，前面还有 {reply['position']} 个请求")
+            elif reply["status"] == "pending" or (key == "susu" and reply["status"] == "streaming"):
+                st.caption(f"{name}：思考中...")
+            elif reply["status"] == "cancelled":
+                st.caption(f"{name}：草稿已变化，本轮点评已取消")
+            else:
+                render_chat_message({"sender": key, "name": name, "content": reply["content"], "timestamp": "实时"})
+
+# --- 辅助函数：持久化对话历史 ---
+def get_session_id():
+    """会话 ID 保存在页面地址的 ?session= 参数中，刷新页面或重启服务后仍能找回历史"""
+    session_id = st.query_params.get("session")
+    if not session_id:
+        session_id = uuid.uuid4().hex
+        st.query_params["session"] = session_id
+    return session_id
+
+def get_session():
+    """
+    当前会话的历史（storage.SessionHistory）
+    历史保存在进程级的会话缓存中而不是 session_state 里：消息正文按内容共享，冷会话会被淘汰，
+    下次访问时再从会话存储加载
+    """
+    return get_session_cache(CHAT_WINDOW_ROUNDS).get(st.session_state.session_id)
 
 def clear_conversation_history():
     """清除对话历史"""
-    st.session_state.conversation_history = {
-        "mark": [],
-        "amy": [],
-        "susu": []
-    }
-    st.session_state.chat_history = []  # 清除统一的聊天记录
-    st.session_state.storage_data = ""
+    get_session_cache(CHAT_WINDOW_ROUNDS).clear(get_session())
     st.session_state.context_cleared = True
-    save_conversation_history()
+    st.session_state.chat_window_rounds = CHAT_WINDOW_ROUNDS
 
 # 1. 页面配置
-st.set_page_config(page_title="AI 小组讨论室", layout="wide", page_icon="🎓")
+# 图标使用 Material 图标：emoji 图标会让 Streamlit 加载完整的 emoji 表做校验，首次渲染多花约 0.1 秒
+st.set_page_config(page_title="AI 小组讨论室", layout="wide", page_icon=":material/school:")
 
 # --- 自定义 CSS ---
 st.markdown("""
@@ -285,37 +386,95 @@ st.title("🎓 AI 沉浸式学习小组")
 st.caption("你的全能虚拟助教团队：马克（逻辑）、艾米（数据）、苏苏（视觉）")
 st.markdown("---")
 
-# 2. 初始化智能体和对话历史
-if 'agents' not in st.session_state:
-    st.session_state.agents = {
-        "mark": ReviewerAgent(name="马克", role="逻辑审核员"),
-        "amy": ResearcherAgent(name="艾米", role="数据资料员"),
-        "susu": VisualizerAgent(name="苏苏", role="视觉设计师") # 新增苏苏
-    }
+# 智能体在进程内只创建一次，所有会话共享；所有会话共享同一个回复缓存，重复提交相同草稿时不再重新请求模型
+agents = get_shared_agents(cache=get_default_cache())
+startup.mark("agents")
 
-# 初始化对话历史
-if 'conversation_history' not in st.session_state:
-    st.session_state.conversation_history = {
-        "mark": [],
-        "amy": [],
-        "susu": []
-    }
+# --- 侧边栏：设置 ---
+with st.sidebar:
+    st.header("⚙️ 设置")
+    streaming_enabled = st.toggle(
+        "流式输出",
+        value=True,
+        help="边生成边显示马克和艾米的回复；苏苏的图表在代码完整后再渲染"
+    )
+    cache_stats = get_default_cache().stats()
+    st.caption(f"回复缓存：命中 {cache_stats['hits']} 次 / 未命中 {cache_stats['misses']} 次")
+    saved = sum(a.history_manager.saved_tokens for a in agents.values() if a.history_manager)
+    st.caption(f"历史压缩：累计节省约 {saved} tokens（所有会话）")
+    scheduler_stats = get_scheduler().stats()
+    st.caption(f"请求队列：排队 {scheduler_stats['queued']} 个 / 执行中 {scheduler_stats['running']} 个")
+    prefetch_enabled = st.toggle(
+        "🔮 上传后预先点评",
+        value=False,
+        help="上传的草稿解析完成后立即在后台请小组审阅，直接提交时不用再等；修改过草稿则作废重新请求。每个会话的预取花费有上限"
+    )
+    if prefetch_enabled and 'prefetch' in st.session_state:
+        prefetch_stats = st.session_state.prefetch.stats()
+        st.caption(
+            f"预取：直接使用 {prefetch_stats['used']} 次 / "
+            f"已用约 {prefetch_stats['spent_tokens']} / {prefetch_stats['budget_tokens']} tokens"
+        )
+    combined_enabled = st.toggle(
+        "🧩 合并请求",
+        value=False,
+        help="草稿和对话历史只发送一次，由一次请求同时得到三位助手的回复，节省输入 token；"
+             "回复不再逐字显示，解析失败的助手会单独重新请求。长草稿仍然分开审阅"
+    )
+    if combined_enabled:
+        combined_stats = get_combined_reviewer(agents).stats()
+        st.caption(
+            f"合并请求：{combined_stats['calls']} 次 / 直接使用 {combined_stats['sections']} 条 / "
+            f"单独补发 {combined_stats['fallbacks']} 条"
+        )
+    live_review_enabled = st.toggle(
+        "⚡ 实时点评",
+        value=False,
+        help=f"停止输入 {LIVE_DEBOUNCE:g} 秒后自动点评当前草稿；草稿再次变化时放弃上一轮，输入没变的助手不会重复请求"
+    )
+    if st.toggle("📈 显示性能指标", value=False):
+        metrics = get_registry()
+        rows = metrics.summary()
+        if rows:
+            st.dataframe(rows, hide_index=True)
+        else:
+            st.caption("暂无调用记录")
+        st.download_button(
+            "导出 Prometheus 指标",
+            data=metrics.to_prometheus(),
+            file_name="metrics.prom",
+            mime="text/plain"
+        )
+        st.download_button(
+            "导出调用明细（JSONL）",
+            data=metrics.to_jsonl(),
+            file_name="calls.jsonl",
+            mime="application/x-ndjson"
+        )
+    if profiling_enabled():
+        startup_summary = get_startup_profile().summary()
+        if startup_summary["process"]:
+            st.caption(
+                f"冷启动：导入 {startup_summary['process']['imports']} ms / "
+                f"首次渲染 {startup_summary['process']['total']} ms / "
+                f"新会话首屏中位数 {startup_summary['session_render_p50_ms']} ms"
+            )
 
-# 初始化统一聊天历史
-if 'chat_history' not in st.session_state:
-    st.session_state.chat_history = []
+# 2. 初始化对话历史
+# 初始化对话历史：会话历史在进程内缓存，只有第一次访问或被淘汰后才从会话存储加载
+new_session = 'session_id' not in st.session_state
+if new_session:
+    st.session_state.session_id = get_session_id()
+session = get_session()
 
-# 初始化存储数据
-if 'storage_data' not in st.session_state:
-    st.session_state.storage_data = ""
+# 聊天记录只渲染最近的若干轮，点击"加载更早的记录"时逐步展开
+if 'chat_window_rounds' not in st.session_state:
+    st.session_state.chat_window_rounds = CHAT_WINDOW_ROUNDS
 
 # 初始化上下文清除状态
 if 'context_cleared' not in st.session_state:
     st.session_state.context_cleared = False
 
-# 加载对话历史
-load_conversation_history()
-
 # 3. 布局：双栏设计
 col_editor, col_feedback = st.columns([1, 1]) 
 
@@ -334,21 +493,37 @@ with col_editor:
     file_content = ""
     if uploaded_file is not None:
         try:
-            if uploaded_file.name.endswith('.pdf'):
-                # 处理PDF文件
-                import PyPDF2
-                pdf_reader = PyPDF2.PdfReader(uploaded_file)
-                file_content = ""
-                for page in pdf_reader.pages:
-                    file_content += page.extract_text() + "\n"
-            else:
-                # 处理文本文件
-                file_content = uploaded_file.read().decode("utf-8")
-            
+            file_content = read_uploaded_file(uploaded_file)
             st.success(f"✅ 文件 {uploaded_file.name} 上传成功！")
         except Exception as e:
             st.error(f"❌ 文件处理出错: {str(e)}")
             file_content = ""
+
+    # 参考资料上传：建立检索索引，每轮只把与草稿相关的片段发送给智能体
+    reference_files = st.file_uploader(
+        "📚 上传参考资料（可选）",
+        type=["txt", "pdf", "md"],
+        accept_multiple_files=True,
+        key="reference_uploader"
+    )
+    reference_indexes = []
+    for reference_file in reference_files or []:
+        try:
+            reference_text = read_uploaded_file(reference_file)
+            reference_indexes.append(get_document_index(reference_text, name=reference_file.name))
+        except Exception as e:
+            st.error(f"❌ 参考资料 {reference_file.name} 处理出错: {str(e)}")
+    if reference_indexes:
+        chunk_count = sum(len(index.chunks) for index in reference_indexes)
+        st.caption(f"已索引 {len(reference_indexes)} 份参考资料，共 {chunk_count} 个片段")
+
+    # 预取：上传的草稿解析完成后立即在后台审阅，同一份草稿只预取一次
+    if prefetch_enabled and file_content:
+        get_prefetcher().start(
+            file_content,
+            lambda draft: build_agent_inputs(draft, reference_indexes, session),
+            runner_for=lambda key, content, draft=file_content: get_runner(key, content, draft, reference_indexes)
+        )
     
     user_draft = st.text_area(
         "在此撰写内容...",
@@ -357,6 +532,16 @@ with col_editor:
         value=file_content
     )
     
+    # 实时点评：记录最新草稿，草稿变化时作废正在进行的一轮
+    if live_review_enabled:
+        get_live_controller().update(user_draft)
+    elif 'live_review' in st.session_state:
+        st.session_state.live_review.cancel()
+
+    # 草稿被修改后，预取的结果不再适用
+    if 'prefetch' in st.session_state:
+        st.session_state.prefetch.retain(user_draft)
+
     # 创建按钮列布局
     button_col1, button_col2 = st.columns([3, 1])
     
@@ -381,92 +566,136 @@ with col_editor:
 # --- 右侧：AI 反馈区 ---
 with col_feedback:
     st.subheader("💬 小组讨论记录")
+
+    if live_review_enabled:
+        render_live_review(
+            get_live_controller(),
+            lambda draft, indexes=reference_indexes, session=session: build_agent_inputs(draft, indexes, session),
+            # 与正式提交相同的选择：长草稿由 MapReduceReviewer 按章节审阅
+            lambda draft, key, content, indexes=reference_indexes: get_runner(key, content, draft, indexes)
+        )
     
     # 显示聊天历史
     chat_container = st.container()
     
     with chat_container:
         # 如果有聊天历史，则显示
-        if st.session_state.chat_history:
-            for message in st.session_state.chat_history:
-                sender = message["sender"]
-                name = message["name"]
-                content = message["content"]
-                timestamp = message["timestamp"]
-                
-                # 根据发送者设置不同的样式
-                if sender == "user":
-                    st.markdown(f"""
-                    <div class="chat-bubble user-bubble">
-                        <div class="bubble-header" style="justify-content: flex-end;">
-                            <small style="color: gray; margin-right: 8px;">{timestamp}</small>
-                            <strong style="color: #1565c0;">{name}</strong>
-                            <span class="avatar" style="background-color: #bbdefb; margin-left: 8px; margin-right: 0;">👤</span>
-                        </div>
-                        <div style="color: #333; text-align: right;">{content}</div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                elif sender == "mark":
-                    st.markdown(f"""
-                    <div class="chat-bubble assistant-bubble role-mark">
-                        <div class="bubble-header">
-                            <span class="avatar" style="background-color: #e3f2fd;">🧠</span>
-                            <strong style="color: #1976d2;">{name}</strong> 
-                            <span style="background-color: #e3f2fd; color: #1976d2; padding: 2px 8px; border-radius: 10px; font-size: 0.8em; margin-left: 8px;">逻辑审核员</span>
-                            <small style="color: gray; margin-left: auto;">{timestamp}</small>
-                        </div>
-                        <div style="color: #333; line-height: 1.6;">{content}</div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                elif sender == "amy":
-                    st.markdown(f"""
-                    <div class="chat-bubble assistant-bubble role-amy">
-                        <div class="bubble-header">
-                            <span class="avatar" style="background-color: #e8f5e9;">📊</span>
-                            <strong style="color: #388e3c;">{name}</strong>
-                            <span style="background-color: #e8f5e9; color: #388e3c; padding: 2px 8px; border-radius: 10px; font-size: 0.8em; margin-left: 8px;">数据资料员</span>
-                            <small style="color: gray; margin-left: auto;">{timestamp}</small>
-                        </div>
-                        <div style="color: #333; line-height: 1.6;">{content}</div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                elif sender == "susu":
-                    # 渲染 Mermaid 图表，包含发送者信息以便包装在同一个框内
-                    render_mermaid(content, sender_info={"name": name, "role": "视觉设计师", "timestamp": timestamp}, debug=False)
+        if session.chat_history:
+            hidden_rounds, visible_messages = window_chat_history(
+                session.chat_history, st.session_state.chat_window_rounds
+            )
+            if hidden_rounds or session.has_more:
+                label = f"⬆️ 加载更早的记录（还有 {hidden_rounds} 轮）" if hidden_rounds else "⬆️ 加载更早的记录"
+                if st.button(label, key="load_earlier"):
+                    if not hidden_rounds:
+                        get_session_cache(CHAT_WINDOW_ROUNDS).load_earlier(session)
+                    st.session_state.chat_window_rounds += CHAT_WINDOW_ROUNDS
+                    st.rerun()
+            # 文字气泡按顺序显示，窗口内苏苏的图表集中在一个组件中渲染（只加载一次 mermaid.js）
+            diagrams = []
+            for message in visible_messages:
+                if message["sender"] == "susu":
+                    diagrams.append((message["content"], diagram_sender_info(message)))
+                else:
+                    render_chat_message(message)
+            render_mermaid_feed(diagrams)
         else:
             st.info("还没有讨论记录，提交草稿开始与AI助手们的对话吧！")
     
     # 处理用户提交
     if start_review and user_draft:
+        # 全局队列已满时直接拒绝，不记录本轮草稿
+        scheduler = get_scheduler()
+        try:
+            scheduler.check_capacity(len(AGENT_TIMEOUTS))
+        except QueueFullError as e:
+            st.warning(f"⏳ 当前提交的同学太多了：{e}")
+            st.stop()
+
+        # 正式提交后不再需要正在进行的实时点评
+        if 'live_review' in st.session_state:
+            st.session_state.live_review.cancel()
+
+        # 先记录并显示用户的草稿
+        sessions = get_session_cache(CHAT_WINDOW_ROUNDS)
+        user_message = sessions.add_user_message(session, "user", "你", user_draft, "刚刚")
+        with chat_container:
+            render_chat_message(user_message)
+
+        # 输入与实时点评相同，实时点评已经完成的智能体会直接命中回复缓存
+        inputs = build_agent_inputs(user_draft, reference_indexes, session)
+        # 草稿与上传时预取的相同、输入也没变的智能体直接使用预取结果
+        prefetched = get_prefetcher().claim(user_draft, inputs) if 'prefetch' in st.session_state else {}
+        if streaming_enabled:
+            jobs = {
+                key: (lambda runner=get_runner(key, content, user_draft, reference_indexes), content=content, context=context,
+                      history=history: runner.stream(content, context_material=context, conversation_history=history))
+                for key, (content, context, history) in inputs.items()
+            }
+        else:
+            # 非流式模式：完整回复作为唯一的分片
+            jobs = {
+                key: (lambda runner=get_runner(key, content, user_draft, reference_indexes), content=content, context=context,
+                      history=history: [runner.process(content, context_material=context, conversation_history=history)])
+                for key, (content, context, history) in inputs.items()
+            }
+        timeouts = dict(AGENT_TIMEOUTS)
+        # 合并模式：草稿不长时由一次请求得到各位助手的回复，整轮在调度器中只占一个任务；
+        # 已经有预取结果的助手不参与合并，只剩一位时照常单独请求
+        if combined_enabled and len(user_draft) < LONG_DRAFT_CHARS:
+            pending = {key: value for key, value in inputs.items() if key not in prefetched}
+            if len(pending) > 1:
+                fallback_jobs = {key: jobs.pop(key) for key in pending}
+                combined_round = get_combined_reviewer(agents).start(user_draft, pending, fallback_jobs)
+                jobs[tuple(pending)] = combined_round.run
+                timeouts.update({key: COMBINED_TIMEOUT for key in pending})
+        jobs.update({key: prefetched_job(future, AGENT_TIMEOUTS[key]) for key, future in prefetched.items()})
+
         with st.spinner("小组正在头脑风暴中..."):
-            # 获取每个agent的历史对话
-            mark_history = st.session_state.conversation_history["mark"]
-            amy_history = st.session_state.conversation_history["amy"]
-            susu_history = st.session_state.conversation_history["susu"]
-            
-            # 并行处理（在简单的 Streamlit 结构中顺序执行即可，速度很快）
-            review_res = st.session_state.agents['mark'].process(user_draft, conversation_history=mark_history)
-            data_res = st.session_state.agents['amy'].process(user_draft, conversation_history=amy_history)
-            visual_res = st.session_state.agents['susu'].process(user_draft, conversation_history=susu_history)
-            
-            # 保存对话历史
-            st.session_state.conversation_history["mark"].append({"role": "user", "content": user_draft})
-            st.session_state.conversation_history["mark"].append({"role": "assistant", "content": review_res})
-            
-            st.session_state.conversation_history["amy"].append({"role": "user", "content": user_draft})
-            st.session_state.conversation_history["amy"].append({"role": "assistant", "content": data_res})
-            
-            st.session_state.conversation_history["susu"].append({"role": "user", "content": user_draft})
-            st.session_state.conversation_history["susu"].append({"role": "assistant", "content": visual_res})
-            
-            # 添加到统一聊天历史
-            st.session_state.chat_history.append({"sender": "user", "name": "你", "content": user_draft, "timestamp": "刚刚"})
-            st.session_state.chat_history.append({"sender": "mark", "name": st.session_state.agents['mark'].name, "content": review_res, "timestamp": "刚刚"})
-            st.session_state.chat_history.append({"sender": "amy", "name": st.session_state.agents['amy'].name, "content": data_res, "timestamp": "刚刚"})
-            st.session_state.chat_history.append({"sender": "susu", "name": st.session_state.agents['susu'].name, "content": visual_res, "timestamp": "刚刚"})
-            
-            # 保存到localStorage
-            save_conversation_history()
-            
-            # 重新运行以更新界面
-            st.rerun()
\ No newline at end of file
+            replies = {}
+            placeholders = {}
+            last_render = {}
+            # 并行处理：三个智能体同时请求，收到第一段输出时创建气泡，之后逐步刷新
+            queue_positions = {}
+            with chat_container:
+                queue_status = st.empty()
+            # 所有会话的请求都经过全局调度器：限速、限制并发，并在会话之间轮流执行
+            for event, key, payload in stream_parallel(jobs, timeout=timeouts, scheduler=scheduler,
+                                                       session_id=st.session_state.session_id):
+                if event == "queued":
+                    queue_positions[key] = payload
+                    queue_status.info(f"⏳ 排队中：前面还有 {min(queue_positions.values())} 个请求")
+                    continue
+                if queue_positions.pop(key, None) is not None and not queue_positions:
+                    queue_status.empty()
+
+                if key not in replies:
+                    replies[key] = {"sender": key, "name": agents[key].name, "content": "", "timestamp": "刚刚"}
+                    with chat_container:
+                        placeholders[key] = st.empty()
+                    last_render[key] = 0
+                message = replies[key]
+
+                if event == "delta":
+                    message["content"] += payload
+                    if time.monotonic() - last_render[key] < STREAM_RENDER_INTERVAL:
+                        continue
+                else:
+                    if event == "error":
+                        # 超时或异常时：苏苏使用默认图表，其他人显示错误信息
+                        message["content"] = agents[key].default_chart(user_draft) if key == "susu" else f"Error: {payload}"
+
+                    # 该智能体本轮结束，保存对话历史（只追加本轮新增的消息，草稿正文与其他历史共享）
+                    # 即使本轮只发送了差异，历史中也保存全文，作为下一轮比较的基准
+                    sessions.add_reply(session, key, user_draft, message)
+
+                with placeholders[key].container():
+                    render_chat_message(message)
+                last_render[key] = time.monotonic()
+
+        # 重新运行以更新界面
+        st.rerun()
+
+# 页面渲染完成：记录冷启动耗时，并在后台预热模型后端（导入 SDK），第一次提交时不用再等
+startup.finish(new_session)
+warm_up_in_background(agents["mark"].backend)
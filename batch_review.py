@@ -0,0 +1,256 @@
+# batch_review.py
+"""
+批量审阅：不经过 Streamlit，让三个智能体审阅一个目录下的全部草稿（txt/md/pdf），结果逐行写入 JSONL
+
+- 多篇草稿同时审阅，所有后端请求（包括长文档的分段请求）共享一个并发上限和每秒请求数上限（ThrottledBackend），
+  吞吐量由限速决定，而不是逐篇串行
+- 同时处理的草稿数有上限，内存占用不随目录大小增长；模型调用是 I/O 密集的，使用线程，只有 PDF 解析在进程池中进行
+- 每篇草稿审阅完成后立即追加一行结果并刷新到磁盘；中断后用同样的命令重新运行，
+  已经成功审阅（且文件内容没有变化）的草稿会被跳过
+
+用法：
+    python batch_review.py essays/ --output reviews.jsonl --concurrency 16 --rate 5
+    LLM_BACKEND=fake FAKE_LLM_LATENCY=0.5 python batch_review.py essays/ -o reviews.jsonl
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+from agents.backends import get_backend
+from agents.cache import get_default_cache
+from agents.documents import read_pdf_file, POOL_WORKERS
+from agents.mapreduce import MapReduceReviewer, LONG_DRAFT_CHARS
+from agents.parallel import run_parallel
+from agents.registry import create_agents
+from agents.scheduler import ThrottledBackend, DEFAULT_WORKERS, DEFAULT_RATE
+
+# 支持的草稿类型
+DRAFT_EXTENSIONS = (".txt", ".md", ".pdf")
+
+# 每个智能体的超时时间（秒）；限速时等待请求名额的时间也计算在内，比界面中的超时更宽松
+AGENT_TIMEOUT = 300
+
+# 与 app.py 一致：长草稿由马克和艾米按章节分段审阅
+LONG_REVIEW_AGENTS = ("mark", "amy")
+
+# 这些状态的结果视为已完成，重新运行时跳过
+FINISHED_STATUSES = ("ok", "empty")
+
+
+def find_drafts(root):
+    """
+    递归查找目录下的草稿文件
+    :return: [(相对路径, 绝对路径), ...]，按相对路径排序
+    """
+    drafts = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if name.lower().endswith(DRAFT_EXTENSIONS):
+                path = os.path.join(directory, name)
+                drafts.append((os.path.relpath(path, root).replace(os.sep, "/"), path))
+    return sorted(drafts)
+
+
+def file_digest(path):
+    """文件内容的 SHA-256，用于判断上次审阅之后文件是否改过"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_finished(output_path):
+    """
+    读取已有的结果文件，返回已经完成的 {(相对路径, sha256)}
+    中断时写了一半的最后一行会被忽略
+    """
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if row.get("status") in FINISHED_STATUSES:
+                finished.add((row.get("file"), row.get("sha256")))
+    return finished
+
+
+class ResultWriter:
+    """线程安全地向 JSONL 文件追加结果，每行写完立即刷新"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, "a+", encoding="utf-8")
+        # 上次中断时最后一行可能没有写完，先补一个换行，避免和新的一行连在一起
+        if self._file.tell() > 0:
+            self._file.seek(self._file.tell() - 1)
+            if self._file.read(1) != "\n":
+                self._file.write("\n")
+
+    def write(self, row):
+        line = json.dumps(row, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class BatchReviewer:
+    """
+    批量审阅一组草稿
+    每篇草稿在一个线程中处理：读取文本，然后三个智能体并发审阅；
+    智能体共用一个 ThrottledBackend，请求的并发数和速率由它统一控制
+    """
+
+    def __init__(self, agents, pdf_pool=None, timeout=AGENT_TIMEOUT):
+        """
+        :param agents: {key: 智能体}
+        :param pdf_pool: 解析 PDF 的进程池（可选），没有时在当前线程中解析
+        :param timeout: 每个智能体的超时时间（秒）
+        """
+        self.agents = agents
+        self.pdf_pool = pdf_pool
+        self.timeout = timeout
+
+    def read_draft(self, path):
+        if path.lower().endswith(".pdf"):
+            if self.pdf_pool is not None:
+                return self.pdf_pool.submit(read_pdf_file, path).result()
+            return read_pdf_file(path)
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+
+    def runner(self, key, draft):
+        if key in LONG_REVIEW_AGENTS and len(draft) >= LONG_DRAFT_CHARS:
+            return MapReduceReviewer(self.agents[key])
+        return self.agents[key]
+
+    def review(self, name, path, digest):
+        """
+        审阅一篇草稿
+        :return: 结果字典，status 为 ok（全部成功）、empty（没有文本）或 error（读取失败或有智能体出错）
+        """
+        started = time.perf_counter()
+        row = {"file": name, "sha256": digest, "status": "ok", "chars": 0, "replies": {}, "errors": {}}
+        try:
+            draft = self.read_draft(path)
+        except Exception as e:
+            row["status"] = "error"
+            row["errors"]["read"] = str(e) or type(e).__name__
+            return row
+        row["chars"] = len(draft)
+        if not draft.strip():
+            row["status"] = "empty"
+            return row
+
+        jobs = {key: (lambda runner=self.runner(key, draft): runner.process(draft)) for key in self.agents}
+        for key, reply, error in run_parallel(jobs, timeout=self.timeout):
+            if error is not None:
+                row["errors"][key] = str(error) or type(error).__name__
+                continue
+            row["replies"][key] = reply
+            if reply.startswith("Error:"):
+                row["errors"][key] = reply
+        if row["errors"]:
+            row["status"] = "error"
+        row["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return row
+
+
+def run(args):
+    """运行一次批量审阅，返回汇总信息"""
+    started = time.perf_counter()
+    drafts = find_drafts(args.input)
+    finished = load_finished(args.output)
+    todo = []
+    for name, path in drafts:
+        digest = file_digest(path)
+        if (name, digest) not in finished:
+            todo.append((name, path, digest))
+    print(f"Found {len(drafts)} drafts, {len(drafts) - len(todo)} already reviewed, {len(todo)} to go",
+          file=sys.stderr)
+
+    backend = ThrottledBackend(get_backend(args.backend), rate=args.rate, burst=args.burst or args.concurrency,
+                               max_concurrency=args.concurrency)
+    agents = create_agents(cache=get_default_cache(), backend=backend, history_budgets={})
+    pdf_pool = None
+    if any(path.lower().endswith(".pdf") for _, path, _ in todo):
+        # 使用 spawn 启动工作进程，与上传解析（agents/documents.py）一致
+        pdf_pool = ProcessPoolExecutor(max_workers=args.pdf_workers, mp_context=multiprocessing.get_context("spawn"))
+    reviewer = BatchReviewer(agents, pdf_pool=pdf_pool, timeout=args.timeout)
+    writer = ResultWriter(args.output)
+    counts = {"ok": 0, "empty": 0, "error": 0}
+
+    def review(item):
+        row = reviewer.review(*item)
+        writer.write(row)
+        return row
+
+    # 同时处理的草稿数与请求并发上限相同：每篇草稿有三个调用，足以让所有请求名额一直被占满
+    executor = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="batch-draft")
+    try:
+        futures = [executor.submit(review, item) for item in todo]
+        for done, future in enumerate(as_completed(futures), 1):
+            row = future.result()
+            counts[row["status"]] += 1
+            detail = "; ".join(f"{k}: {v}" for k, v in row["errors"].items())
+            print(f"[{done}/{len(todo)}] {row['file']} {row['status']}" + (f" ({detail})" if detail else ""),
+                  file=sys.stderr)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if pdf_pool is not None:
+            pdf_pool.shutdown(wait=False, cancel_futures=True)
+        writer.close()
+
+    elapsed = time.perf_counter() - started
+    return {
+        "drafts": len(drafts),
+        "skipped": len(drafts) - len(todo),
+        "reviewed": counts,
+        "elapsed_s": round(elapsed, 2),
+        "drafts_per_minute": round(len(todo) / elapsed * 60, 1) if todo else 0.0,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="批量审阅一个目录下的草稿（txt/md/pdf），结果写入 JSONL")
+    parser.add_argument("input", help="草稿所在的目录（递归查找）")
+    parser.add_argument("-o", "--output", default="reviews.jsonl", help="结果文件，已存在时跳过其中已完成的草稿")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("SCHEDULER_WORKERS", str(DEFAULT_WORKERS))),
+                        help="同时进行的后端请求数上限（也是同时处理的草稿数）")
+    parser.add_argument("--rate", type=float, default=float(os.getenv("SCHEDULER_RATE", str(DEFAULT_RATE))),
+                        help="每秒请求数上限")
+    parser.add_argument("--burst", type=int, default=None, help="突发请求数上限，默认与 --concurrency 相同")
+    parser.add_argument("--timeout", type=float, default=AGENT_TIMEOUT, help="每个智能体的超时时间（秒）")
+    parser.add_argument("--pdf-workers", type=int, default=POOL_WORKERS, help="解析 PDF 的进程数")
+    parser.add_argument("--backend", default=None, help="模型后端（dashscope/openai/mock/fake），默认读取 LLM_BACKEND")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        summary = run(args)
+    except KeyboardInterrupt:
+        print(f"Interrupted; finished drafts are saved in {args.output}, rerun the same command to resume",
+              file=sys.stderr)
+        sys.exit(130)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
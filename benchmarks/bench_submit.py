@@ -0,0 +1,539 @@
+# benchmarks/bench_submit.py
+"""
+"发送给小组"提交流程的端到端延迟基准测试
+
+使用确定性的 FakeBackend 驱动 ReviewerAgent / ResearcherAgent / VisualizerAgent，
+测量草稿长度、对话历史长度、参考资料大小对延迟和请求大小的影响，
+逐轮修改同一篇文章时发送全文与只发送差异的对比，长文档整篇审阅与分段并发审阅的对比，以及 Mermaid HTML 生成、JSON 历史存取、会话存储读写的耗时，近似重复草稿复用结果的情况，以及后端偶发失败、长尾时重试/对冲的效果，三个智能体合并成一次请求与分开请求的对比。结果以 JSON 输出，便于比较不同版本。
+
+用法：
+    python -m benchmarks.bench_submit --iterations 20 --latency 0.05 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+
+from agents.backends import FakeBackend, BackendError
+from agents.diffing import incremental_content, compact_history
+from agents.mapreduce import MapReduceReviewer
+from agents.mermaid import DiagramCache
+from agents.metrics import MetricsRegistry
+from agents.orchestrator import CombinedReviewer
+from agents.parallel import run_parallel, stream_parallel
+from agents.registry import create_agents
+from agents.resilience import ResilientBackend, RetryPolicy
+from agents.retrieval import DocumentIndex, build_context
+from agents.similarity import SimilarityCache
+from rendering import build_mermaid_html, _build_mermaid_bubble, _build_mermaid_feed_html
+from storage import AGENT_KEYS, SessionStore, SessionCache, serialize_history, deserialize_history
+
+SAMPLE_PARAGRAPH = "工业革命不仅带来了蒸汽机，还改变了社会结构，导致了城市化进程加快。"
+
+
+def make_text(size):
+    """生成指定字符数的确定性文本"""
+    repeats = size // len(SAMPLE_PARAGRAPH) + 1
+    return (SAMPLE_PARAGRAPH * repeats)[:size]
+
+
+def percentiles(samples):
+    """计算 p50/p95/p99（最近秩法）及均值，单位毫秒"""
+    ordered = sorted(samples)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(rank(50) * 1000, 3),
+        "p95_ms": round(rank(95) * 1000, 3),
+        "p99_ms": round(rank(99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def make_agents(latency, jitter, history_budgets=None):
+    """创建三个智能体，每个使用独立的 FakeBackend，便于分别统计请求大小"""
+    agents = create_agents(history_budgets=history_budgets)
+    for i, agent in enumerate(agents.values()):
+        agent.backend = FakeBackend(latency=latency, jitter=jitter, seed=i)
+        # 与回复缓存一样，基准测试中不使用近似缓存，每轮都真正请求模型
+        agent.similarity_cache = None
+    agents["susu"].diagram_cache = DiagramCache(max_entries=0)
+    return agents
+
+
+def submit_round(agents, draft, histories, context_material=None):
+    """模拟一次提交：并发调用三个智能体并写回对话历史，返回耗时（秒）"""
+    # 与 app.py 一致：参考资料只发给马克和艾米
+    contexts = {"mark": context_material, "amy": context_material, "susu": None}
+    jobs = {
+        key: (lambda agent=agents[key], history=list(histories[key]), context=contexts[key]:
+              agent.process(draft, conversation_history=history, context_material=context))
+        for key in AGENT_KEYS
+    }
+    started = time.perf_counter()
+    for key, result, error in run_parallel(jobs):
+        histories[key].append({"role": "user", "content": draft})
+        histories[key].append({"role": "assistant", "content": result or f"Error: {error}"})
+    return time.perf_counter() - started
+
+
+def last_request(agent):
+    return agent.backend.requests[-1] if agent.backend.requests else {}
+
+
+def bench_draft_size(args):
+    """草稿长度对单轮延迟和请求大小的影响"""
+    results = []
+    for size in args.draft_sizes:
+        agents = make_agents(args.latency, args.jitter)
+        draft = make_text(size)
+        samples = [
+            submit_round(agents, draft, {key: [] for key in AGENT_KEYS})
+            for _ in range(args.iterations)
+        ]
+        results.append({
+            "draft_chars": size,
+            "latency": percentiles(samples),
+            "prompt_bytes": {key: last_request(agent).get("prompt_bytes", 0) for key, agent in agents.items()},
+        })
+    return results
+
+
+def bench_history_growth(args, history_budgets=None):
+    """对话轮数增长时每轮的延迟、请求字节数和消息条数"""
+    agents = make_agents(args.latency, args.jitter, history_budgets)
+    histories = {key: [] for key in AGENT_KEYS}
+    draft = make_text(args.history_draft_chars)
+    rounds = []
+    for n in range(1, args.rounds + 1):
+        elapsed = submit_round(agents, draft, histories)
+        rounds.append({
+            "round": n,
+            "latency_ms": round(elapsed * 1000, 3),
+            "prompt_bytes": {key: last_request(agent).get("prompt_bytes", 0) for key, agent in agents.items()},
+            "message_count": {key: last_request(agent).get("message_count", 0) for key, agent in agents.items()},
+            "backend_calls": {key: agent.backend.calls for key, agent in agents.items()},
+        })
+    return rounds
+
+
+def bench_incremental_review(args):
+    """
+    逐轮修改同一篇 10 段的文章（每轮改一段）：马克每轮的请求字节数和延迟，
+    比较每轮发送全文与只发送差异（并压缩历史中的旧版草稿）两种方式
+    """
+    paragraphs = [f"第{i}段：" + make_text(args.history_draft_chars // 10) for i in range(10)]
+    results = {}
+    for mode in ("full", "diff"):
+        agent = make_agents(args.latency, args.jitter, history_budgets={})["mark"]
+        history = []
+        rounds = []
+        for n in range(args.rounds):
+            revision = list(paragraphs)
+            revision[n % len(revision)] += f"（第{n}次修改）"
+            paragraphs = revision
+            draft = "\n\n".join(revision)
+            content, sent = draft, history
+            if mode == "diff":
+                sent = compact_history(history)
+                content = incremental_content(draft, sent)[0]
+            started = time.perf_counter()
+            reply = agent.process(content, conversation_history=sent)
+            elapsed = time.perf_counter() - started
+            history.extend([{"role": "user", "content": draft}, {"role": "assistant", "content": reply}])
+            rounds.append({
+                "round": n + 1,
+                "latency_ms": round(elapsed * 1000, 3),
+                "prompt_bytes": last_request(agent).get("prompt_bytes", 0),
+            })
+        results[mode] = {
+            "total_prompt_bytes": sum(r["prompt_bytes"] for r in rounds),
+            "rounds": rounds,
+        }
+    return results
+
+
+def make_long_draft(size):
+    """生成带章节标题的长草稿，每章约 1500 字"""
+    chapters = []
+    for c in range(size // 1500 + 1):
+        chapters.append(f"# 第{c + 1}章\n\n" + "\n\n".join(make_text(250) for _ in range(6)))
+    return "\n\n".join(chapters)[:size]
+
+
+def bench_long_draft(args):
+    """
+    长草稿：整篇发送与按章节分段并发审阅（map-reduce）的延迟对比
+    假后端按提示 token 数增加延迟（每 1000 token 额外 args.latency 秒），模拟长提示的处理时间
+    """
+    results = []
+    for size in (3000, 10000, 30000):
+        draft = make_long_draft(size)
+        row = {"draft_chars": size}
+        for mode in ("single", "map_reduce"):
+            agent = make_agents(args.latency, args.jitter, history_budgets={})["mark"]
+            agent.backend.token_latency = args.latency / 1000
+            runner = MapReduceReviewer(agent) if mode == "map_reduce" else agent
+            samples = []
+            for _ in range(max(1, args.iterations // 4)):
+                started = time.perf_counter()
+                runner.process(draft)
+                samples.append(time.perf_counter() - started)
+            row[mode] = {"latency": percentiles(samples), "backend_calls": agent.backend.calls}
+        results.append(row)
+    return results
+
+
+def bench_reference_size(args):
+    """参考资料大小对索引构建、检索和单轮延迟的影响"""
+    results = []
+    draft = make_text(args.history_draft_chars)
+    for size in args.reference_sizes:
+        agents = make_agents(args.latency, args.jitter)
+        started = time.perf_counter()
+        index = DocumentIndex(make_text(size), name="reference")
+        index_seconds = time.perf_counter() - started
+
+        retrieval_samples = []
+        context_material = ""
+        for _ in range(args.iterations):
+            started = time.perf_counter()
+            context_material = build_context([index], draft)
+            retrieval_samples.append(time.perf_counter() - started)
+
+        samples = [
+            submit_round(agents, draft, {key: [] for key in AGENT_KEYS}, context_material or None)
+            for _ in range(args.iterations)
+        ]
+        results.append({
+            "reference_chars": size,
+            "chunks": len(index.chunks),
+            "index_build_ms": round(index_seconds * 1000, 3),
+            "retrieval": percentiles(retrieval_samples),
+            "context_chars": len(context_material),
+            "latency": percentiles(samples),
+            "prompt_bytes": {key: last_request(agent).get("prompt_bytes", 0) for key, agent in agents.items()},
+        })
+    return results
+
+
+def bench_render(args):
+    """Mermaid 图表 HTML 生成耗时：cold 为首次生成，warm 为重新运行时命中缓存"""
+    results = []
+    for nodes in (5, 50, 200):
+        lines = ["graph TD"] + [f"    N{i}[节点{i}] --> N{i + 1}[节点{i + 1}]" for i in range(nodes)]
+        code = "\n".join(lines)
+        sender = {"name": "苏苏", "role": "视觉设计师", "timestamp": "刚刚"}
+        cold_samples = []
+        warm_samples = []
+        for _ in range(max(args.iterations, 100)):
+            _build_mermaid_bubble.cache_clear()
+            _build_mermaid_feed_html.cache_clear()
+            started = time.perf_counter()
+            build_mermaid_html(code, sender)
+            cold_samples.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            build_mermaid_html(code, sender)
+            warm_samples.append(time.perf_counter() - started)
+        results.append({
+            "nodes": nodes,
+            "code_chars": len(code),
+            "latency": percentiles(cold_samples),
+            "cached_latency": percentiles(warm_samples),
+        })
+    return results
+
+
+def bench_storage(args):
+    """JSON 历史序列化/反序列化耗时随历史长度的变化"""
+    results = []
+    draft = make_text(args.history_draft_chars)
+    for rounds in (1, 10, 50, 200):
+        conversation_history = {key: [] for key in AGENT_KEYS}
+        chat_history = []
+        for _ in range(rounds):
+            chat_history.append({"sender": "user", "name": "你", "content": draft, "timestamp": "刚刚"})
+            for key in AGENT_KEYS:
+                conversation_history[key].append({"role": "user", "content": draft})
+                conversation_history[key].append({"role": "assistant", "content": SAMPLE_PARAGRAPH})
+                chat_history.append({"sender": key, "name": key, "content": SAMPLE_PARAGRAPH, "timestamp": "刚刚"})
+
+        save_samples = []
+        load_samples = []
+        data = ""
+        for _ in range(args.iterations):
+            started = time.perf_counter()
+            data = serialize_history(conversation_history, chat_history)
+            save_samples.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            deserialize_history(data)
+            load_samples.append(time.perf_counter() - started)
+        results.append({
+            "rounds": rounds,
+            "serialized_bytes": len(data.encode("utf-8")),
+            "save": percentiles(save_samples),
+            "load": percentiles(load_samples),
+        })
+    return results
+
+
+def bench_session_store(args):
+    """
+    会话存储：每轮追加新消息、加载最近几轮聊天记录和冷加载整个会话的耗时随会话长度的变化，
+    以及共享正文的内存占用（只含已加载的轮次）与每条消息各存一份正文的对比
+    """
+    results = []
+    draft = make_text(args.history_draft_chars)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SessionStore(os.path.join(tmp, "sessions.sqlite3"))
+        sessions = SessionCache(store, max_session_bytes=float("inf"))
+        for rounds in (1, 10, 50, 200):
+            session_id = f"bench-{rounds}"
+            append_samples = []
+            duplicated_bytes = 0
+            for i in range(rounds):
+                # 每轮的草稿和回复都不同，只统计同一轮内的共享
+                round_draft = f"第{i}轮：{draft}"
+                reply = f"第{i}轮：{SAMPLE_PARAGRAPH}"
+                entries = [(SessionStore.CHAT_STREAM, {"sender": "user", "name": "你", "content": round_draft, "timestamp": "刚刚"})]
+                started = time.perf_counter()
+                store.append(session_id, entries)
+                for key in AGENT_KEYS:
+                    store.append(session_id, [
+                        (SessionStore.CHAT_STREAM, {"sender": key, "name": key, "content": reply, "timestamp": "刚刚"}),
+                        (key, {"role": "user", "content": round_draft}),
+                        (key, {"role": "assistant", "content": reply}),
+                    ])
+                append_samples.append(time.perf_counter() - started)
+                # 每轮草稿出现 4 次（统一聊天记录 + 三个智能体的历史），回复各出现 2 次
+                duplicated_bytes += 4 * len(round_draft.encode("utf-8")) + 6 * len(reply.encode("utf-8"))
+
+            load_samples = []
+            for _ in range(args.iterations):
+                started = time.perf_counter()
+                store.load_chat_rounds(session_id, 5)
+                load_samples.append(time.perf_counter() - started)
+            # 冷加载整个会话：聊天记录和各智能体的对话历史都只读最近几轮，耗时不随会话长度增长
+            started = time.perf_counter()
+            session = sessions.get(session_id)
+            load_session = time.perf_counter() - started
+            results.append({
+                "rounds": rounds,
+                "append_round": percentiles(append_samples[-min(len(append_samples), 10):]),
+                "load_recent_rounds": percentiles(load_samples),
+                "load_session_ms": round(load_session * 1000, 3),
+                "memory_bytes": session.memory_bytes(),
+                "duplicated_body_bytes": duplicated_bytes,
+            })
+    return results
+
+
+SIMILARITY_DRAFT = (
+    "工业革命不仅带来了蒸汽机，还改变了社会结构，导致了城市化进程加快。大量农民离开土地进入工厂，形成了新的工人阶级。\n"
+    "与此同时，交通运输的进步让商品能够更快地流通，市场规模不断扩大。然而，工厂的劳动条件十分恶劣，"
+    "童工现象普遍存在，这引发了后来的工人运动和劳动立法。"
+)
+
+SIMILARITY_EDITS = {
+    "punctuation": SIMILARITY_DRAFT.replace("，", ", ").replace("。", ". "),
+    "one_word": SIMILARITY_DRAFT.replace("恶劣", "艰苦"),
+    "one_sentence": SIMILARITY_DRAFT.replace("大量农民离开土地进入工厂，形成了新的工人阶级。", "许多农村人口涌入城市寻找工作。"),
+    "unrelated": (
+        "人工智能的发展正在改变教育的形态，个性化学习成为可能，教师的角色也随之转变。"
+        "学生可以借助智能工具随时获得反馈，但也面临依赖技术、缺乏独立思考的风险。"
+    ),
+}
+
+
+def bench_similarity_cache(args):
+    """
+    近似缓存：资料补充员先审阅一篇草稿，再分别提交几种修改后的版本，记录是否复用了上次的结果和相似度；
+    另外测量缓存写满（1024 条）后一次查找的耗时
+    """
+    agent = make_agents(args.latency, args.jitter)["amy"]
+    agent.similarity_cache = SimilarityCache()
+    agent.process(SIMILARITY_DRAFT)
+    edits = {}
+    for name, draft in SIMILARITY_EDITS.items():
+        calls = agent.backend.calls
+        agent.process(draft)
+        record = agent.metrics.records()[-1]
+        edits[name] = {"reused": agent.backend.calls == calls, "similarity": record.similarity}
+
+    cache = SimilarityCache(max_entries=1024)
+    for i in range(1024):
+        cache.put("bench", f"{i}号草稿：" + make_text(300)[i % 30:], "reply")
+    samples = []
+    for i in range(args.iterations * 5):
+        started = time.perf_counter()
+        cache.lookup("bench", SIMILARITY_EDITS["unrelated"] + str(i))
+        samples.append(time.perf_counter() - started)
+    return {"edits": edits, "lookup_full_cache": percentiles(samples)}
+
+
+def bench_resilience(args):
+    """
+    后端有 10% 的请求失败（429/5xx）、5% 的请求进入长尾（20 倍延迟）时，
+    直接调用、重试、重试加对冲三种方式的成功率和延迟分布
+    """
+    latency = max(args.latency, 0.001)
+    messages = [{"role": "user", "content": make_text(200)}]
+    variants = {
+        "plain": lambda backend: backend,
+        "retry": lambda backend: ResilientBackend(backend, RetryPolicy(max_retries=2, base_delay=latency, seed=0),
+                                                  failure_threshold=1000),
+        "retry_hedge": lambda backend: ResilientBackend(backend, RetryPolicy(max_retries=2, base_delay=latency, seed=0),
+                                                        hedge_after=latency * 3, failure_threshold=1000),
+    }
+    results = []
+    for name, wrap in variants.items():
+        inner = FakeBackend(latency=latency, seed=0, failure_rate=0.1, tail_rate=0.05, tail_latency=latency * 20)
+        backend = wrap(inner)
+        samples = []
+        succeeded = 0
+        for _ in range(args.iterations * 5):
+            started = time.perf_counter()
+            try:
+                backend.complete("bench", messages)
+                succeeded += 1
+            except BackendError:
+                pass
+            samples.append(time.perf_counter() - started)
+        results.append({
+            "variant": name,
+            "success_rate": round(succeeded / len(samples), 3),
+            "backend_calls": inner.calls,
+            "latency": percentiles(samples),
+        })
+    return results
+
+
+def bench_combined(args):
+    """
+    合并模式（agents/orchestrator.py）与分开调用三个智能体的对比：
+    逐轮修改同一篇草稿（带参考资料，输入与 app.py 相同：马克和艾米只收到差异），比较每轮的请求数、提示 token、
+    生成 token 和延迟。假后端按提示 token 增加预填充时间（每 1000 token 额外 args.latency 秒），
+    按生成 token 增加生成时间（每 100 token 额外 args.latency 秒）
+    """
+    reference = make_text(1500)
+    results = []
+    for size in (500, 2000, 6000):
+        paragraphs = [f"第{i}段：" + make_text(size // 10) for i in range(10)]
+        row = {"draft_chars": size}
+        for mode in ("separate", "combined"):
+            registry = MetricsRegistry()
+            agents = make_agents(args.latency, args.jitter)
+            backends = [agent.backend for agent in agents.values()]
+            for agent in agents.values():
+                agent.metrics = registry
+            reviewer = None
+            if mode == "combined":
+                backend = FakeBackend(latency=args.latency, jitter=args.jitter)
+                backends = [backend]
+                reviewer = CombinedReviewer(agents, backend=backend, metrics=registry)
+            for backend in backends:
+                backend.token_latency = args.latency / 1000
+                backend.completion_token_latency = args.latency / 100
+            histories = {key: [] for key in AGENT_KEYS}
+            samples = []
+            revision = list(paragraphs)
+            for n in range(min(args.rounds, 5)):
+                revision[n % len(revision)] += f"（第{n}次修改）"
+                draft = "\n\n".join(revision)
+                inputs = {}
+                for key in AGENT_KEYS:
+                    history = compact_history(histories[key])
+                    content = incremental_content(draft, history)[0] if key in ("mark", "amy") else draft
+                    inputs[key] = (content, reference if key != "susu" else None, history)
+                jobs = {
+                    key: (lambda agent=agents[key], content=content, context=context, history=history:
+                          [agent.process(content, context_material=context, conversation_history=history)])
+                    for key, (content, context, history) in inputs.items()
+                }
+                if reviewer is not None:
+                    # 与 app.py 相同：合并请求作为一个组任务，不合格的部分退回单独调用
+                    jobs = {tuple(AGENT_KEYS): reviewer.start(draft, inputs, jobs).run}
+                started = time.perf_counter()
+                replies = {key: "" for key in AGENT_KEYS}
+                for event, key, payload in stream_parallel(jobs):
+                    if event == "delta":
+                        replies[key] += payload
+                    elif event == "error":
+                        replies[key] = f"Error: {payload}"
+                for key in AGENT_KEYS:
+                    histories[key].append({"role": "user", "content": draft})
+                    histories[key].append({"role": "assistant", "content": replies[key]})
+                samples.append(time.perf_counter() - started)
+            records = registry.records()
+            row[mode] = {
+                "latency": percentiles(samples),
+                "backend_calls": sum(backend.calls for backend in backends),
+                "prompt_tokens": sum(r.prompt_tokens for r in records),
+                "completion_tokens": sum(r.completion_tokens for r in records),
+            }
+            if reviewer is not None:
+                row[mode]["fallbacks"] = reviewer.stats()["fallbacks"]
+        row["prompt_tokens_saved"] = round(1 - row["combined"]["prompt_tokens"] / row["separate"]["prompt_tokens"], 3)
+        results.append(row)
+    return results
+
+
+def run(args):
+    """运行全部基准测试，返回结果字典"""
+    return {
+        "meta": {
+            "benchmark": "submit_pipeline",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": vars(args),
+        },
+        "draft_size": bench_draft_size(args),
+        "history_growth": bench_history_growth(args),
+        "history_growth_unbudgeted": bench_history_growth(args, history_budgets={}),
+        "incremental_review": bench_incremental_review(args),
+        "long_draft": bench_long_draft(args),
+        "reference_size": bench_reference_size(args),
+        "render_mermaid": bench_render(args),
+        "history_storage": bench_storage(args),
+        "session_store": bench_session_store(args),
+        "similarity_cache": bench_similarity_cache(args),
+        "resilience": bench_resilience(args),
+        "combined": bench_combined(args),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="提交流程端到端延迟基准测试")
+    parser.add_argument("--iterations", type=int, default=20, help="每个场景的重复次数")
+    parser.add_argument("--latency", type=float, default=0.05, help="假后端每次调用的延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="假后端延迟抖动（秒）")
+    parser.add_argument("--rounds", type=int, default=20, help="历史增长场景的轮数")
+    parser.add_argument("--history-draft-chars", type=int, default=500, help="历史增长场景中每轮草稿的字符数")
+    parser.add_argument("--draft-sizes", type=int, nargs="+", default=[200, 2000, 10000])
+    parser.add_argument("--reference-sizes", type=int, nargs="+", default=[0, 20000, 200000])
+    parser.add_argument("--output", help="结果 JSON 文件路径，不指定时输出到标准输出")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    data = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(data)
+        print(f"Benchmark results written to {args.output}", file=sys.stderr)
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
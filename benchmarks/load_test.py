@@ -0,0 +1,265 @@
+# benchmarks/load_test.py
+"""
+多会话压力测试：在一个进程中用 Streamlit AppTest 模拟 N 个同时使用的学生
+
+每个模拟会话打开页面，然后逐轮上传草稿文件（或在输入框中修改草稿）、点击"发送给小组"，
+再空闲重跑几次页面。所有会话共享同一个进程里的智能体、调度器、缓存和会话存储，与一个 app.py 服务进程相同；
+模型调用使用进程内的 FakeBackend（延迟可配置）。
+
+按并发会话数逐级测量：
+- 各类操作（打开页面、上传、提交、重跑）的耗时分位数
+- 吞吐量：每秒完成的重跑次数和提交次数
+- 进程 CPU 占用（CPU 时间 / 墙钟时间，1.0 表示占满一个核）以及 RSS 内存（峰值和结束时）
+
+用法：
+    python -m benchmarks.load_test --sessions 1,4,8,16 --rounds 3 --latency 0.5 --output load.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import resource
+import tempfile
+import threading
+
+from benchmarks.bench_submit import percentiles
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+# install_shared_runtime() 替换了 AppTest 的内部实现，只在这个版本上验证过（与 requirements.txt 中的版本一致）
+STREAMLIT_VERSION = "1.66.0"
+
+# 常用汉字的范围，用来生成互不相同的草稿，避免命中回复缓存和近似缓存
+_CJK_START = 0x4e00
+_CJK_SIZE = 3000
+
+
+def make_draft(rng, size):
+    """生成 size 个字符的随机草稿，每 50 个字一个句号"""
+    chars = [chr(_CJK_START + rng.randrange(_CJK_SIZE)) for _ in range(size)]
+    for i in range(49, size, 50):
+        chars[i] = "。"
+    return "".join(chars)
+
+
+def current_rss():
+    """当前进程的常驻内存（字节）；不是 Linux 时返回峰值 RSS"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 上单位是字节，Linux 上是 KB
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class ResourceSampler:
+    """后台线程定时采样 RSS，记录峰值"""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def install_shared_runtime():
+    """
+    让所有模拟会话像真实服务器一样共用一个 Streamlit Runtime 和一个脚本缓存
+    - AppTest 每次运行前把进程全局的 Runtime._instance 设为新的模拟对象、运行后清空，多个会话并发运行时会互相清掉。
+      这里把 AppTest 看到的 Runtime 换成一个子类：第一次运行创建的模拟对象成为共享的 Runtime._instance，
+      之后的设置和清空只作用在子类上
+    - AppTest 每次运行都新建脚本缓存、重新编译 app.py（多线程同时编译还会触发 Python 3.11 ast 模块的问题），
+      真实服务器只编译一次，这里共用一个 ScriptCache
+    这些都是 Streamlit 的私有接口，版本与 STREAMLIT_VERSION 不同时直接报错，而不是在替换失效后给出错误的数字
+    """
+    import streamlit
+    if streamlit.__version__ != STREAMLIT_VERSION:
+        raise RuntimeError(
+            f"load_test patches Streamlit internals and is only verified on streamlit=={STREAMLIT_VERSION}, "
+            f"found {streamlit.__version__}; install the version pinned in requirements.txt"
+        )
+
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    if app_test.Runtime is not Runtime:
+        return
+
+    class SharedRuntimeMeta(type):
+        def __setattr__(cls, name, value):
+            if name == "_instance" and value is not None and Runtime._instance is None:
+                Runtime._instance = value
+            type.__setattr__(cls, name, value)
+
+    app_test.Runtime = SharedRuntimeMeta("AppTestRuntime", (Runtime,), {})
+    script_cache = ScriptCache()
+    # 先编译一次：缓存为空时并发的第一批会话仍会同时编译
+    script_cache.get_bytecode(APP_PATH)
+    # AppTest 和它的脚本执行器各自新建脚本缓存，两处都换成共享的
+    app_test.ScriptCache = lambda: script_cache
+    local_script_runner.ScriptCache = lambda: script_cache
+
+
+class SimulatedSession:
+    """一个模拟的学生：在自己的线程中依次执行页面操作，记录每次操作的耗时"""
+
+    def __init__(self, index, args):
+        self.index = index
+        self.args = args
+        self.rng = random.Random(index)
+        self.samples = {}
+        self.errors = []
+
+    def timed(self, action, fn):
+        started = time.perf_counter()
+        try:
+            at = fn()
+        except Exception as e:
+            self.errors.append(f"{action}: {type(e).__name__}: {e}")
+            return False
+        self.samples.setdefault(action, []).append(time.perf_counter() - started)
+        if at.exception:
+            self.errors.extend(f"{action}: {e.value}" for e in at.exception)
+        return True
+
+    def run(self):
+        from streamlit.testing.v1 import AppTest
+
+        at = AppTest.from_file(APP_PATH, default_timeout=self.args.timeout)
+        if not self.timed("load", at.run):
+            return
+        for round_index in range(self.args.rounds):
+            draft = make_draft(self.rng, self.args.draft_chars)
+            # 一半的轮次上传草稿文件，另一半直接在输入框中修改
+            if round_index % 2 == 0:
+                name = f"session{self.index}-round{round_index}.md"
+                ok = self.timed("upload", lambda: at.file_uploader[0].upload(
+                    name, draft.encode("utf-8"), "text/markdown").run())
+            else:
+                ok = self.timed("edit", lambda: at.text_area[0].input(draft).run())
+            if not ok or not self.timed("submit", lambda: at.button[0].click().run()):
+                return
+            for _ in range(self.args.idle_reruns):
+                if not self.timed("rerun", at.run):
+                    return
+
+
+def run_level(sessions, args):
+    """以 sessions 个并发会话运行一轮，返回这一级的测量结果"""
+    simulated = [SimulatedSession(i + sessions * 1000, args) for i in range(sessions)]
+    threads = [threading.Thread(target=s.run, name=f"load-session-{s.index}") for s in simulated]
+    cpu_start = cpu_seconds()
+    started = time.perf_counter()
+    with ResourceSampler() as sampler:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+    cpu = cpu_seconds() - cpu_start
+
+    actions = {}
+    for session in simulated:
+        for action, samples in session.samples.items():
+            actions.setdefault(action, []).extend(samples)
+    reruns = sum(len(samples) for samples in actions.values())
+    errors = [error for session in simulated for error in session.errors]
+
+    from agents.scheduler import get_scheduler
+    return {
+        "sessions": sessions,
+        "elapsed_s": round(elapsed, 3),
+        "actions": {action: percentiles(samples) for action, samples in sorted(actions.items())},
+        "reruns_per_s": round(reruns / elapsed, 2),
+        "submits_per_s": round(len(actions.get("submit", [])) / elapsed, 3),
+        "cpu_cores": round(cpu / elapsed, 3),
+        "rss_peak_mb": round(sampler.peak / 2 ** 20, 1),
+        "rss_end_mb": round(current_rss() / 2 ** 20, 1),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "scheduler": get_scheduler().stats(),
+    }
+
+
+def run(args):
+    """依次运行各个并发级别，返回结果字典"""
+    # 在导入 app 之前配置：进程内假后端、独立的会话存储
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["FAKE_LLM_LATENCY"] = str(args.latency)
+    store_dir = tempfile.mkdtemp(prefix="load-test-")
+    os.environ.setdefault("SESSION_STORE_PATH", os.path.join(store_dir, "sessions.sqlite3"))
+
+    install_shared_runtime()
+
+    levels = [int(n) for n in args.sessions.split(",") if n.strip()]
+    results = {
+        "meta": {
+            "benchmark": "load_test",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "streamlit": STREAMLIT_VERSION,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "params": vars(args),
+            "rss_start_mb": round(current_rss() / 2 ** 20, 1),
+        },
+        "levels": [],
+    }
+    for sessions in levels:
+        level = run_level(sessions, args)
+        print(f"{sessions} sessions: {level['reruns_per_s']} reruns/s, {level['submits_per_s']} submits/s, "
+              f"cpu {level['cpu_cores']} cores, rss {level['rss_peak_mb']} MB, errors {level['errors']}",
+              file=sys.stderr)
+        results["levels"].append(level)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="app.py 多会话压力测试（AppTest + 进程内假后端）")
+    parser.add_argument("--sessions", default="1,4,8,16", help="逐级测试的并发会话数，逗号分隔")
+    parser.add_argument("--rounds", type=int, default=3, help="每个会话提交的轮数")
+    parser.add_argument("--idle-reruns", type=int, default=2, help="每次提交后空闲重跑页面的次数")
+    parser.add_argument("--draft-chars", type=int, default=800, help="每份草稿的字符数")
+    parser.add_argument("--latency", type=float, default=0.5, help="假后端每次调用的延迟（秒）")
+    parser.add_argument("--timeout", type=float, default=120, help="单次页面运行的超时时间（秒）")
+    parser.add_argument("--output", help="结果输出文件（JSON），默认打印到标准输出")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    data = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(data)
+        print(f"Load test results written to {args.output}", file=sys.stderr)
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
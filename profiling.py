@@ -0,0 +1,99 @@
+# profiling.py
+"""
+冷启动计时：设置环境变量 COPILOT_PROFILE_STARTUP=1 后打开
+- 每个进程第一次运行 app.py 时：导入耗时（以及新加载的模块数）、到共享智能体创建完成的耗时、首次渲染的总耗时
+- 每个新会话第一次运行 app.py 的渲染耗时
+结果打印到标准错误，侧边栏中也会显示；需要按模块细分导入耗时时，用 python -X importtime -m streamlit run app.py 启动
+"""
+import os
+import sys
+import time
+import threading
+
+
+def profiling_enabled():
+    return os.getenv("COPILOT_PROFILE_STARTUP", "").lower() in ("1", "true", "yes", "on")
+
+
+class StartupTimer:
+    """一次脚本运行的计时：按顺序记录检查点，每个阶段的耗时为与上一个检查点的间隔"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.modules_before = len(sys.modules)
+        self.modules_loaded = 0
+        self.marks = []
+
+    def mark(self, phase):
+        """记录一个检查点；第一个检查点 imports 同时统计新加载的模块数"""
+        if not self.marks:
+            self.modules_loaded = len(sys.modules) - self.modules_before
+        self.marks.append((phase, time.perf_counter()))
+
+    def phases(self):
+        """:return: {阶段: 毫秒}"""
+        phases = {}
+        previous = self.started
+        for phase, at in self.marks:
+            phases[phase] = round((at - previous) * 1000, 1)
+            previous = at
+        return phases
+
+    def finish(self, new_session):
+        """
+        脚本运行结束时调用：进程的第一次运行和每个新会话的第一次运行登记到 StartupProfile
+        :param new_session: 本次运行是否为一个会话的第一次运行
+        """
+        self.mark("render")
+        get_startup_profile().record(self, new_session)
+
+
+class StartupProfile:
+    """进程级的冷启动记录"""
+
+    def __init__(self):
+        self.process = None
+        self.sessions = 0
+        self.session_render_ms = []
+        self._lock = threading.Lock()
+
+    def record(self, timer, new_session):
+        total = round((timer.marks[-1][1] - timer.started) * 1000, 1)
+        with self._lock:
+            first_run = self.process is None
+            if first_run:
+                self.process = dict(timer.phases(), total=total, modules_loaded=timer.modules_loaded)
+            if new_session:
+                self.sessions += 1
+                self.session_render_ms.append(total)
+        if not profiling_enabled():
+            return
+        if first_run:
+            phases = ", ".join(f"{phase} {ms} ms" for phase, ms in timer.phases().items())
+            print(f"Startup profile: first run {total} ms ({phases}; {timer.modules_loaded} modules imported)",
+                  file=sys.stderr)
+        elif new_session:
+            print(f"Startup profile: new session first render {total} ms", file=sys.stderr)
+
+    def summary(self):
+        """:return: {"process": 第一次运行的各阶段耗时（毫秒）, "sessions": 新会话数, "session_render_p50_ms": ...}"""
+        with self._lock:
+            renders = sorted(self.session_render_ms)
+            return {
+                "process": dict(self.process) if self.process else None,
+                "sessions": self.sessions,
+                "session_render_p50_ms": renders[len(renders) // 2] if renders else None,
+            }
+
+
+_startup_profile = None
+_startup_profile_lock = threading.Lock()
+
+
+def get_startup_profile():
+    """进程级共享的冷启动记录"""
+    global _startup_profile
+    with _startup_profile_lock:
+        if _startup_profile is None:
+            _startup_profile = StartupProfile()
+        return _startup_profile
@@ -0,0 +1,203 @@
+# rendering.py
+"""聊天界面的 HTML 生成（与 Streamlit 无关，便于复用和基准测试）"""
+import os
+from functools import lru_cache
+
+MERMAID_VERSION = "9.4.3"
+MERMAID_CDN_URL = f"https://cdn.jsdelivr.net/npm/mermaid@{MERMAID_VERSION}/dist/mermaid.min.js"
+
+# 仓库中附带的 mermaid.js（UMD 构建，许可证见 static/LICENSE-mermaid），
+# 由 Streamlit 静态文件服务（.streamlit/config.toml 中的 enableStaticServing）在 <baseUrlPath>/app/static/ 下提供
+MERMAID_LOCAL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "mermaid.min.js")
+MERMAID_STATIC_PATH = "app/static/mermaid.min.js"
+
+# 缓存的图表 HTML 数量
+MERMAID_HTML_CACHE_SIZE = 256
+
+# 同一个 iframe 中相邻图表气泡的间距（px）
+BUBBLE_GAP = 12
+
+# 聊天记录默认只渲染最近的轮数
+CHAT_WINDOW_ROUNDS = 5
+
+
+def mermaid_script_src(base_url_path=""):
+    """
+    本地 mermaid.js 的地址
+    组件 iframe 使用 srcdoc，相对地址会按当前页面路径解析，所以这里总是返回以 / 开头的绝对路径
+    :param base_url_path: Streamlit 的 server.baseUrlPath 配置
+    :return: 例如 /app/static/mermaid.min.js 或 /copilot/app/static/mermaid.min.js
+    """
+    if not os.path.exists(MERMAID_LOCAL_FILE):
+        raise FileNotFoundError(
+            f"{MERMAID_LOCAL_FILE} is missing; restore it from git or run `python rendering.py` to download it"
+        )
+    base = (base_url_path or "").strip("/")
+    return f"/{base}/{MERMAID_STATIC_PATH}" if base else f"/{MERMAID_STATIC_PATH}"
+
+
+def fetch_mermaid(url=MERMAID_CDN_URL, path=MERMAID_LOCAL_FILE):
+    """重新下载 mermaid.min.js 到 static 目录（升级 MERMAID_VERSION 时使用）"""
+    import urllib.request
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with urllib.request.urlopen(url, timeout=60) as response:
+        data = response.read()
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def window_chat_history(chat_history, rounds=CHAT_WINDOW_ROUNDS):
+    """
+    只保留最近 rounds 轮的聊天记录（每条用户消息开始新的一轮）
+    :param chat_history: 统一聊天历史
+    :param rounds: 保留的轮数，None 表示全部
+    :return: (被隐藏的轮数, 需要渲染的消息列表)
+    """
+    starts = [i for i, message in enumerate(chat_history) if message.get("sender") == "user"]
+    if rounds is None or len(starts) <= rounds:
+        return 0, chat_history
+    return len(starts) - rounds, chat_history[starts[-rounds]:]
+
+
+def build_mermaid_html(code, sender_info=None, base_url_path=""):
+    """
+    生成渲染单个 Mermaid 图表的 iframe HTML（流式回复、实时点评中刚生成的图表）
+    :param code: Mermaid 代码
+    :param sender_info: 发送者信息 {"name", "role", "timestamp"}（可选），提供时包装成聊天气泡
+    :param base_url_path: Streamlit 的 server.baseUrlPath 配置
+    :return: (html, 估算高度)
+    """
+    return build_mermaid_feed_html([(code, sender_info)], base_url_path)
+
+
+def build_mermaid_feed_html(diagrams, base_url_path=""):
+    """
+    把聊天窗口中的所有 Mermaid 图表放进同一个 iframe，整个页面只加载一次 mermaid.js
+    结果按内容缓存：重新运行时不再重新拼接 HTML，图表没有变化时 HTML 完全相同，前端不会重建 iframe
+    :param diagrams: [(Mermaid 代码, 发送者信息或 None)]，按显示顺序排列
+    :param base_url_path: Streamlit 的 server.baseUrlPath 配置
+    :return: (html, 估算高度)
+    """
+    items = []
+    for code, sender_info in diagrams:
+        if sender_info:
+            items.append((
+                code,
+                sender_info.get('name', '苏苏'),
+                sender_info.get('role', '视觉设计师'),
+                sender_info.get('timestamp', '')
+            ))
+        else:
+            items.append((code, None, None, None))
+    return _build_mermaid_feed_html(tuple(items), mermaid_script_src(base_url_path))
+
+
+@lru_cache(maxsize=MERMAID_HTML_CACHE_SIZE)
+def _build_mermaid_bubble(code, name, role, timestamp):
+    # 准备头部信息
+    header_html = ""
+    if name is not None:
+        # 使用新的CSS类样式
+        header_html = f"""
+            <div class="bubble-header">
+                <span class="avatar" style="background-color: #fff3e0;">🎨</span>
+                <strong style="color: #f57c00;">{name}</strong>
+                <span style="background-color: #fff3e0; color: #f57c00; padding: 2px 8px; border-radius: 10px; font-size: 0.8em; margin-left: 8px;">{role}</span>
+                <small style="color: gray; margin-left: auto;">{timestamp}</small>
+            </div>
+        """
+        # 使用新的CSS类样式
+        box_class = "chat-bubble assistant-bubble role-susu"
+    else:
+        box_class = "diagram"
+
+    # 估算高度：基础高度 + 每行代码增加的高度
+    # 这是一个简单的启发式方法，避免固定高度导致的巨大空白
+    line_count = len(code.strip().split('\n'))
+    estimated_height = max(200, min(600, line_count * 40 + 100))
+
+    bubble_html = f"""
+    <div class="{box_class}">
+        {header_html}
+        <div class="mermaid">
+        {code}
+        </div>
+    </div>
+    """
+    return bubble_html, estimated_height
+
+
+@lru_cache(maxsize=MERMAID_HTML_CACHE_SIZE)
+def _build_mermaid_feed_html(items, script_src):
+    bubbles = [_build_mermaid_bubble(*item) for item in items]
+    # 每个气泡之间留出间距，再加上 body 的上下内边距
+    estimated_height = sum(height for _, height in bubbles) + BUBBLE_GAP * (len(bubbles) - 1) + 20
+
+    # 注意：我们需要将CSS样式注入到iframe中，因为iframe不继承父页面的样式
+    html_code = f"""
+    <style>
+        body {{
+            font-family: "Helvetica Neue", Helvetica, Arial, sans-serif;
+            margin: 0;
+            padding: 10px;
+            overflow: hidden; /* 隐藏滚动条，除非必要 */
+        }}
+        /* 聊天气泡基础样式 */
+        .chat-bubble, .diagram {{
+            margin-bottom: {BUBBLE_GAP}px;
+        }}
+        .chat-bubble {{
+            padding: 15px;
+            border-radius: 15px;
+            box-shadow: 0 2px 5px rgba(0,0,0,0.05);
+            position: relative;
+        }}
+        .chat-bubble:last-child, .diagram:last-child {{
+            margin-bottom: 0;
+        }}
+
+        /* 助手气泡通用 */
+        .assistant-bubble {{
+            background-color: #ffffff;
+            border-bottom-left-radius: 2px;
+            margin-right: 10%;
+            border: 1px solid #f0f0f0;
+        }}
+
+        /* 角色特定样式 */
+        .role-susu {{ border-left: 4px solid #ff9800; }}
+
+        /* 头部信息 */
+        .bubble-header {{
+            display: flex;
+            align-items: center;
+            margin-bottom: 8px;
+            font-size: 0.9em;
+        }}
+
+        .avatar {{
+            width: 24px;
+            height: 24px;
+            border-radius: 50%;
+            display: inline-flex;
+            align-items: center;
+            justify-content: center;
+            margin-right: 8px;
+            font-size: 14px;
+        }}
+    </style>
+    {"".join(bubble_html for bubble_html, _ in bubbles)}
+    <script src="{script_src}"></script>
+    <script>
+        // 脚本放在所有图表之后，加载完成时图表节点都已存在，一次渲染全部图表
+        mermaid.initialize({{ startOnLoad: false, theme: 'default' }});
+        mermaid.init(undefined, document.querySelectorAll('.mermaid'));
+    </script>
+    """
+
+    return html_code, estimated_height
+
+
+if __name__ == "__main__":
+    print(f"Saved {fetch_mermaid()}")
@@ -0,0 +1,552 @@
+# storage.py
+"""对话历史的序列化和持久化存储（与 Streamlit 无关，便于复用和基准测试）"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+
+AGENT_KEYS = ("mark", "amy", "susu")
+
+# 每条消息记录除正文以外的估算内存开销（字节），用于会话内存上限的计算
+RECORD_OVERHEAD = 120
+
+
+def body_digest(text):
+    """消息正文的内容哈希（32 位十六进制），内存和 SQLite 中都用它引用正文"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class MessageBody:
+    """消息正文：相同内容在进程内只保存一份，所有引用它的记录共享同一个对象"""
+
+    __slots__ = ("digest", "text", "__weakref__")
+
+    def __init__(self, digest, text):
+        self.digest = digest
+        self.text = text
+
+    @property
+    def size(self):
+        return len(self.text.encode("utf-8"))
+
+
+# 不再被任何记录引用的正文会被自动回收
+_bodies = weakref.WeakValueDictionary()
+_bodies_lock = threading.Lock()
+
+
+def intern_body(text, digest=None):
+    """
+    返回内容为 text 的共享正文对象
+    :param digest: 已知的内容哈希（例如从 SQLite 读出时），省去重新计算
+    """
+    digest = digest or body_digest(text)
+    with _bodies_lock:
+        body = _bodies.get(digest)
+        if body is None:
+            body = MessageBody(digest, text)
+            _bodies[digest] = body
+        return body
+
+
+def interned_body_count():
+    """当前进程中共享正文的数量"""
+    return len(_bodies)
+
+
+class _Record:
+    """
+    紧凑的消息记录（__slots__），正文通过 MessageBody 引用
+    支持 message["content"] 和 message.get("role") 的读取方式，与原来的 dict 消息兼容
+    """
+
+    __slots__ = ()
+    _fields = ()
+
+    @property
+    def content(self):
+        return self.body.text
+
+    def __getitem__(self, key):
+        if key == "content":
+            return self.body.text
+        if key in self._fields:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self._fields}
+        data["content"] = self.body.text
+        return data
+
+
+class HistoryEntry(_Record):
+    """智能体对话历史中的一条消息 {"role", "content"}"""
+
+    __slots__ = ("role", "body", "row_id")
+    _fields = ("role",)
+
+    def __init__(self, role, content, digest=None, row_id=None):
+        self.role = role
+        self.body = intern_body(content, digest)
+        # 在会话存储中的行 ID，用于向前翻页
+        self.row_id = row_id
+
+
+class ChatMessage(_Record):
+    """统一聊天记录中的一条消息 {"sender", "name", "content", "timestamp"}"""
+
+    __slots__ = ("sender", "name", "timestamp", "body", "row_id")
+    _fields = ("sender", "name", "timestamp")
+
+    def __init__(self, sender, name, content, timestamp="", row_id=None, digest=None):
+        self.sender = sender
+        self.name = name
+        self.timestamp = timestamp
+        self.body = intern_body(content, digest)
+        # 在会话存储中的行 ID，用于向前翻页
+        self.row_id = row_id
+
+
+def _as_dict(message):
+    return message.to_dict() if isinstance(message, _Record) else message
+
+
+def serialize_history(conversation_history, chat_history):
+    """把各智能体的对话历史和统一聊天记录序列化成 JSON 字符串"""
+    conversation_data = {key: [_as_dict(m) for m in conversation_history[key]] for key in AGENT_KEYS}
+    conversation_data["chat"] = [_as_dict(m) for m in chat_history]  # 保存统一的聊天记录
+    return json.dumps(conversation_data)
+
+
+def deserialize_history(data):
+    """
+    从 JSON 字符串恢复对话历史
+    :return: (conversation_history, chat_history)，数据损坏时返回空历史
+    """
+    try:
+        conversation_data = json.loads(data)
+        conversation_history = {key: conversation_data.get(key, []) for key in AGENT_KEYS}
+        return conversation_history, conversation_data.get("chat", [])
+    except (ValueError, TypeError, AttributeError):
+        return {key: [] for key in AGENT_KEYS}, []
+
+
+class SessionStore:
+    """
+    持久化的会话存储（SQLite，WAL 模式）
+    每条消息一行，只追加不重写；按会话 ID 和消息流（"chat" 或智能体名）分页读取
+    保存和加载的开销只与新增/读取的消息数有关，与会话总长度无关，重启进程后历史仍然保留
+    消息正文按内容哈希单独保存在 bodies 表中，同一份草稿在各个消息流中只存一次
+    """
+
+    CHAT_STREAM = "chat"
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            # WAL 模式下读写互不阻塞，多个 Streamlit 会话可以同时写入
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "session_id TEXT NOT NULL, "
+            "stream TEXT NOT NULL, "
+            "kind TEXT NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "created REAL NOT NULL, "
+            "body TEXT)"
+        )
+        # 旧版本的数据库没有 body 列，正文直接保存在 payload 中
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(messages)")]
+        if "body" not in columns:
+            self._db.execute("ALTER TABLE messages ADD COLUMN body TEXT")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS bodies (digest TEXT PRIMARY KEY, content TEXT NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS messages_by_stream ON messages (session_id, stream, id)"
+        )
+        self._db.commit()
+
+    def append(self, session_id, entries):
+        """
+        在一个事务中追加若干条消息
+        :param session_id: 会话 ID
+        :param entries: [(stream, message), ...]，stream 为 "chat" 或智能体名，message 为 dict 或消息记录
+        :return: 新消息的行 ID 列表
+        """
+        now = time.time()
+        ids = []
+        with self._lock:
+            for stream, message in entries:
+                if isinstance(message, _Record):
+                    digest, content = message.body.digest, message.body.text
+                    meta = {field: getattr(message, field) for field in message._fields}
+                else:
+                    content = message.get("content", "")
+                    digest = body_digest(content)
+                    meta = {k: v for k, v in message.items() if k != "content"}
+                kind = meta.get("sender") or meta.get("role") or ""
+                self._db.execute("INSERT OR IGNORE INTO bodies (digest, content) VALUES (?, ?)", (digest, content))
+                cursor = self._db.execute(
+                    "INSERT INTO messages (session_id, stream, kind, payload, created, body) VALUES (?, ?, ?, ?, ?, ?)",
+                    (session_id, stream, kind, json.dumps(meta, ensure_ascii=False), now, digest)
+                )
+                ids.append(cursor.lastrowid)
+            self._db.commit()
+        return ids
+
+    _SELECT = (
+        "SELECT m.id, m.payload, m.body, b.content FROM messages m "
+        "LEFT JOIN bodies b ON b.digest = m.body "
+        "WHERE m.session_id = ? AND m.stream = ?"
+    )
+
+    @staticmethod
+    def _row(row):
+        row_id, payload, digest, content = row
+        message = json.loads(payload)
+        if content is not None:
+            message["content"] = content
+        message.setdefault("content", "")
+        return row_id, digest, message
+
+    def load(self, session_id, stream, limit=None, before_id=None):
+        """
+        按时间顺序读取一个消息流
+        :param limit: 最多读取最近的多少条（None 表示全部）
+        :param before_id: 只读取行 ID 小于该值的消息，用于向前翻页
+        :return: [(行 ID, 正文哈希, message), ...]，旧数据的正文哈希为 None
+        """
+        query = self._SELECT
+        params = [session_id, stream]
+        if before_id is not None:
+            query += " AND m.id < ?"
+            params.append(before_id)
+        query += " ORDER BY m.id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        return [self._row(row) for row in reversed(rows)]
+
+    def load_chat_rounds(self, session_id, rounds, before_id=None):
+        """
+        读取统一聊天记录中最近 rounds 轮（每条用户消息开始新的一轮）
+        :return: ([(行 ID, 正文哈希, message), ...], 更早是否还有记录)
+        """
+        return self.load_rounds(session_id, self.CHAT_STREAM, rounds, before_id)
+
+    def load_rounds(self, session_id, stream, rounds, before_id=None):
+        """
+        读取一个消息流中最近 rounds 轮：聊天记录中每条用户消息、智能体历史中每条 user 消息开始新的一轮
+        :return: ([(行 ID, 正文哈希, message), ...], 更早是否还有记录)
+        """
+        query = "SELECT id FROM messages WHERE session_id = ? AND stream = ? AND kind = 'user'"
+        params = [session_id, stream]
+        if before_id is not None:
+            query += " AND id < ?"
+            params.append(before_id)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(rounds + 1)
+        with self._lock:
+            starts = [row[0] for row in self._db.execute(query, params).fetchall()]
+        if len(starts) <= rounds:
+            # 剩余的不足 rounds 轮：全部读出
+            return self.load(session_id, stream, before_id=before_id), False
+
+        query = self._SELECT + " AND m.id >= ?"
+        params = [session_id, stream, starts[rounds - 1]]
+        if before_id is not None:
+            query += " AND m.id < ?"
+            params.append(before_id)
+        query += " ORDER BY m.id"
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        return [self._row(row) for row in rows], True
+
+    def clear(self, session_id):
+        """删除一个会话的全部消息，以及不再被引用的正文"""
+        with self._lock:
+            self._db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._db.execute(
+                "DELETE FROM bodies WHERE digest NOT IN (SELECT body FROM messages WHERE body IS NOT NULL)"
+            )
+            self._db.commit()
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_default_store():
+    """
+    进程级共享的会话存储
+    通过环境变量 SESSION_STORE_PATH 配置 SQLite 文件路径（默认 sessions.sqlite3）
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = SessionStore(os.getenv("SESSION_STORE_PATH", "sessions.sqlite3"))
+        return _default_store
+
+
+class SessionHistory:
+    """
+    一个会话在内存中的历史
+    conversation_history: {智能体名: [HistoryEntry, ...]}，只包含已加载的最近几轮
+    chat_history: [ChatMessage, ...]，只包含已加载的最近几轮
+    history_has_more: {智能体名: 会话存储中是否还有更早的对话历史}
+    """
+
+    __slots__ = ("session_id", "conversation_history", "chat_history", "has_more", "history_has_more", "last_used")
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.conversation_history = {key: [] for key in AGENT_KEYS}
+        self.chat_history = []
+        self.has_more = False
+        self.history_has_more = {key: False for key in AGENT_KEYS}
+        self.last_used = time.monotonic()
+
+    @property
+    def oldest_id(self):
+        """内存中最早一条聊天记录的行 ID"""
+        for message in self.chat_history:
+            if message.row_id is not None:
+                return message.row_id
+        return None
+
+    def memory_bytes(self):
+        """估算本会话占用的内存：引用到的正文各算一次，加上每条记录的固定开销"""
+        bodies = {}
+        count = len(self.chat_history)
+        for message in self.chat_history:
+            bodies[message.body.digest] = message.body.size
+        for history in self.conversation_history.values():
+            count += len(history)
+            for entry in history:
+                bodies[entry.body.digest] = entry.body.size
+        return sum(bodies.values()) + count * RECORD_OVERHEAD
+
+
+def _drop_oldest_turn(history):
+    """删除最早的一轮（从 user 消息开始到下一条 user 消息之前）"""
+    end = 1
+    while end < len(history) and history[end].role != "user":
+        end += 1
+    del history[:end]
+
+
+class SessionCache:
+    """
+    进程级的会话历史缓存
+    - 消息以紧凑记录保存，正文按内容共享：同一份草稿在四个历史列表中只占一份内存
+    - 加载会话时聊天记录只读最近 chat_rounds 轮，每个智能体的对话历史只读最近 history_turns 轮，
+      更早的部分需要时用 load_earlier / load_earlier_history 分页读入
+    - 单个会话超过 max_session_bytes 时，先从内存中移除最早的聊天记录（仍在 SQLite 中，可以再加载），
+      仍然超出时移除智能体历史中最早的轮次
+    - 超过 max_sessions 个会话或闲置超过 idle_seconds 的会话从内存中淘汰，下次访问时从 SQLite 重新加载
+    """
+
+    def __init__(self, store, chat_rounds=5, max_session_bytes=2 * 1024 * 1024, max_sessions=200,
+                 idle_seconds=1800, history_turns=20):
+        """
+        :param store: SessionStore
+        :param chat_rounds: 首次加载和每次向前翻页的聊天记录轮数
+        :param history_turns: 首次加载和每次向前翻页的智能体对话历史轮数（更早的轮次在发送前本来也会被折叠成摘要）
+        :param max_session_bytes: 单个会话的内存上限（字节）
+        :param max_sessions: 内存中最多保留的会话数
+        :param idle_seconds: 会话闲置多久后从内存中淘汰
+        """
+        self.store = store
+        self.chat_rounds = chat_rounds
+        self.max_session_bytes = max_session_bytes
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.history_turns = history_turns
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """返回会话历史，不在内存中时从会话存储加载"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+        if session is None:
+            session = self._load(session_id)
+            with self._lock:
+                # 并发加载同一个会话时保留先放入的那一份
+                session = self._sessions.setdefault(session_id, session)
+                self._sessions.move_to_end(session_id)
+        session.last_used = time.monotonic()
+        self._evict_cold(keep=session_id)
+        return session
+
+    def _load(self, session_id):
+        session = SessionHistory(session_id)
+        for key in AGENT_KEYS:
+            rows, session.history_has_more[key] = self.store.load_rounds(session_id, key, self.history_turns)
+            session.conversation_history[key] = [self._history_entry(row) for row in rows]
+        rows, session.has_more = self.store.load_chat_rounds(session_id, self.chat_rounds)
+        session.chat_history = [self._chat_message(row) for row in rows]
+        self._enforce_cap(session)
+        return session
+
+    @staticmethod
+    def _chat_message(row):
+        row_id, digest, message = row
+        return ChatMessage(
+            message.get("sender", ""), message.get("name", ""), message["content"],
+            message.get("timestamp", ""), row_id=row_id, digest=digest
+        )
+
+    @staticmethod
+    def _history_entry(row):
+        row_id, digest, message = row
+        return HistoryEntry(message.get("role", ""), message["content"], digest, row_id=row_id)
+
+    def load_earlier(self, session):
+        """从会话存储再加载更早的几轮聊天记录"""
+        rows, session.has_more = self.store.load_chat_rounds(
+            session.session_id, self.chat_rounds, before_id=session.oldest_id
+        )
+        session.chat_history[:0] = [self._chat_message(row) for row in rows]
+
+    def load_earlier_history(self, session, key, turns=None):
+        """
+        从会话存储再加载一个智能体更早的几轮对话历史
+        :param turns: 加载的轮数，默认 history_turns
+        :return: 加载的消息数
+        """
+        if not session.history_has_more[key]:
+            return 0
+        history = session.conversation_history[key]
+        before_id = next((entry.row_id for entry in history if entry.row_id is not None), None)
+        rows, session.history_has_more[key] = self.store.load_rounds(
+            session.session_id, key, turns or self.history_turns, before_id=before_id
+        )
+        history[:0] = [self._history_entry(row) for row in rows]
+        return len(rows)
+
+    def add_user_message(self, session, sender, name, content, timestamp):
+        """记录用户提交的草稿，返回新的聊天记录"""
+        message = ChatMessage(sender, name, content, timestamp)
+        message.row_id = self.store.append(session.session_id, [(SessionStore.CHAT_STREAM, message)])[0]
+        session.chat_history.append(message)
+        return message
+
+    def add_reply(self, session, key, user_content, reply):
+        """
+        记录一个智能体本轮的回复：写入统一聊天记录和该智能体的对话历史，只追加新增的消息
+        :param reply: {"sender", "name", "content", "timestamp"}
+        :return: 新的聊天记录
+        """
+        message = ChatMessage(reply["sender"], reply["name"], reply["content"], reply.get("timestamp", ""))
+        entries = [HistoryEntry("user", user_content), HistoryEntry("assistant", reply["content"])]
+        row_ids = self.store.append(
+            session.session_id,
+            [(SessionStore.CHAT_STREAM, message)] + [(key, entry) for entry in entries]
+        )
+        message.row_id = row_ids[0]
+        for entry, row_id in zip(entries, row_ids[1:]):
+            entry.row_id = row_id
+        session.chat_history.append(message)
+        session.conversation_history[key].extend(entries)
+        self._enforce_cap(session)
+        return message
+
+    def clear(self, session):
+        """清除会话的全部历史（内存和会话存储）"""
+        session.conversation_history = {key: [] for key in AGENT_KEYS}
+        session.chat_history = []
+        session.has_more = False
+        session.history_has_more = {key: False for key in AGENT_KEYS}
+        self.store.clear(session.session_id)
+
+    def _enforce_cap(self, session):
+        if session.memory_bytes() <= self.max_session_bytes:
+            return
+        # 先移除最早的聊天记录（至少保留最近一轮），它们仍可从会话存储中重新加载
+        chat = session.chat_history
+        while session.memory_bytes() > self.max_session_bytes:
+            starts = [i for i, message in enumerate(chat) if message.sender == "user"]
+            if len(starts) < 2:
+                break
+            del chat[:starts[1]]
+            session.has_more = True
+        # 仍然超出时移除智能体历史中最早的轮次（每个智能体至少保留最近一轮），它们同样可以重新加载
+        while session.memory_bytes() > self.max_session_bytes:
+            keys = [key for key, h in session.conversation_history.items()
+                    if sum(1 for entry in h if entry.role == "user") > 1]
+            if not keys:
+                break
+            key = max(keys, key=lambda k: len(session.conversation_history[k]))
+            _drop_oldest_turn(session.conversation_history[key])
+            session.history_has_more[key] = True
+
+    def _evict_cold(self, keep=None):
+        now = time.monotonic()
+        with self._lock:
+            for session_id in list(self._sessions):
+                if session_id == keep:
+                    continue
+                session = self._sessions[session_id]
+                if len(self._sessions) > self.max_sessions or now - session.last_used > self.idle_seconds:
+                    del self._sessions[session_id]
+                    self.evictions += 1
+                else:
+                    # 按最近使用排序，剩下的都比它更新
+                    break
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "evictions": self.evictions,
+            "memory_bytes": sum(s.memory_bytes() for s in sessions),
+            "bodies": interned_body_count(),
+        }
+
+
+_default_sessions = None
+_default_sessions_lock = threading.Lock()
+
+
+def get_session_cache(chat_rounds=5):
+    """
+    进程级共享的会话历史缓存
+    通过环境变量配置：SESSION_MEMORY_CAP（单个会话的内存上限，字节，默认 2 MB），
+    SESSION_CACHE_SIZE（内存中保留的会话数，默认 200），SESSION_IDLE_SECONDS（闲置淘汰时间，默认 1800），
+    SESSION_HISTORY_TURNS（每个智能体加载的对话历史轮数，默认 20）
+    """
+    global _default_sessions
+    with _default_sessions_lock:
+        if _default_sessions is None:
+            _default_sessions = SessionCache(
+                get_default_store(),
+                chat_rounds=chat_rounds,
+                max_session_bytes=int(os.getenv("SESSION_MEMORY_CAP", str(2 * 1024 * 1024))),
+                max_sessions=int(os.getenv("SESSION_CACHE_SIZE", "200")),
+                idle_seconds=float(os.getenv("SESSION_IDLE_SECONDS", "1800")),
+                history_turns=int(os.getenv("SESSION_HISTORY_TURNS", "20"))
+            )
+        return _default_sessions